@@ -6,27 +6,25 @@ import astropy.io.fits as fits
 from astropy.table import Table
 from astropy.coordinates import SkyCoord
 from astropy import units as u
-from astropy.nddata import NDData
-from astroimtools import nddata_stats
+from astropy import wcs
 import datetime
 import os
 import logging
 import time
-import seaborn as sns
-import matplotlib
 import glob
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import copy
-from scipy.interpolate import UnivariateSpline as spln
 
 from des_stacks import des_stack as stack
 from des_stacks.utils.stack_tools import make_cap_stamps, resample_chip_for_cap, get_chip_vals, get_cuts
-from des_stacks.utils.source_tools import cap_source_sn, cap_source_chip, get_sn_dat
+from des_stacks.utils.source_tools import cap_source_sn, cap_source_chip, get_sn_dat, get_sn_dats
 from des_stacks.utils.gen_tools import mc_robust_median as r_median
+from des_stacks.utils.ref_cat import get_ref_stars
+from des_stacks.utils.sky_noise import sky_noise
+from des_stacks.utils.result_writer import write_region, write_result
+from des_stacks.utils.grc_index import get_grc_index
+from des_stacks.utils.dlr import get_DLR_ABT, find_pairs, dlr_pairs, signed_rank
+from des_stacks.utils.header_cache import getheader
 
-sns.set_palette('Dark2')
-sns.set_color_codes(palette='colorblind')
 hashes = "#" *45
 def init_calib(s,chip,sourcecat,phot_type='AUTO'):
     '''Function to match sources and calculate a zeropoint'''
@@ -48,43 +46,30 @@ def init_calib(s,chip,sourcecat,phot_type='AUTO'):
     logger.info(hashes)
     logger.info("Reading in catalog in order to do photometry")
     cmap = {'PSF':'red','AUTO':'green','cat':'blue','APER':'purple'}
-    y3a1_fn = os.path.join(s.cat_dir,'y3a1_%s_%s.csv'%(s.field[3],s.band))
-    y3a1 = pd.DataFrame.from_csv(y3a1_fn)
     logger.info("Reading in sourcecat: %s"%sourcecat)
-    sourcedat = fits.getdata(sourcecat,ext=1)
-    logger.info("Successfully read in catalog: %s" %y3a1_fn)
-    Band = s.band.capitalize()
-    star_inds = ((((y3a1['SPREAD_MODEL_%s'%Band] + 3*y3a1['SPREADERR_MODEL_%s'%Band])<0.003)) & ((y3a1['MAG_AUTO_%s'%Band]>19.5)&(y3a1['MAG_AUTO_%s'%Band]<23.5)))
-
-    y3a1_stars = y3a1[star_inds]
+    if isinstance(sourcecat,np.ndarray):
+        # already in memory, from the sep backend
+        sourcedat = sourcecat
+    else:
+        sourcedat = fits.getdata(sourcecat,ext=1)
+    # the stars of the Y3A1 catalogue, loaded and indexed once per field and band
+    ref = get_ref_stars(s.cat_dir,s.field,s.band,logger=logger)
+    logger.info("Successfully read in catalog of %s stars for %s, %s band" %(len(ref),s.field,s.band))
 
     logger.info("Matching objects...")
     new =pd.DataFrame(sourcedat)
-    new_obj = SkyCoord(ra=new['X_WORLD'].values*u.degree,dec =new['Y_WORLD'].values*u.degree)
-    old_obj = SkyCoord(ra=y3a1_stars['RA'].values*u.degree,dec =y3a1_stars['DEC'].values*u.degree)
-    # match the catalogs
-    idx, d2d, d3d = new_obj.match_to_catalog_sky(old_obj)
-    match_ids = idx
-    match_dists = d2d.arcsec
-    logger.info("Successfully matched %s objects!" %len(match_ids))
-    # get old cat mags of the matched objects
-    init_match_cat_mag =y3a1_stars['MAG_AUTO_%s'%Band].iloc[match_ids]
-    init_match_cat_magerr =y3a1_stars['MAGERR_AUTO_%s'%Band].iloc[match_ids]
-    # get indices of the objects that are within a specified distance of their matches
+    # match the catalogs, keeping the objects that are within a specified distance of their matches
     dist_cut =2.0
-    good_inds = np.nonzero(match_dists < dist_cut)[0]
-
-    good_new_ra = new['X_WORLD'].iloc[good_inds]
-    good_new_dec = new['Y_WORLD'].iloc[good_inds]
+    match_ids,match_dists = ref.match(new['X_WORLD'].values,new['Y_WORLD'].values,dist_cut)
+    good_inds = np.nonzero(match_ids>=0)[0]
+    logger.info("Successfully matched %s objects!" %len(good_inds))
     logger.info("Using catalog magnitudes to calibrate photometry and get zeropoint")
     # find the new mags that correspond to that
     good_new_mag = new['MAG_AUTO'].iloc[good_inds]
-    good_new_magerr = new['MAGERR_AUTO'].iloc[good_inds]
     # and the old ones
-    good_cat_mag = init_match_cat_mag.iloc[good_inds]
-    good_cat_magerr = init_match_cat_magerr.iloc[good_inds]
+    good_cat_mag = ref.mag[match_ids[good_inds]].astype(np.float64)
     # subtract to get the frame ZP
-    diffs = good_cat_mag.values - good_new_mag.values
+    diffs = good_cat_mag - good_new_mag.values
     zp,zp_sig = r_median(diffs,return_sigma=True)
     psf,psf_sig = r_median(new['FWHM_WORLD']*3600,return_sigma=True)
     logger.info("Successfully calbirated this DES stack of: %s, MY %s, %s band, CCD %s" %(s.field,s.my,s.band,chip))
@@ -93,6 +78,7 @@ def init_calib(s,chip,sourcecat,phot_type='AUTO'):
 
 def init_phot(s,chip,cat,pl='n'):
     '''Function to calibrate photometry and determine limiting magnitudes'''
+    from scipy.interpolate import UnivariateSpline as spln
 
     s.logger.info(hashes)
     s.logger.info("Entered 'init_phot.py' to get Kron and PSF photometry, provide limiting magnitudes, and write out the results file for \n MY%s, %s, %s, %s" %(s.my,s.field,chip,s.band))
@@ -133,15 +119,17 @@ def init_phot(s,chip,cat,pl='n'):
     cat = cat.iloc[truth.values]
 
     # make region files for ds9
-    krreg = open(os.path.join(ana_dir,'%s_%s_%s_%s_auto.reg'%(s.my,s.field,s.band,chip)),'w')
-
-    for i in range(len(cat['X_WORLD'].values)):
-        print ('fk5; circle(%s,%s,1") # text={%.2f +/- %.2f}'%(cat['X_WORLD'].iloc[i],cat['Y_WORLD'].iloc[i],cat['MAG_AUTO'].iloc[i],cat['MAGERR_AUTO'].iloc[i]),file=krreg)
-    krreg.close()
+    write_region(os.path.join(ana_dir,'%s_%s_%s_%s_auto.reg'%(s.my,s.field,s.band,chip)),
+        cat['X_WORLD'],cat['Y_WORLD'],cat['MAG_AUTO'],cat['MAGERR_AUTO'])
     s.logger.info("Saved ds9 region files in /ana directory")
-    sns.set_palette('Dark2')
-    sns.set_color_codes(palette='colorblind')
     if pl == 'y':
+        # plotting is only needed here, so keep it out of the import of the pipeline
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        sns.set_palette('Dark2')
+        sns.set_color_codes(palette='colorblind')
         f,ax=plt.subplots()
         alp= 0.75
         cat.hist(column='MAG_AUTO',bins=150,normed=True,ax=ax,alpha=alp+0.25,label='Kron Magnitudes',color='r')
@@ -183,17 +171,17 @@ def init_phot(s,chip,cat,pl='n'):
     c2 = c2[c2['MAGERR_AUTO']>b_lo]
     kr_lim2 = c2['MAG_AUTO'].median()
 
-    nclip=50
-    s.logger.info("Running nddata_stats on %s in order to get sky noise" %imgname)
-    nd1 = NDData(fits.getdata(imgname))
-    columns=['mean','std']
-    tbl = nddata_stats(nd1,columns=columns,sigma=2.8,iters=10)
-    s.logger.info(tbl)
-    mean,skynoise = tbl['mean'],tbl['std']
-    s.logger.info('Skynoise: %s'%skynoise)
-    h = fits.getheader(imgname)
+    h = getheader(imgname)
     exptime= h['EXPTIME']
     pixscale=0.27
+    # the sky noise from a subsample of the pixels, away from the sources and off the edges
+    s.logger.info("Measuring the sky noise of %s" %imgname)
+    wgtname = imgname.replace('_sci.fits','_wgt.fits')
+    if not os.path.isfile(wgtname):
+        wgtname = None
+    src_x,src_y = wcs.WCS(h,naxis=2).all_world2pix(cat['X_WORLD'].values,cat['Y_WORLD'].values,1)
+    mean,skynoise = sky_noise(imgname,wgtname,sources=(src_x,src_y,2*av_fwhm/pixscale),logger=s.logger)
+    s.logger.info('Skynoise: %s'%skynoise)
 
     thresh = 5
     skyflux = skynoise*np.sqrt(np.pi*(av_fwhm/pixscale)**2)
@@ -203,26 +191,10 @@ def init_phot(s,chip,cat,pl='n'):
     s.logger.info("%s sigma limiting magnitude based on matched objects: %.3f\n"%(limsig,kr_lim2))
     s.logger.info("%s sigma limiting magnitude using zeropoint %.3f: %.3f\n "%(thresh,zp,skylim))
 
-    resfile = open(os.path.join(ana_dir,'%s_%s_%s_%s_init_wgtd.result'%(s.my,s.field,s.band,chip)),'w')
-    cat['FWHM_WORLD'] = cat['FWHM_WORLD']*3600
-    for i in range(len(cat['FWHM_WORLD'].values)):
-        cat['FWHM_WORLD'].values[i] = float(cat['FWHM_WORLD'].values[i])
-    radec=cat[['X_WORLD','Y_WORLD']].applymap("{0:7.5f}".format)
-    try:
-        rest = cat[['MAG_AUTO','MAGERR_AUTO','MAG_PSF','MAGERR_PSF','MAG_APER','MAGERR_APER','FWHM_WORLD','ELONGATION']].applymap("{0:4.3f}".format)
-    except:
-        rest = cat[['MAG_AUTO','MAGERR_AUTO','MAG_PSF','MAGERR_PSF','FWHM_WORLD','ELONGATION']].applymap("{0:4.3f}".format)
-
-    rest[['X_WORLD','Y_WORLD']]=radec[['X_WORLD','Y_WORLD']]
-    rest['CLASS_STAR']=cat['CLASS_STAR']
-    rest['FLUX_RADIUS']=cat['FLUX_RADIUS']
-    cols = rest.columns.tolist()
-    rearranged = cols[-2:]+cols[:-2]
-    re = rest[rearranged]
-    re.to_csv(os.path.join(s.temp_dir,'temp_cat.csv'),index=False,sep=' ')
-    stringthing = open(os.path.join(s.temp_dir,'temp_cat.csv'),'r')
-    psfstring = stringthing.read()
-    stringthing.close()
+    cat['FWHM_WORLD'] = cat['FWHM_WORLD'].astype(np.float64)*3600
+    columns = ['CLASS_STAR','FLUX_RADIUS','MAG_AUTO','MAGERR_AUTO','MAG_PSF','MAGERR_PSF',
+        'MAG_APER','MAGERR_APER','FWHM_WORLD','ELONGATION','X_WORLD','Y_WORLD']
+    columns = [c for c in columns if c in cat.columns]
     reshead = '# Result file for a stack of Dark Energy Survey data taken by DECam\n'
     reshead +='# Field: %s\n'% s.field
     reshead +='# Minus year: %s\n'% s.my
@@ -243,9 +215,10 @@ def init_phot(s,chip,cat,pl='n'):
     reshead +='# FWHM of the source (arcsec)\n'
     reshead +='# Elongation of source\n'
     reshead +='# Flux Radius\n'
-    resfile.write(reshead)
-    resfile.write(psfstring)
     savestring = os.path.join(ana_dir,'%s_%s_%s_%s_init_wgtd.result'%(s.my,s.field,s.band,chip))
+    meta = {'FIELD':s.field,'MY':s.my,'BAND':s.band,'CCDNUM':chip,'EXPTIME':exptime,'ZP':zp,'ZP_SIG':zp_sig,
+        'KRON_LIM':kr_lim,'LIM_%sSIG'%limsig:kr_lim2,'SKYLIM_%sSIG'%thresh:skylim}
+    write_result(savestring,cat,reshead,columns,meta,binary=getattr(s,'result_binary',None))
     s.logger.info("Saved result file to: %s"%savestring)
     s.logger.info(hashes)
     return (kr_lim,kr_lim2,skylim,np.mean([kr_lim,kr_lim2,skylim]))
@@ -344,7 +317,7 @@ def cap_phot_sn(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thresh
         close_inds = d2d <dist_thresh*u.arcsec
         dists = d2d[close_inds]
         match = capcat.iloc[close_inds]
-        angsep = np.array([float(d2d[close_inds][j].to_string(unit=u.arcsec,decimal=True)) for j in range(len(d2d[close_inds]))])
+        angsep = d2d[close_inds].arcsec
         with open(os.path.join(s.band_dir,str(chip),'ana',
             '%s_%s_%s_%s_init.result'%(y,f,s.band,chip)),'r') as resheader:
             header = [next(resheader) for x in range(9)]
@@ -391,14 +364,11 @@ def cap_phot_sn(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thresh
 
                 res_df = res_df.append(match)
                 res_df['SN_NAME']=sn_name
-                dlr = get_DLR_ABT(ra,dec, match.X_WORLD, match.Y_WORLD, match['A_IMAGE'], match['B_IMAGE'],  match['THETA_IMAGE'], angsep)[0]
+                angsep,dlr,rank = dlr_pairs(ra,dec, match.X_WORLD, match.Y_WORLD, match['A_IMAGE'], match['B_IMAGE'],  match['THETA_IMAGE'],
+                    angsep=angsep,method='average')
 
-                res_df['DLR'] = np.array(dlr)
-                rank = res_df['DLR'].rank().astype(int)
-                for counter, r in enumerate(res_df['DLR'].values):
-                    if r >4:
-                        rank[counter]*=-1
-                res_df['DLR_RANK']=rank
+                res_df['DLR'] = dlr
+                res_df['DLR_RANK'] = rank
             else:
                 match =match.rename(index=str,columns=band_cols)
 
@@ -606,45 +576,45 @@ def cap_phot_all(y,f,chip,wd='coadding',autocuts = False):
     logger.info(hashes)
     return matched_cat_df
 
-def cap_sn_lookup(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thresh = 5,autocuts=False):
-    logger = logging.getLogger(__name__)
-    logger.handlers =[]
-    ch = logging.StreamHandler()
-    logger.setLevel(logging.INFO)
-    ch.setLevel(logging.INFO)
-    formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    logger.info(hashes)
-    logger.info("Entered 'cap_sn_lookup' to do find host galaxy candidates for %s"%sn_name)
-    logger.info(hashes)
-    bands = ['g','r','i','z']
-
-    try:
-        ra,dec,f,y,chip = get_sn_dat(snid =int(sn_name))
-    except:
-        try:
-            ra,dec,f,y,chip = get_sn_dat(sn_name= sn_name)
-        except:
-
-            return None
-    my = 'MY'+str(y)
+def _cap_cat_fn(y,f,ch):
+    return os.path.join('/media/data3/wiseman/des/coadding/5yr_stacks','MY%s'%y,
+                        f,'CAP',str(ch),'%s_%s_%s_obj_deep_v7.cat'%(y,f,ch))
+
+def _host_pairs(sns,capres,dist_thresh):
+    '''Finds the galaxies of a CAP catalogue within dist_thresh arcsec of every SN in sns,
+    returning {sn_name: (row numbers in capres, separations in arcsec, DLRs)}'''
+    if len(sns)==0 or len(capres)==0:
+        return {}
+    sn_ra,sn_dec = sns['ra'].values.astype(float),sns['dec'].values.astype(float)
+    gal_ra,gal_dec = capres['X_WORLD'].values.astype(float),capres['Y_WORLD'].values.astype(float)
+    sn_inds,gal_inds,angsep = find_pairs(sn_ra,sn_dec,gal_ra,gal_dec,dist_thresh)
+    # the galaxies also have to be in a box dist_thresh wide in RA and Dec, as they always have been
+    search_rad = dist_thresh/3600
+    close = (np.abs(gal_ra[gal_inds]-sn_ra[sn_inds])<search_rad)&(np.abs(gal_dec[gal_inds]-sn_dec[sn_inds])<search_rad)
+    sn_inds,gal_inds,angsep = sn_inds[close],gal_inds[close],angsep[close]
+    angsep,dlr,_ = dlr_pairs(sn_ra[sn_inds],sn_dec[sn_inds],gal_ra[gal_inds],gal_dec[gal_inds],
+                      capres['A_IMAGE'].values[gal_inds],capres['B_IMAGE'].values[gal_inds],
+                      capres['THETA_IMAGE'].values[gal_inds],groups=sn_inds,angsep=angsep)
+    names = sns.index.values
+    bounds = np.searchsorted(sn_inds,np.arange(len(sns)+1))
+    return {names[i]:(gal_inds[bounds[i]:bounds[i+1]],angsep[bounds[i]:bounds[i+1]],dlr[bounds[i]:bounds[i+1]])
+            for i in range(len(sns)) if bounds[i+1]>bounds[i]}
+
+def _sn_hosts(sn_name,ra,dec,f,y,chip,cats,pairs,snspect,snspect_empty,logger):
+    '''Puts together the host candidates of one SN from the chip catalogues and the pairs found by _host_pairs'''
     main_res_df = pd.DataFrame()
     logger.debug('Looking in chips %s, %s, %s'%(chip -1, chip,chip+1))
     add_lim=False
     for ch in [chip -1, chip,chip+1]:
         if ch not in [0,2,31,61,63]:
             add_lim=False
-            capres_fn = os.path.join('/media/data3/wiseman/des/coadding/5yr_stacks',my,
-                                 f,'CAP',str(ch),'%s_%s_%s_obj_deep_v7.cat'%(y,f,ch))
-            capres = pd.read_csv(capres_fn,index_col = 0)
+            capres_fn = _cap_cat_fn(y,f,ch)
+            capres = cats[capres_fn]
             if len(capres)==0:
                 logger.debug('The capres  %s has no length'%capres_fn)
-            logger.debug('Managed to read in the catalog %s'%capres_fn)
-            search_rad = dist_thresh
-            capres_box = capres[(capres['X_WORLD']< ra+(search_rad/3600))&(capres['X_WORLD']> ra-(search_rad/3600)) & (capres['Y_WORLD']> dec-(search_rad/3600)) & (capres['Y_WORLD']< dec+(search_rad/3600))]
-            logger.debug('Found %s galaxies within a search box %.2f arsecs wide'%(len(capres_box.index.unique()),search_rad*2))
-            cols = capres_box.columns.tolist() + [
+            # the galaxies within dist_thresh, with their separations and DLRs, found for all the SNe at once
+            gal_inds,angsep,dlr = pairs[capres_fn].get(sn_name,(np.array([],dtype=int),np.array([]),np.array([])))
+            cols = capres.columns.tolist() + [
                 'SNID',
                  'DLR',
                  'DLR_RANK',
@@ -653,13 +623,7 @@ def cap_sn_lookup(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thre
             ]
             res_df = pd.DataFrame(columns=cols)
             res_df['EDGE_FLAG'] = 0
-            sncoord = SkyCoord(ra = ra*u.deg,dec = dec*u.deg)
-            catalog = SkyCoord(ra = capres_box.X_WORLD.values*u.deg,dec = capres_box.Y_WORLD.values*u.deg)
-            d2d= sncoord.separation(catalog)
-            close_inds = d2d <dist_thresh*u.arcsec
-            dists = d2d[close_inds]
-            match = capres_box.iloc[close_inds]
-            angsep = np.array([float(d2d[close_inds][j].to_string(unit=u.arcsec,decimal=True)) for j in range(len(d2d[close_inds]))])
+            match = capres.iloc[gal_inds]
             hashost = 0
             lims = True
             limcols = ['X_WORLD', 'Y_WORLD', 'X_IMAGE', 'Y_IMAGE', 'MAG_AUTO_g',
@@ -692,17 +656,10 @@ def cap_sn_lookup(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thre
                 res_df = res_df.append(match)
 
                 res_df['SNID']=sn_name
-                dlr = get_DLR_ABT(ra,dec, match.X_WORLD, match.Y_WORLD, match['A_IMAGE'], match['B_IMAGE'],  match['THETA_IMAGE'], angsep)[0]
-
                 res_df['ANGSEP'] = angsep
 
                 res_df['DLR'] = np.array(dlr)
-                rank = res_df['DLR'].rank(method='dense').astype(int)
-
-                for counter, r in enumerate(res_df['DLR'].values):
-                    if r >4:
-                        rank.iloc[counter]*=-1
-                res_df['DLR_RANK']=rank
+                res_df['DLR_RANK'] = signed_rank(res_df['DLR'].values)
                 if len(match)>5:
                     res_df = res_df[res_df['DLR']<30]
 
@@ -761,8 +718,7 @@ def cap_sn_lookup(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thre
                 if dlr<4 or lims:
                     logger.debug('There is a host with DLR <1, or there are limits')
 
-                    snspect = pd.read_csv('/media/data3/wiseman/des/coadding/catalogs/snspect.csv')
-                    snspecobs = snspect[snspect['SNID']==int(sn_name)]
+                    snspecobs = snspect.get(int(sn_name),snspect_empty)
 
                     if type(ind)==int:
                         underlying_host = res_df.loc[ind]
@@ -914,20 +870,85 @@ def cap_sn_lookup(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thre
     if add_lim:
         main_res_df.loc[ind,['DLR']] = 0
         logger.debug(main_res_df[['ANGSEP','DLR','DLR_RANK']])
-        rank = main_res_df['DLR'].rank(method='dense').astype(int)
-    else:
-        rank = main_res_df['DLR'].rank(method='dense').astype(int)
-
-    for counter, r in enumerate(main_res_df['DLR'].values):
-        if r >4:
-            rank.iloc[counter]*=-1
-    main_res_df['DLR_RANK']=rank
+    main_res_df['DLR_RANK'] = signed_rank(main_res_df['DLR'].values)
     # set DLR_RANK of limits to 0 and re-adjust the detections
     if len(main_res_df[main_res_df['DLR']==0])>0:
         main_res_df.sort_values('DLR',inplace=True)
         main_res_df['DLR_RANK'] = main_res_df['DLR_RANK'] - (main_res_df['DLR_RANK']/np.abs(main_res_df['DLR_RANK']))
         main_res_df['DLR_RANK'].iloc[0] = 0
 
+    return main_res_df
+
+def cap_sn_lookup_batch(sn_names,dist_thresh=5,save_fn=None,per_sn=False,logger=None):
+    '''Finds the host galaxy candidates of many SNe in one pass.
+    Each chip catalogue, the SN candidate table and snspect.csv are read once, and the
+    separations and DLRs of every SN in a catalogue are worked out together.
+    arguments:
+    sn_names (list): SNIDs or transient names
+    dist_thresh (float): radius to look for hosts in (arcsec)
+    save_fn (str): file to write the table of all the SNe to (default = not written)
+    per_sn (bool): also write the result of each SN to CAP/<sn_name>/<sn_name>_v7.5.result
+    returns:
+    main_res_df (DataFrame): the host candidates of all the SNe, with their SNID
+    '''
+    if not logger:
+        logger = logging.getLogger(__name__)
+    dist_thresh = float(dist_thresh)
+    sns = get_sn_dats(sn_names)
+    sns = sns[~sns.index.duplicated()]
+    for sn_name in sn_names:
+        if sn_name not in sns.index:
+            logger.warning('Could not find %s in the SN candidates; skipping it'%sn_name)
+    logger.info('Looking for the hosts of %s SNe'%len(sns))
+    # every chip catalogue is read once, and searched for all the SNe that are on or next to it
+    cats,pairs = {},{}
+    for off in [-1,0,1]:
+        for (f,y,ch),grp in sns.groupby([sns['field'],sns['season'],sns['chip']+off]):
+            if ch in [0,2,31,61,63]:
+                continue
+            capres_fn = _cap_cat_fn(y,f,ch)
+            if capres_fn not in cats:
+                cats[capres_fn] = pd.read_csv(capres_fn,index_col = 0)
+                logger.debug('Managed to read in the catalog %s'%capres_fn)
+                pairs[capres_fn] = {}
+            pairs[capres_fn].update(_host_pairs(grp,cats[capres_fn],dist_thresh))
+    snspect = pd.read_csv('/media/data3/wiseman/des/coadding/catalogs/snspect.csv')
+    snspect_empty = snspect.iloc[:0]
+    snspect = {snid:obs for snid,obs in snspect.groupby('SNID')}
+    results = []
+    for sn_name,sn in sns.iterrows():
+        try:
+            res_df = _sn_hosts(sn_name,sn['ra'],sn['dec'],sn['field'],sn['season'],sn['chip'],cats,pairs,snspect,snspect_empty,logger)
+        except Exception:
+            logger.exception('Could not find the hosts of %s'%sn_name)
+            continue
+        if per_sn:
+            sn_dir = '/media/data3/wiseman/des/coadding/5yr_stacks/CAP/%s'%sn_name
+            if not os.path.isdir(sn_dir):
+                os.mkdir(sn_dir)
+            res_df.to_csv(os.path.join(sn_dir,'%s_v7.5.result'%sn_name))
+        results.append(res_df)
+    main_res_df = pd.concat(results) if results else pd.DataFrame()
+    if save_fn:
+        main_res_df.to_csv(save_fn)
+        logger.info('Saved the hosts of %s SNe to %s'%(len(results),save_fn))
+    return main_res_df
+
+def cap_sn_lookup(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thresh = 5,autocuts=False):
+    logger = logging.getLogger(__name__)
+    logger.handlers =[]
+    ch = logging.StreamHandler()
+    logger.setLevel(logging.INFO)
+    ch.setLevel(logging.INFO)
+    formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.info(hashes)
+    logger.info("Entered 'cap_sn_lookup' to do find host galaxy candidates for %s"%sn_name)
+    logger.info(hashes)
+    main_res_df = cap_sn_lookup_batch([sn_name],dist_thresh=dist_thresh,logger=logger)
+    if len(main_res_df)==0:
+        return None
     if not os.path.isdir('/media/data3/wiseman/des/coadding/5yr_stacks/CAP/%s'%sn_name):
         os.mkdir('/media/data3/wiseman/des/coadding/5yr_stacks/CAP/%s'%sn_name)
     if not savename:
@@ -937,105 +958,9 @@ def cap_sn_lookup(sn_name,wd = 'coadding',savename = 'all_sn_phot.csv',dist_thre
     main_res_df.to_csv(save_fn)
     return main_res_df
 
-def get_DLR_ABT(RA_SN, DEC_SN, RA, DEC, A_IMAGE, B_IMAGE, THETA_IMAGE, angsep):
-    '''Function for calculating the DLR of a galaxy - SN pair (taken from dessne)'''
-
-    # inputs are arrays
-    rad  = np.pi/180                   # convert deg to rad
-    pix_arcsec = 0.264                 # pixel scale (arcsec per pixel)
-    pix2_arcsec2 = 0.264**2            # pix^2 to arcsec^2 conversion factor
-    pix2_deg2 = pix2_arcsec2/(3600**2) # pix^2 to deg^2 conversion factor
-    global numFailed
-    rPHI = np.empty_like(angsep)
-    d_DLR = np.empty_like(angsep)
-
-    # convert from IMAGE units (pixels) to WORLD (arcsec^2)
-    A_ARCSEC = A_IMAGE*pix_arcsec
-    B_ARCSEC = B_IMAGE*pix_arcsec
-
-    # angle between RA-axis and SN-host vector
-    GAMMA = np.arctan((DEC_SN - DEC)/(np.cos(DEC_SN*rad)*(RA_SN - RA)))
-
-    # angle between semi-major axis of host and SN-host vector
-    PHI = np.radians(THETA_IMAGE) + GAMMA # angle between semi-major axis of host and SN-host vector
-
-    rPHI = A_ARCSEC*B_ARCSEC/np.sqrt((A_ARCSEC*np.sin(PHI))**2 +
-                                     (B_ARCSEC*np.cos(PHI))**2)
-
-    # directional light radius
-    #  where 2nd moments are bad, set d_DLR = 99.99
-    d_DLR = angsep/rPHI
-
-    return [d_DLR, A_ARCSEC, B_ARCSEC, rPHI]
-
 def get_zs_box(s,search_ra,search_dec,search_rad):
     '''Function to get all objects in the OzDES GRC within a search radius'''
-
-    survey_flags = {
-    'DES_AAOmega':['1','2','3','4','6'],
-    'DEVILS':['1','2','3','4','6'],
-    'ZFIRE_UDS':['3'],
-    'NOAO_0522':['3','4','6'],
-    'NOAO_0334':['3','4','6'],
-    'N17B331':['4','6'],
-    'MOSDEF':['Any'],
-    'SpARCS':['1','2'],
-    'PanSTARRS_AAOmega':['3','4','6'],
-    'PanSTARRS_MMT': ['3','4','6'],
-    'PRIMUS': ['3','4'],
-    'NED': ['Any'],
-    'UDS_FORS2':['A','B'],
-    'UDS_VIMOS':['3','4'],
-    'ACES': ['3','4'],
-    'SDSS': ['0'],
-    '6dF': ['4'],
-    'ATLAS':['Any'],
-    '2dFGRS':['3','4'],
-    'GAMA':['4'],
-    'SNLS_FORS':['1','2'],
-    'CDB':['Any'],
-    'VVDS_DEEP':['3','4','13','14','23','24','213','214'],
-    'VVDS_CDFS':['3','4','13','14','23','24'],
-    'MUSE':['3','2'],
-    'SAGA':['4'],
-    'SNLS_AAOmega':['3','4','6'],
-    'VIPERS':['23.4', '2.4', '4.4', '3.5', '4.5', '2.2', '3.2', '4.2',
-       '2.5', '9.5', '3.4', '19.5', '12.2', '9.4', '9.2', '13.2',
-       '22.5', '24.2', '24.4', '14.2', '12.4', '24.5', '12.5', '22.2',
-       '29.2', '23.5', '29.1', '22.1', '19.2', '13.5', '22.4', '29.5',
-       '14.4', '23.2', '13.4', '14.5', '19.4', '23.1', '29.4', '2.1',
-       '24.1', '4.1', '3.1', '219.', '13.1', '14.1', '9.1', '19.1',
-       '12.1'],
-    'VIPERS_private_communication':['23.4', '2.4', '4.4', '3.5', '4.5', '2.2', '3.2', '4.2',
-       '2.5', '9.5', '3.4', '19.5', '12.2', '9.4', '9.2', '13.2',
-       '22.5', '24.2', '24.4', '14.2', '12.4', '24.5', '12.5', '22.2',
-       '29.2', '23.5', '29.1', '22.1', '19.2', '13.5', '22.4', '29.5',
-       '14.4', '23.2', '13.4', '14.5', '19.4', '23.1', '29.4', '2.1',
-       '24.1', '4.1', '3.1', '219.', '13.1', '14.1', '9.1', '19.1',
-       '12.1'],
-    'DEEP2_DR4':['-1','3','4'],
-    'VUDS_COSMOS':['3','4','13','14','23','24','43','44'],
-    'VUDS_ECDFS':['3','4','13','14','23','24','43','44'],
-    'XMM__Stalin':['1'],
-    'KMOS':['0'],
-    '2dF Archive':['1','2','3','4','6'],
-    }
-    grc = Table.read('/media/data3/wiseman/des/coadding/catalogs/OzDES_GRC_2020_08_01.fits')
-    for col in ['ID','flag','source','Comment','Object_types','Transient_type']:
-        grc[col] = grc[col].astype(str)
-
-    grc = grc.to_pandas()
-    grc['flag'] = grc['flag'].str.strip(' ')
-    good_redshifts = pd.DataFrame()
-    for survey,flags in survey_flags.items():
-        if flags !=['Any']:
-            for flag in flags:
-                good_redshifts = good_redshifts.append(grc[(grc['source']==survey)&(grc['flag']==flag)])
-        else:
-            good_redshifts = good_redshifts.append(grc[grc['source']==survey])
-    good_in_search_box = (good_redshifts['RA']< search_ra+search_rad)&(good_redshifts['RA']> search_ra-search_rad) & (good_redshifts['DEC']> search_dec-search_rad) & (good_redshifts['DEC']< search_dec+search_rad)
-
-    gals_with_z = good_redshifts[good_in_search_box]
+    gals_with_z = get_grc_index(s.cat_dir).box(search_ra,search_dec,search_rad)
     z_gals = SkyCoord(ra=gals_with_z['RA'].values*u.degree,dec = gals_with_z['DEC'].values*u.degree)
     return gals_with_z,z_gals
 
@@ -1063,73 +988,48 @@ def match_gals(catcoord,galscoord,cat,gals,dist_thresh = 2):
     formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     ch.setFormatter(formatter)
     logger.addHandler(ch)
-    gals['z']= ''
-    gals['z_err']= ''
-    gals['flag']= ''
-    gals['source'] = ''
-    gals['Object_types'] = ''
-    gals['Transient_type'] = ''
-    gals['Z_RANK'] = np.NaN
-    stack_gals_with_z = pd.DataFrame(columns=gals.columns)
     cols = ['z','z_err','flag','source','Object_types','Transient_type']
-    for n in range(1,10):
-        inds,d2d,d3d = galscoord.match_to_catalog_sky(catcoord,nthneighbor=n)
-        init_matches = cat.iloc[inds]
-        close_match_inds = d2d< dist_thresh*u.arcsec
-        stack_gal_zs = init_matches[close_match_inds]
-        stack_gals_with_z_sub =gals.iloc[close_match_inds]
-        stack_gals_with_z_sub[cols]= stack_gal_zs[cols].set_index(stack_gals_with_z_sub.index)
-        stack_gals_with_z = stack_gals_with_z.append(stack_gals_with_z_sub)
-
-
+    for c in cols:
+        gals[c] = pd.Series('',index=gals.index,dtype=object)
+    gals['Z_RANK'] = np.nan
+    # every galaxy-redshift pair within dist_thresh, keeping the 9 nearest redshifts of each galaxy
+    gal_inds,cat_inds,d2d,d3d = catcoord.search_around_sky(galscoord,dist_thresh*u.arcsec)
+    close = d2d<dist_thresh*u.arcsec
+    gal_inds,cat_inds,dists = gal_inds[close],cat_inds[close],d2d[close].arcsec
+    by_dist = np.lexsort((dists,gal_inds))
+    gal_inds,cat_inds,dists = gal_inds[by_dist],cat_inds[by_dist],dists[by_dist]
+    nth = pd.Series(gal_inds).groupby(gal_inds).cumcount().values
+    gal_inds,cat_inds,dists = gal_inds[nth<9],cat_inds[nth<9],dists[nth<9]
+
+    stack_gals_with_z = gals.iloc[gal_inds].copy()
+    for c in cols:
+        stack_gals_with_z[c] = cat[c].values[cat_inds]
     logger.info('Matched %s galaxies with redshifts'%len(stack_gals_with_z))
-    logger.debug('Going through them one-by-one to get the priority right')
 
-    stack_gals_with_z['source'] = pd.Categorical(stack_gals_with_z['source'],ordered_surveys)
-    stack_gals_with_z['Z_RANK']= 1
+    # order the redshifts of each galaxy: by survey (DES_AAOmega first, PRIMUS last, unknown surveys after that),
+    # then flag, then distance
+    stack_gals_with_z['_gal'] = gal_inds
+    stack_gals_with_z['_survey'] = pd.Categorical(stack_gals_with_z['source'],ordered_surveys).codes
+    stack_gals_with_z['_dist'] = dists
+    stack_gals_with_z = stack_gals_with_z.sort_values(['_gal','_survey','flag','_dist'],ascending=[True,False,False,True])
+    # the secure DES_AAOmega redshifts, other redshifts above 0 and PRIMUS take the next rank in turn;
+    # the rest go to the bottom
+    source = stack_gals_with_z['source']
+    is_primus = source=='PRIMUS'
+    des_secure = (source=='DES_AAOmega')&stack_gals_with_z['flag'].isin(['3','4'])
+    has_z = (pd.to_numeric(stack_gals_with_z['z'],errors='coerce')>0)&~is_primus
+    to_bottom = ~(des_secure|has_z|is_primus)
+    groups = stack_gals_with_z.groupby('_gal',sort=False)
+    stack_gals_with_z['Z_RANK'] = np.where(to_bottom,groups['_gal'].transform('size'),
+        (~to_bottom).groupby(stack_gals_with_z['_gal'].values).cumsum())
     cols.append('Z_RANK')
-    total = len(stack_gals_with_z.index.unique())
-
-    gals.loc[stack_gals_with_z.index,cols] = stack_gals_with_z[cols]
-
-    multi_ind = stack_gals_with_z.index[stack_gals_with_z.index.duplicated(keep=False)].unique()
-    total =len(multi_ind.unique())
-    for counter,i in enumerate(multi_ind.unique()):
-        this_match = stack_gals_with_z.loc[i]
-        logger.debug('Processing match %s of %s'%(counter,total))
-        this_match.sort_values(['source','flag'],ascending=[False,False],inplace=True)
-        z_rank_cum=0
-        for j in range(len(this_match)):
-            logger.debug('Match row %s'%j)
-            match_row = this_match.iloc[j]
-            if match_row['source']=='DES_AAOmega' and match_row['flag'] in ['3','4']:
-
-                this_match['Z_RANK'].iloc[j] = 1+z_rank_cum
-                z_rank_cum+=1
-                logger.debug('Adding %s'%this_match[cols].iloc[j])
-
-            elif match_row['z']>0 and match_row['source'] != 'PRIMUS':
-                this_match['Z_RANK'].iloc[j] = 1+z_rank_cum
-                logger.debug('Adding %s'%this_match[cols].iloc[j])
-                z_rank_cum+=1
-
-            elif match_row['source'] != 'PRIMUS':
-                this_match['Z_RANK'].iloc[j] = len(this_match)
-                logger.debug('Adding %s'%this_match[cols].iloc[j])
-
-
-            elif match_row['source']=='PRIMUS':
-                logger.debug('Going with PRIMUS...')
-                this_match['Z_RANK'].iloc[j] = 1+z_rank_cum
-                logger.debug('Adding %s'%this_match.iloc[j])
-                z_rank_cum+=1
-        duplicator = copy.deepcopy(gals.loc[i])
-        for n in range(len(this_match.index)-1):
-            gals = gals.append(duplicator)
-
-        logger.debug('Final match to add to gals: %s'%this_match[cols])
-        gals.loc[i,cols] = this_match[cols]
-    #gals.loc[stack_gals_with_z.index]=stack_gals_with_z
+    order = groups.cumcount().values
+
+    # the best redshift goes in the galaxy's own row, the others in copies of it added at the end
+    best = stack_gals_with_z[order==0]
+    gals.loc[best.index,cols] = best[cols].values
+    logger.debug('Adding %s extra rows for galaxies with more than one redshift'%np.sum(order>0))
+    gals = pd.concat([gals,stack_gals_with_z[order>0][gals.columns]])
 
     return gals
 
@@ -0,0 +1,149 @@
+#!/home/wiseman/anaconda3/bin/python
+# -*- coding: utf-8 -*-
+'''Times the selection of good frames from snobsinfo against the old
+exposure-by-exposure loop, on a synthetic five-year table, and checks that both
+give the same frames.'''
+
+import numpy as np
+import pandas as pd
+import logging
+import argparse
+import time
+
+from time import gmtime, strftime
+
+from des_stacks.utils.stack_tools import select_good_frames_zp, select_good_frames_teff
+
+def parser():
+    parser = argparse.ArgumentParser(description='Benchmark the good frame selection')
+    parser.add_argument('-n','--nexp', help = 'Number of exposures in the synthetic table (60 chips each)',type=int,default=8400)
+    parser.add_argument('-zc','--zcut', help ='ZP residual cut',type=float,default=-0.15)
+    parser.add_argument('-pc','--pcut', help ='PSF_NEA cut',type=float,default=2.5)
+    parser.add_argument('-tr','--teffrange', help ='Range of teff cuts for the grid (min,max,step)',default='0.0,0.5,0.01')
+    parser.add_argument('-pr','--psfrange', help ='Range of psf cuts for the grid (min,max,step)',default='1.5,3.0,0.25')
+    parser.add_argument('-s','--seed', help ='Random seed',type=int,default=1)
+    parser.add_argument('--skiploop', help ='Do not time the old loop',action='store_true')
+    return parser.parse_args()
+
+def make_fake_info(nexp,seed=1):
+    '''Makes a snobsinfo-like table for one field and band: nexp exposures of 60 chips over 5 years'''
+    rng = np.random.RandomState(seed)
+    chips = np.array([c for c in range(1,63) if c not in [2,61]])
+    expnums = np.sort(rng.choice(np.arange(150000,750000),nexp,replace=False))
+    years = np.sort(rng.randint(1,6,nexp))
+    nrow = nexp*len(chips)
+    info = pd.DataFrame({
+        'EXPNUM':np.repeat(expnums,len(chips)),
+        'CCDNUM':np.tile(chips,nexp),
+        'YEAR':np.repeat(years,len(chips)),
+        'FIELD':'SN-X2',
+        'BAND':'r',
+        'CHIP_ZERO_POINT':np.repeat(rng.normal(31.5,0.2,nexp),len(chips))+rng.normal(0,0.05,nrow),
+        'PSF_NEA':np.repeat(rng.lognormal(0.5,0.3,nexp),len(chips))*rng.normal(1,0.1,nrow),
+        'T_EFF':np.repeat(rng.uniform(-0.1,1.2,nexp),len(chips)),
+        'FWHM_ASEC':np.repeat(rng.uniform(0.7,2.5,nexp),len(chips)),
+        })
+    # snobsinfo comes out of the DB in no particular order
+    return info.sample(frac=1,random_state=seed).reset_index(drop=True)
+
+def loop_zp(info,zp_cut,psf_cut,nbad=15):
+    '''The original loops of make_good_frame_list, as the reference'''
+    info = info.copy()
+    info['ZP_EXPRES']=np.nan
+    for exp in info.EXPNUM.unique():
+        this_exp = info[info['EXPNUM']==exp]
+        med_zp = this_exp['CHIP_ZERO_POINT'].median()
+        info.loc[this_exp.index,'ZP_EXPRES'] = this_exp['CHIP_ZERO_POINT']-med_zp
+    info['ZP_ADJ1'] = np.nan
+    info['ZP_SIG_ADJ1'] = np.nan
+    for chip in info.CCDNUM.unique():
+        this_chip = info[info['CCDNUM']==chip]
+        info.loc[this_chip.index,'ZP_ADJ1']=this_chip['CHIP_ZERO_POINT']-this_chip['ZP_EXPRES'].median()
+        info.loc[this_chip.index,'ZP_SIG_ADJ1']=this_chip['ZP_EXPRES'].std()
+    info['ZP_RES']=np.nan
+    for year in [1,2,3,4,5]:
+        this_year = info[info['YEAR']==year]
+        info.loc[this_year.index,'ZP_RES']=this_year['ZP_ADJ1']-this_year['ZP_ADJ1'].median()
+    good_exps = []
+    good_frame = pd.DataFrame()
+    for exp in info.EXPNUM.unique():
+        this_exp = info[info['EXPNUM']==exp]
+        bads = np.sum(this_exp['ZP_RES'].values<zp_cut)+len(this_exp[this_exp['PSF_NEA']>psf_cut])
+        if bads <nbad:
+            good_exps.append(exp)
+            good_frame = pd.concat([good_frame,this_exp])
+    return good_frame,good_exps
+
+def loop_teff(info,teff_cut,psf_cut,nbad=15):
+    '''The original T_eff loop of make_good_frame_list, as the reference'''
+    good_frame = pd.DataFrame()
+    good_exps = []
+    for exp in info.EXPNUM.unique():
+        this_exp = info[info['EXPNUM']==exp].copy()
+        t_eff = this_exp['T_EFF'].values[0]
+        if t_eff < -1:
+            t_eff = 2
+        elif not t_eff:
+            t_eff = 2
+        if not psf_cut:
+            psf_cut=5
+        if t_eff > teff_cut and len(this_exp[this_exp['PSF_NEA']>psf_cut])<nbad :
+            this_exp['T_EFF']= t_eff
+            good_frame = pd.concat([good_frame,this_exp])
+            good_exps.append(exp)
+    return good_frame,good_exps
+
+def same_frames(a,b):
+    '''Checks two good frame lists would be written out identically'''
+    cols = ['ZP_RES','ZP_EXPRES','ZP_ADJ1','ZP_SIG_ADJ1']
+    a = a.drop([c for c in cols if c in a.columns],axis=1)
+    b = b.drop([c for c in cols if c in b.columns],axis=1)
+    return a.to_csv()==b.to_csv()
+
+def bench(logger,args):
+    info = make_fake_info(args.nexp,args.seed)
+    logger.info('Made a synthetic snobsinfo with %s rows'%len(info))
+    start = float(time.time())
+    good_frame,good_exps = select_good_frames_zp(info,args.zcut,args.pcut)
+    t_new = float(time.time())-start
+    logger.info('ZP selection: %s of %s exposures are good, took %.3f seconds'%(len(good_exps),info.EXPNUM.nunique(),t_new))
+    if args.skiploop:
+        return
+    start = float(time.time())
+    old_frame,old_exps = loop_zp(info,args.zcut,args.pcut)
+    t_old = float(time.time())-start
+    logger.info('ZP selection with the old loop took %.3f seconds (%.0fx slower)'%(t_old,t_old/t_new))
+    if old_exps!=good_exps or not same_frames(good_frame,old_frame):
+        logger.error('The ZP selections differ!')
+    else:
+        logger.info('The ZP selections are identical')
+    t0,t1,ts = [float(t) for t in args.teffrange.split(',')]
+    p0,p1,ps = [float(p) for p in args.psfrange.split(',')]
+    cut_pairs = [(t,p) for p in np.arange(p0,p1,ps) for t in np.arange(t0,t1,ts)]
+    start = float(time.time())
+    frames = select_good_frames_teff(info,cut_pairs)
+    t_new = float(time.time())-start
+    logger.info('T_eff selection for a grid of %s cuts took %.3f seconds'%(len(cut_pairs),t_new))
+    start = float(time.time())
+    teff_cut,psf_cut = cut_pairs[len(cut_pairs)//2]
+    old_frame,old_exps = loop_teff(info,teff_cut,psf_cut)
+    t_old = float(time.time())-start
+    logger.info('T_eff selection with the old loop took %.3f seconds for a single pair of cuts (%.0fx slower per pair)'%(t_old,t_old*len(cut_pairs)/t_new))
+    good_frame,good_exps = frames[len(cut_pairs)//2]
+    if old_exps!=good_exps or not same_frames(good_frame,old_frame):
+        logger.error('The T_eff selections differ!')
+    else:
+        logger.info('The T_eff selections are identical')
+
+if __name__=="__main__":
+    logger = logging.getLogger('bench_good_frames.py')
+    logger.setLevel(logging.DEBUG)
+    formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.info("***********************************")
+    logger.info("Initialising *** bench_good_frames.py *** at %s UT" % strftime("%Y-%m-%d %H:%M:%S", gmtime()))
+    logger.info("***********************************")
+    bench(logger,parser())
@@ -3,13 +3,11 @@
 #Note: import this first else it crashes importing sub-modules
 import argparse
 import os
-import multiprocessing
-from multiprocessing import Process
-import pathos.pools as pp
 
 from des_stacks import des_stack as stack
 from des_stacks.analysis.astro import cap_phot_all
 from des_stacks.utils.gen_tools import get_good_des_chips
+from des_stacks.utils.pipeline_pool import pool_map
 
 
 def parser():
@@ -48,13 +46,6 @@ def phot_worker(arg_pair):
 def multi_phot(my,f,chips,parsed_args):
 
     args = [my,f,parsed_args]
-    pool_size = multiprocessing.cpu_count()*2
-    act = multiprocessing.active_children()
-    pool = pp.ProcessPool(processes=pool_size,
-                                maxtasksperchild=2,
-                                )
-    pool._clear()
-    pool._serve()
 
     chips = list(chips)
 
@@ -65,10 +56,7 @@ def multi_phot(my,f,chips,parsed_args):
         #p.start()
         #p.join()
 
-    results = pool.map(phot_worker,all_args)
-
-    pool.close()
-    pool.join()
+    results = pool_map(phot_worker,all_args)
     return results
 
 def main(parsed_args):
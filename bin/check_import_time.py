@@ -0,0 +1,74 @@
+#!/home/wiseman/anaconda3/bin/python
+# -*- coding: utf-8 -*-
+'''Checks that importing the pipeline stays cheap: that des_stacks.des_stack imports
+within a time budget without pulling in plotting or database modules, and how much
+each worker saves compared with importing them as well.'''
+
+import sys
+import logging
+import argparse
+import subprocess
+
+from time import gmtime, strftime
+
+# modules the pipeline should only import in the functions that need them
+deferred = ['matplotlib','seaborn','easyaccess','astroimtools','scipy.interpolate']
+
+def parser():
+    parser = argparse.ArgumentParser(description='Check the import time of the pipeline')
+    parser.add_argument('-m','--module', help = 'Module to import',default='des_stacks.des_stack')
+    parser.add_argument('-b','--budget', help = 'Most seconds the import may take',type=float,default=3.0)
+    parser.add_argument('-n','--nrep', help = 'Number of cold starts to time',type=int,default=5)
+    return parser.parse_args()
+
+def cold_import(module,extra=[]):
+    '''Imports a module (and any extra ones) in a fresh interpreter.
+    Returns the time taken and which of the deferred modules ended up loaded'''
+    code = ';'.join(['import sys,time','t=time.time()','import %s'%module]+
+        ['import %s'%m for m in extra]+
+        ['t=time.time()-t','print(t)','print(",".join(m for m in %s if m in sys.modules))'%deferred])
+    out = subprocess.run([sys.executable,'-c',code],stdout=subprocess.PIPE,stderr=subprocess.PIPE,check=True).stdout.decode().split('\n')
+    return float(out[0]),[m for m in out[1].split(',') if m]
+
+def check(logger,args):
+    times,loaded = [],[]
+    for i in range(args.nrep):
+        t,loaded = cold_import(args.module)
+        times.append(t)
+    t_lazy = min(times)
+    logger.info('Importing %s took %.3f seconds'%(args.module,t_lazy))
+    ok = True
+    if len(loaded)>0:
+        logger.error('Importing %s also loaded %s'%(args.module,loaded))
+        ok = False
+    else:
+        logger.info('None of %s were loaded'%deferred)
+    if t_lazy>args.budget:
+        logger.error('That is over the budget of %.3f seconds'%args.budget)
+        ok = False
+    # what every worker used to pay on top, for the modules that are installed here
+    extra = []
+    for m in deferred:
+        try:
+            cold_import(m)
+            extra.append(m)
+        except subprocess.CalledProcessError:
+            logger.info('%s is not installed, so it is left out of the comparison'%m)
+    if 'matplotlib' in extra:
+        extra.append('matplotlib.pyplot')
+    t_eager = min(cold_import(args.module,extra)[0] for i in range(args.nrep))
+    logger.info('Importing %s as well takes %.3f seconds: %.3f seconds saved per worker'%(extra,t_eager,t_eager-t_lazy))
+    return ok
+
+if __name__=="__main__":
+    logger = logging.getLogger('check_import_time.py')
+    logger.setLevel(logging.DEBUG)
+    formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.info("***********************************")
+    logger.info("Initialising *** check_import_time.py *** at %s UT" % strftime("%Y-%m-%d %H:%M:%S", gmtime()))
+    logger.info("***********************************")
+    sys.exit(0 if check(logger,parser()) else 1)
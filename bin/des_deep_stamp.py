@@ -15,12 +15,13 @@ import os
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import _pickle as cpickle
 import math
 import glob
 import seaborn as sns
 import itertools
 
+from des_stacks.utils.chip_index import get_chip_index
+
 
 sns.set_color_codes(palette='colorblind')
 
@@ -59,25 +60,20 @@ def parser():
     return parser.parse_args()
 
 def find_chip(ra,dec):
-    f=open('/media/data3/wiseman/des/coadding/config/chiplims.pkl','rb')
-    chiplims = cpickle.load(f)
-
-    #################
-    for field in ['X1','X2','X3','C1','C2','C3','E1','E2','S1','S2']:
-        the_field = chiplims[field]
-        for ccd in the_field.keys():
-            if the_field[ccd][0][0] > ra > the_field[ccd][2][0]:
-                if the_field[ccd][0][1] < dec < the_field[ccd][1][1]:
-                    return ('SN-%s'%field,ccd)
+    f,ccd,x,y = get_chip_index().locate(ra,dec)
+    if f[0] is not None:
+        return (f[0],ccd.tolist()[0])
 
 def main(args,logger):
     if args.ra:
         l = [[args.ra,args.dec]]
     else:
-        l = np.loadtxt(args.coordlist)
-    for coords in l:
+        l = np.loadtxt(args.coordlist,ndmin=2)
+    l = np.asarray(l,dtype=float)
+    # find the chips of all the positions at once
+    fs,ccds,xs,ys = get_chip_index().locate(l[:,0],l[:,1])
+    for coords,f,ccd in zip(l,fs,ccds):
         ra,dec = coords[0],coords[1]
-        f,ccd = find_chip(ra,dec)
         import aplpy
         fig,ax = plt.subplots(figsize=(15,15)) #figsize=(16,9)
         w = float(args.size)/3600
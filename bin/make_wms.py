@@ -3,13 +3,11 @@ import numpy as np
 import os
 import argparse
 import glob
-import subprocess
-import pathos.pools as pp
-import multiprocessing
 import astropy.io.fits as fits
-from multiprocessing import Process
 
 from des_stacks.utils.gen_tools import get_good_des_chips, get_des_bands
+from des_stacks.utils.tool_runner import run_tool
+from des_stacks.utils.pipeline_pool import pool_map
 
 good_des_chips = get_good_des_chips()
 bands = get_des_bands()
@@ -17,18 +15,19 @@ bands = get_des_bands()
 def worker(img):
     if os.path.isfile(img.replace('.fits','.weight.fits')):
         os.remove(img.replace('.fits','.weight.fits'))
+    img_dir = os.path.split(img)[0]
     swarp_cmd = [
     'swarp',
     '%s'%img,
     '-WEIGHTOUT_NAME','%s'%img.replace('.fits','.wgt.fits'),
     '-COMBINE','N',
     '-RESAMPLE','Y',
+    '-RESAMPLE_DIR',img_dir,
     '-DELETE_TMPFILES','N',
     '-BACK_SIZE','32'
     ]
     print ('Doing following: \n %s '%swarp_cmd)
-    p = subprocess.Popen(swarp_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    outs,errs = p.communicate()
+    run_tool(swarp_cmd,cwd=img_dir)
     if os.path.isfile(img.replace('.fits','.resamp.fits')):
         os.remove(img.replace('.fits','.resamp.fits'))
     return
@@ -44,14 +43,7 @@ def worker2(img):
     fl.close()
     return
 def multi_fn(lst):
-    pool_size = multiprocessing.cpu_count()*2
-    pool = pp.ProcessPool(processes=pool_size,
-                                maxtasksperchild=2,
-                                )
-    pool._clear()
-    pool._serve()
-
-    results = pool.map(worker2,lst)
+    results = pool_map(worker2,lst)
 
 def main():
     fields = ['X1','X2','X3','C1','C2','C3','E1','E2','S1','S2']
@@ -60,7 +52,6 @@ def main():
         for f in fields:
             f = 'SN-'+f
             for b in bands:
-                os.chdir(os.path.join('/media/data3/wiseman/des/coadding/5yr_stacks/','MY%s'%my,f,b))
                 list_of_scis = glob.glob(os.path.join('/media/data3/wiseman/des/coadding/5yr_stacks/','MY%s'%my,f,b,'*clipweighted_sci.fits'))
                 multi_fn(list_of_scis)
 
@@ -2,10 +2,6 @@ import numpy as np
 import pandas as pd
 import subprocess
 import glob
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-
-import seaborn as sns
 from astropy.coordinates import SkyCoord
 import logging
 from astropy.table import Table
@@ -23,9 +19,7 @@ from des_stacks.utils.gen_tools import mc_robust_median as r_median
 import time
 import _pickle as cpickle
 import itertools
-import multiprocessing
-from multiprocessing import Process
-import pathos.pools as pp
+from des_stacks.utils.pipeline_pool import pool_map
 bands = gen_tools.get_des_bands()
 
 
@@ -66,13 +60,6 @@ def multi_init_phot(my,f,b,chips):
     #cuts = {'psf':1.3,'teff':0.02}
     cuts =stack_tools.get_cuts(f,b) 
     args = [my,f,b,cuts]
-    pool_size = multiprocessing.cpu_count()*2
-    act = multiprocessing.active_children()
-    pool = pp.ProcessPool(processes=pool_size,
-                                maxtasksperchild=2,
-                                )
-    pool._clear()
-    pool._serve()
 
     chips = list(chips)
 
@@ -83,10 +70,7 @@ def multi_init_phot(my,f,b,chips):
         #p.start()
         #p.join()
 
-    results = pool.map(init_phot_worker,all_args)
-
-    pool.close()
-    pool.join()
+    results = pool_map(init_phot_worker,all_args)
     return results
 
 def main():
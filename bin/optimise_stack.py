@@ -13,10 +13,6 @@ __date__ = "26/11/19"
 
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import datetime
 import configparser
 import os
@@ -31,7 +27,7 @@ from astropy.time import Time
 
 from des_stacks import des_stack as stack
 from des_stacks.utils.loop_stack import iterate_source_loop, init_source_loop
-sns.set_color_codes(palette='colorblind')
+from des_stacks.utils.stack_tools import make_good_frame_lists
 # define some DES specific lists
 all_years = ['none','1','2','3','4'] # add 5 when available
 all_fields = ['SN-X1','SN-X2','SN-X3','SN-C1','SN-C2','SN-C3','SN-E1','SN-E2','SN-S1','SN-S2']
@@ -56,6 +52,7 @@ class optimiser():
         parser.add_argument('-st','--step',help = 'Size of step in the cut you want to optimize over (psf,teff): [0.25,0.01]',required = False, default = '0.25,0.01')
         parser.add_argument('-pl','--plot',help='Plot a heatmap of where the best cuts are?',required = False,action = 'store_true')
         parser.add_argument('-t','--tidy',help = 'Tidy up temporary files after?',action = 'store_true')
+        parser.add_argument('-i','--incremental',help = 'Update running coadds between grid points instead of restacking',action = 'store_true')
         args=parser.parse_args()
         parsed = {}
         try:
@@ -134,6 +131,7 @@ class optimiser():
             parsed['step'] = [0.25,0.01]
 
         parsed['tidy']=args.tidy
+        parsed['incremental']=args.incremental
         self.parsed = parsed
         self.plot = args.plot
 
@@ -151,7 +149,9 @@ class optimiser():
         psf_df = pd.DataFrame(index = [str(r) for r in psf_range],columns=[str(r) for r in teff_range])#create the DataFrame to put the quality measurements in
         lim_df.name = 'depth'
         psf_df.name = 'psf'
-
+        # make the good frame lists for the whole grid in one go
+        s = stack.Stack(f,b,y,ch,wd,db=True)
+        make_good_frame_lists(s,[(teff_cut,psf_cut) for psf_cut in psf_range for teff_cut in teff_range])
         for psf_cut in psf_range:
             for teff_cut in teff_range:
                 lim,psf = self.do_stack(f,b,y,ch,wd,cuts = {'zp':None,'teff':teff_cut,'psf':psf_cut})
@@ -185,7 +185,11 @@ class optimiser():
             best[df.name] = [np.float(np.argmax(df.max(axis=1))),np.float(np.argmax(df.max(axis=0)))]
             # ADD TO PLOT!
         if self.plot:
-
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+            import seaborn as sns
+            sns.set_color_codes(palette='colorblind')
             f1,ax1 = plt.subplots()
             depthmin = np.min(lim_df.min().values)
             depthmax = np.max(lim_df.max().values)
@@ -213,7 +217,7 @@ class optimiser():
         scifile = os.path.join(s.band_dir,'ccd_%s_%s_%.2f_%s_clipweighted_sci.fits'%(ch[0],b,cuts['teff'],cuts['psf']))
         if not os.path.isfile(scifile):
             print ('Did not find a file for these cuts; doing stack')
-            s.do_my_stack(cuts=cuts,final=True)
+            s.do_my_stack(cuts=cuts,final=True,incremental=self.parsed['incremental'])
         else:
             print ('Found a stacked file for these cuts; going to source')
         s.ana_dir = os.path.join(s.band_dir,ch[0],'ana')
@@ -7,12 +7,9 @@ import logging
 import argparse
 import pandas as pd
 from time import gmtime, strftime
-import multiprocessing
-from multiprocessing import Process
-import pathos.pools as pp
 #Note: import this first else it crashes importing sub-modules
 from des_stacks import des_stack as stack
-from des_stacks.analysis.astro import cap_phot_sn,cap_sn_lookup
+from des_stacks.analysis.astro import cap_phot_sn,cap_sn_lookup,cap_sn_lookup_batch
 import os
 
 def parser():
@@ -28,13 +25,6 @@ def parser():
     return parser.parse_args()
 
 
-def cap_worker(arg_pair):
-    args,sn = arg_pair[0],arg_pair[1]
-    wd,dist_thresh,savename = [args[i]for i in range(len(args))]
-
-    cap_sn_lookup(sn, wd = wd,savename = savename, dist_thresh = dist_thresh,autocuts=True)
-
-
 def cap(args,logger):
     avoid_list = []
     args.version = int(args.version)
@@ -54,13 +44,6 @@ def cap(args,logger):
         sn_list = np.genfromtxt(args.namelist,dtype=str,delimiter='\n')
         logger.info("Doing CAP on following input list")
         logger.info(sn_list)
-        pool_size = multiprocessing.cpu_count()*2
-        act = multiprocessing.active_children()
-        pool = pp.ProcessPool(processes=pool_size,
-                                maxtasksperchild=2,
-                                )
-        pool._clear()
-        pool._serve()
 
         if not args.savename:
 
@@ -78,8 +61,7 @@ def cap(args,logger):
             except:
                 done_sn = pd.DataFrame(columns=['BAND', 'CLASS_STAR', 'ELONGATION', 'FWHM_WORLD', 'KRON_RADIUS', 'MAGERR_APER', 'MAGERR_AUTO', 'MAG_APER', 'MAG_AUTO', 'SN_NAME', 'X_WORLD', 'Y_WORLD','LIMMAG'])
 
-        all_args = []
-        worker_args = [args.workdir,args.threshold,args.savename]
+        todo = []
         for sn_name in sn_list :
             logger.info("Doing common aperture photometry on %s"%sn_name)
             logger.info(sn_name)
@@ -88,22 +70,21 @@ def cap(args,logger):
 
 
                 if sn_name not in avoid_list:
-                    all_args.append([worker_args,sn_name])
+                    todo.append(sn_name)
 
             elif args.overwrite == True:
                 if sn_name not in avoid_list:
-                    if not args.savename:
-
-                        all_args.append([worker_args,sn_name])
-                    else:
-                        all_args.append([worker_args,sn_name])
+                    todo.append(sn_name)
 
             else:
                 logger.info("Result for %s already in result file, and you told me not to overwrite it. Going to next one!"%sn_name)
-        results = pool.map(cap_worker,all_args)
-
-        pool.close()
-        pool.join()
+        # all the SNe in one pass: one table if given a savename, otherwise a result file for each SN
+        if args.savename:
+            save_fn = '/media/data3/wiseman/des/coadding/results/tests/%s'%args.savename
+        else:
+            save_fn = None
+        results = cap_sn_lookup_batch(todo,dist_thresh=float(args.threshold),save_fn=save_fn,
+                                      per_sn=not args.savename,logger=logger)
         return results
 if __name__ == "__main__":
     logger = logging.getLogger('sn_cap.py')
@@ -14,12 +14,13 @@ __date__        = "25/09/2018"
 
 import numpy as np
 import pandas as pd
-import _pickle as cpickle
 import os
 import argparse
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 from astropy.table import Table
+from des_stacks.utils.dlr import dlr_pairs
+from des_stacks.utils.chip_index import get_chip_index
 
 
 def parser():
@@ -32,35 +33,6 @@ def parser():
     parser.add_argument('-th','--threshold',help='Distance threshold for host galaxy searching (arcsecs)',default=15)
     return parser.parse_args()
 
-def get_DLR_ABT(RA_SN, DEC_SN, RA, DEC, A_IMAGE, B_IMAGE, THETA_IMAGE, angsep):
-    # inputs are arrays
-    rad  = np.pi/180                   # convert deg to rad
-    pix_arcsec = 0.264                 # pixel scale (arcsec per pixel)
-    pix2_arcsec2 = 0.264**2            # pix^2 to arcsec^2 conversion factor
-    pix2_deg2 = pix2_arcsec2/(3600**2) # pix^2 to deg^2 conversion factor
-    global numFailed
-    rPHI = np.empty_like(angsep)
-    d_DLR = np.empty_like(angsep)
-
-    # convert from IMAGE units (pixels) to WORLD (arcsec^2)
-    A_ARCSEC = A_IMAGE*pix_arcsec
-    B_ARCSEC = B_IMAGE*pix_arcsec
-
-    # angle between RA-axis and SN-host vector
-    GAMMA = np.arctan((DEC_SN - DEC)/(np.cos(DEC_SN*rad)*(RA_SN - RA)))
-
-    # angle between semi-major axis of host and SN-host vector
-    PHI = np.radians(THETA_IMAGE) + GAMMA # angle between semi-major axis of host and SN-host vector
-
-    rPHI = A_ARCSEC*B_ARCSEC/np.sqrt((A_ARCSEC*np.sin(PHI))**2 +
-                                     (B_ARCSEC*np.cos(PHI))**2)
-
-    # directional light radius
-    #  where 2nd moments are bad, set d_DLR = 99.99
-    d_DLR = angsep/rPHI
-
-    return [d_DLR, A_ARCSEC, B_ARCSEC, rPHI]
-
 class sn():
     def __init__(self,sn_name,args):
         self.sn_name = sn_name
@@ -68,9 +40,6 @@ class sn():
 
     def get_sn_dat(self):
 
-        f=open('/media/data3/wiseman/des/coadding/config/chiplims.pkl','rb')
-        chiplims = cpickle.load(f)
-
         sncand = pd.read_csv('/media/data3/wiseman/des/coadding/catalogs/sncand_db.csv',index_col=0)
 
         dat = sncand[sncand['transient_name']==self.sn_name]
@@ -85,12 +54,10 @@ class sn():
         #################
         obj_field = self.sn_name[5:7]
         self.field=obj_field
-        the_field = chiplims[obj_field]
-        for ccd in the_field.keys():
-            if the_field[ccd][0][0] > ra > the_field[ccd][2][0]:
-                if the_field[ccd][0][1] < dec < the_field[ccd][1][1]:
-                    self.chip = ccd
-                    return (ra,dec,'SN-%s'%obj_field,y,ccd)
+        f,ccd,x,y_pix = get_chip_index().locate(ra,dec,fields=obj_field)
+        if f[0] is not None:
+            self.chip = ccd.tolist()[0]
+            return (ra,dec,f[0],y,self.chip)
 
     def check_res(self):
         sn_cap_dir = '/media/data3/wiseman/des/coadding/5yr_stacks/CAP/%s'%self.sn_name
@@ -117,10 +84,11 @@ class sn():
         close_inds = d2d <float(self.args.threshold)*u.arcsec
         dists = d2d[close_inds]
         match = chip_cap_res.iloc[close_inds]
-        angsep = np.array([float(d2d[close_inds][j].to_string(unit=u.arcsec,decimal=True)) for j in range(len(d2d[close_inds]))])
+        angsep,dlr,rank = dlr_pairs(self.ra,self.dec, match.X_WORLD, match.Y_WORLD, match['A_IMAGE'], match['B_IMAGE'],  match['THETA_IMAGE'],
+            angsep=d2d[close_inds].arcsec)
         match['ANGSEP'] = angsep
-        dlr = get_DLR_ABT(self.ra,self.dec, match.X_WORLD, match.Y_WORLD, match['A_IMAGE'], match['B_IMAGE'],  match['THETA_IMAGE'], angsep)[0]
-        match['DLR'] = np.array(dlr)
+        match['DLR'] = dlr
+        match['DLR_RANK'] = rank
         print ('Went into the Common Aperture Photometry and found galaxies with \n the following angular separations and DLRs')
         print (match[['ANGSEP','DLR']])
         return match
@@ -15,12 +15,13 @@ import os
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import _pickle as cpickle
 import math
 import glob
 import seaborn as sns
 import itertools
 
+from des_stacks.utils.chip_index import get_chip_index
+
 
 sns.set_color_codes(palette='colorblind')
 
@@ -65,8 +66,6 @@ def parser():
     return parser.parse_args()
 
 def get_sn_dat(sn):
-    f=open('/media/data3/wiseman/des/coadding/config/chiplims.pkl','rb')
-    chiplims = cpickle.load(f)
     sncand = pd.read_csv('/media/data3/wiseman/des/coadding/catalogs/sncand_db.csv')
 
     dat = sncand[sncand['transient_name']==sn]
@@ -75,12 +74,9 @@ def get_sn_dat(sn):
     y = dat['season'].values[0]
 
     #################
-    obj_field = sn[5:7]
-    the_field = chiplims[obj_field]
-    for ccd in the_field.keys():
-        if the_field[ccd][0][0] > ra > the_field[ccd][2][0]:
-            if the_field[ccd][0][1] < dec < the_field[ccd][1][1]:
-                return (ra,dec,'SN-%s'%obj_field,y,ccd)
+    f,ccd,x,y_pix = get_chip_index().locate(ra,dec,fields=sn[5:7])
+    if f[0] is not None:
+        return (ra,dec,f[0],y,ccd.tolist()[0])
 
 def main(args,logger):
     sn_name = args.sn_name
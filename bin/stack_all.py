@@ -13,8 +13,6 @@ __date__ = "26/11/19"
 
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import datetime
 import configparser
 import os
@@ -2,13 +2,10 @@
 
 import numpy as np
 import pandas as pd
-import seaborn as sns
 from astropy.table import Table
 from astropy.io import fits
 from astropy.time import Time
-import matplotlib.pyplot as plt
 import datetime
-import configparser
 import os
 import subprocess
 import multiprocessing
@@ -18,6 +15,9 @@ import time
 from des_stacks.utils.stack_tools import make_good_frame_list, make_swarp_cmds, get_dessn_obs, get_des_obs_year,resample
 from des_stacks.utils.source_tools import source_for_psfex, psfex, source_for_cat
 import des_stacks.utils.multi_stack as multi_stack
+from des_stacks.utils.obs_index import get_obs_index
+from des_stacks.utils.info_cache import get_info
+from des_stacks.utils.snobs_config import get_config
 from des_stacks.analysis.astro import init_phot, init_calib
 
 class Stack():
@@ -119,36 +119,22 @@ class Stack():
             the .ini file for the DES SN data, including paths for each
             year, plus year lims
         '''
-        if os.path.split(dessn_ini)[0]=='':
-            # if only the filename for dessn_ini is given, assume it's in /coadding/config
-            ini_fn = os.path.join(self.config_dir,dessn_ini)
-        else:
-            # assume I'm being given a totally new path
-            ini_fn = dessn_ini
-        cp=configparser.ConfigParser()
-        # read the .ini file
-        cp.read(ini_fn)
-        # Make a list of years
-        years = ['Y1','Y2','Y3','Y4','Y5']
+        # the same settings are shared by every Stack in the process, and only read once
+        self.config = get_config(self.config_dir,dessn_ini)
         self.year_lims = {}
-        self.data_dirs = {}
-        for y in years:
-            year_mjd_lim =cp.get('year_mjd_lims',y)
-            year_night_lim = cp.get('year_night_lims',y)
-            self.year_lims[y]={'mjd':year_mjd_lim,'night':year_night_lim}
-            self.data_dirs[y]=cp.get('data_dirs',y)
+        for y,mjd_lim,night_lim in zip(self.config.years,self.config.year_mjd_lims,self.config.year_night_lims):
+            self.year_lims[y]={'mjd':tuple(mjd_lim.tolist()),'night':tuple(night_lim.tolist())}
+        self.data_dirs = dict(self.config.data_dirs)
+        self.resamp_quota = self.config.resamp_quota
+        self.source_backend = self.config.source_backend
+        self.result_binary = self.config.result_binary
         self.logger.info('Successfully pulled configuration from %s' %self.config_dir)
     ############################################################################
     def _get_info(self):
         '''Gets the current info file (originally from the DESDB)'''
-        info_tab = Table.read(os.path.join(self.config_dir,'snobsinfo.fits'))
-        info_tab['BAND'] = info_tab['BAND'].astype(str)
-        info_tab['FIELD'] = info_tab['FIELD'].astype(str)
-        info_tab['NITE'] = info_tab['NITE'].astype(str)
-
-        self.info_df = info_tab.to_pandas()
+        self.info_df = get_info(os.path.join(self.config_dir,'snobsinfo.fits'),logger=self.logger)
 
-    def do_my_stack(self, cuts={'teff':0.2, 'zp':None,'psf':None},final=True):
+    def do_my_stack(self, cuts={'teff':0.2, 'zp':None,'psf':None},final=True,incremental=False):
         '''Does a stack defined by the parameters from the Stack object it is passed.
         keyword arguments:
         cuts:
@@ -156,6 +142,8 @@ class Stack():
             psf (float): the seeing cut to be used for the stack (default = None)
             t_eff (float): the teff cut to be used for the stack (default = 0.2)
         final (Bool): whether the stack is final or intermediate (default = True)
+        incremental (Bool): update running coadds with only the exposures that changed since the
+            last stack, instead of restacking with SWarp (default = False)
         returns:
         none
         '''
@@ -194,6 +182,8 @@ class Stack():
             chips = self.info_df.CCDNUM.sort_values().unique()
             for c in chips:
                 self.chips.append(str(int(c)))
+        # bring the index of the data directories up to date before the workers need it
+        get_obs_index(self,self.logger)
         # get swarp commands
         log = open(os.path.join(self.log_dir,'swarp_%s_%s_%s.log' %(field, band, my)),'a')
         log.flush()
@@ -202,7 +192,10 @@ class Stack():
             if y in 'none':
                 y = 'none'
             self.logger.info('Stacking {0} in {1} band, skipping year {2}'.format(field,band,y))
-            multi_stack.multitask(self)
+            if incremental:
+                multi_stack.multitask(self,w='incremental')
+            else:
+                multi_stack.multitask(self)
             self.logger.info('Finished stacking chips {0} for MY {1}'.format(self.chips,y))
             if y == 'none':
                 break
@@ -272,10 +265,11 @@ class Stack():
         limmags = {}
         for counter,chip in enumerate(self.chips):
             chip_dir = os.path.join(self.out_dir,'MY%s'%self.my,self.field,self.band,chip)
-            ana_dir = os.path.join(chip_dir,'ana')
-            os.chdir(ana_dir)
             sourcecat = self.sourcecats[counter]
             self.logger.info('Going to init_phot to do photometry on %s'%sourcecat)
-            cat = Table.read(sourcecat).to_pandas()
+            if isinstance(sourcecat,np.ndarray):
+                cat = pd.DataFrame(sourcecat)
+            else:
+                cat = Table.read(sourcecat).to_pandas()
             limmags[chip]=init_phot(self,chip,cat)
         return limmags
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+'''Tests for utils/coadd_engine.py'''
+
+import numpy as np
+import astropy.io.fits as fits
+
+from des_stacks.utils.coadd_engine import CoaddEngine
+
+def _frames(d,n,shape=(20,30)):
+    '''Writes n frames on the same grid, each with its own masked weightmap'''
+    rng = np.random.default_rng(1)
+    frames = {}
+    for i in range(n):
+        h = fits.Header()
+        h['CTYPE1'],h['CTYPE2'] = 'RA---TAN','DEC--TAN'
+        h['CRVAL1'],h['CRVAL2'] = 36.45,-4.6
+        h['CRPIX1'],h['CRPIX2'] = 10.5+i,5.
+        h['CD1_1'],h['CD2_2'],h['CD1_2'],h['CD2_1'] = -7.3e-5,7.3e-5,0.,0.
+        h['FLXSCALE'],h['EXPTIME'] = 1.+0.1*i,90.
+        root = str(d/('D%08d_g_c01'%i))
+        fits.writeto(root+'.resamp.fits',rng.normal(100,5,shape).astype(np.float32),header=h)
+        fits.writeto(root+'.resamp.coadd.maskweight.fits',rng.uniform(0.5,1,shape).astype(np.float32),header=h)
+        frames['D%08d_g_c01'%i] = (root+'.resamp.fits',root+'.resamp.coadd.maskweight.fits')
+    return frames
+
+def test_one_exposure_cut_change_touches_one_frame(tmp_path):
+    frames = _frames(tmp_path,4)
+    names = sorted(frames)
+    engine = CoaddEngine(str(tmp_path/'engine'),shape=(40,60))
+    assert engine.sync({r:frames[r] for r in names[:3]})==(3,0)
+    # a looser cut lets one more exposure in, a tighter one takes it out again
+    assert engine.sync(frames)==(1,0)
+    assert engine.sync({r:frames[r] for r in names[:3]})==(0,1)
+    assert engine.sync(frames)==(1,0)
+    # the same as coadding the four from scratch
+    fresh = CoaddEngine(str(tmp_path/'fresh'),shape=(40,60))
+    fresh.sync(frames)
+    assert np.allclose(engine.num,fresh.num)
+    assert np.allclose(engine.den,fresh.den)
+
+def test_coadd_header_has_no_per_exposure_keywords(tmp_path):
+    frames = _frames(tmp_path,2)
+    engine = CoaddEngine(str(tmp_path/'engine'),shape=(40,60))
+    engine.sync(frames)
+    sci_fn,wgt_fn = str(tmp_path/'sci.fits'),str(tmp_path/'wgt.fits')
+    engine.write(sci_fn,wgt_fn)
+    h = fits.getheader(sci_fn)
+    assert h['FLXSCALE']==1.0
+    assert h['EXPTIME']==180.
+    assert 'MJD-OBS' not in h
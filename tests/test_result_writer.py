@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+'''Tests for utils/result_writer.py'''
+
+import numpy as np
+import pandas as pd
+import astropy.io.fits as fits
+
+from des_stacks.utils.result_writer import write_result
+
+def test_fits_result_leaves_out_nan_meta(tmp_path):
+    cat = pd.DataFrame({'X_WORLD':[34.1,34.2],'Y_WORLD':[-4.9,-5.0],'MAG_AUTO':[21.5,22.25]})
+    meta = {'zp':31.2,'zp_sig':np.nan,'kr_lim2':np.float64(np.nan),'lim':np.inf,'chip':5}
+    fn = str(tmp_path/'result')
+    write_result(fn,cat,'# zp = 31.2\n',['X_WORLD','Y_WORLD','MAG_AUTO'],meta=meta,binary='fits')
+    with fits.open(fn+'.fits') as f:
+        hdr,data = f[1].header,f[1].data
+    assert hdr['zp']==31.2
+    assert hdr['chip']==5
+    for k in ['zp_sig','kr_lim2','lim']:
+        assert k not in hdr
+    assert np.allclose(data['MAG_AUTO'],[21.5,22.25])
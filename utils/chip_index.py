@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''chip_index.py: Which DES-SN field and CCD a position falls on.
+
+config/chiplims.pkl gives the four corners of every CCD of every field. It is read once
+per process and turned into flat arrays of the box of each chip, so that whole arrays of
+positions are located at once: each position is tested against every chip of the fields it
+may be in, and the first chip (in the order of chiplims) that contains it wins, as in the
+loops this replaces.'''
+
+import os
+import numpy as np
+import _pickle as cpickle
+
+chiplims_fn = '/media/data3/wiseman/des/coadding/config/chiplims.pkl'
+# the order fields are searched in when a position could be in any of them
+field_order = ['X1','X2','X3','C1','C2','C3','E1','E2','S1','S2']
+pix_scale = 0.263                  # arcsec per pixel
+
+_indexes = {}
+
+class ChipIndex():
+    '''The boxes of the chips of every field'''
+
+    def __init__(self,chiplims):
+        '''parameters:
+        chiplims: (dict) the corners [(ra,dec),...] of each ccd of each field, as in chiplims.pkl
+        '''
+        self.chiplims = chiplims
+        fields,ccds,corners = [],[],[]
+        for field,the_field in chiplims.items():
+            for ccd,lims in the_field.items():
+                fields.append(field)
+                ccds.append(ccd)
+                corners.append(np.asarray(lims,dtype=np.float64)[:4])
+        self.fields = np.array(fields,dtype=object)
+        self.ccds = np.array(ccds)
+        self.corners = np.array(corners).reshape(-1,4,2)
+        # a position is on a chip if it is between corners 2 and 0 in RA and 0 and 1 in Dec
+        self.ra_lo,self.ra_hi = self.corners[:,2,0],self.corners[:,0,0]
+        self.dec_lo,self.dec_hi = self.corners[:,0,1],self.corners[:,1,1]
+        self.field_chips = {field:np.nonzero(self.fields==field)[0] for field in chiplims}
+
+    def lims(self,field,ccd):
+        '''The corners of one chip; field can be given as X1 or SN-X1'''
+        return self.chiplims[field[-2:]][ccd]
+
+    def center(self,field,ccd):
+        '''The mean ra, dec of the corners of one chip'''
+        ras,decs = np.asarray(self.lims(field,ccd),dtype=np.float64)[:4].T
+        return (np.mean(ras),np.mean(decs))
+
+    def locate(self,ra,dec,fields=None):
+        '''Finds the field and chip of each position.
+        arguments:
+        ra,dec (arrays or floats): the positions in degrees
+        fields (list): the fields each position may be in, as 'X1' or 'X1,X2' (in the order
+            to try them), or one field for all (default = any field, in field_order)
+        returns:
+        field (array): SN-X1 etc, None where the position is not on a chip
+        ccd (array): the chip, 0 where it is not on one
+        x,y (arrays): position in pixels from the (max RA, min Dec) corner of the chip's box
+        '''
+        ra = np.atleast_1d(np.asarray(ra,dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec,dtype=np.float64))
+        n = len(ra)
+        if fields is None:
+            cands = [field_order]*n
+        elif isinstance(fields,str):
+            cands = [fields.split(',')]*n
+        else:
+            cands = [str(f).split(',') for f in fields]
+        cands = [[c.strip(' ')[-2:] for c in cand] for cand in cands]
+        nmax = max([len(c) for c in cands]) if n else 0
+        cand_arr = np.array([c+['']*(nmax-len(c)) for c in cands],dtype=object).reshape(n,nmax)
+        chip = np.full(n,-1)
+        for k in range(nmax):
+            for field,chips in self.field_chips.items():
+                sel = np.nonzero((chip<0)&(cand_arr[:,k]==field))[0]
+                if not len(sel):
+                    continue
+                r,d = ra[sel,None],dec[sel,None]
+                inside = ((self.ra_hi[chips]>r)&(r>self.ra_lo[chips])&
+                          (self.dec_lo[chips]<d)&(d<self.dec_hi[chips]))
+                found = inside.any(axis=1)
+                chip[sel[found]] = chips[inside[found].argmax(axis=1)]
+        on = chip>=0
+        field = np.full(n,None,dtype=object)
+        field[on] = ['SN-%s'%f for f in self.fields[chip[on]]]
+        ccd = np.zeros(n,dtype=self.ccds.dtype)
+        ccd[on] = self.ccds[chip[on]]
+        x,y = np.full(n,np.nan),np.full(n,np.nan)
+        x[on] = (self.ra_hi[chip[on]]-ra[on])*np.cos(np.radians(dec[on]))*3600/pix_scale
+        y[on] = (dec[on]-self.dec_lo[chip[on]])*3600/pix_scale
+        return field,ccd,x,y
+
+def get_chip_index(fn=chiplims_fn):
+    '''Returns the index of the chips in fn, reading it the first time'''
+    fn = os.path.abspath(fn)
+    if fn not in _indexes:
+        with open(fn,'rb') as f:
+            _indexes[fn] = ChipIndex(cpickle.load(f))
+    return _indexes[fn]
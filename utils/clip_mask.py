@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''clip_mask.py: Turns the outliers SWarp logs while clipping into masked weightmaps.
+
+With -COMBINE_TYPE CLIPPED and -CLIP_LOGNAME, SWarp writes one line per rejected pixel:
+the index of the input image (counting from 0, in the order of the input list), the x and
+y of the pixel in the clipped stack (counting from 1) and its deviation. Since the inputs
+are resampled onto the grid of the stack, a pixel of the stack lands on a pixel of each
+input with an integer offset. The outliers (grown by a few pixels) are set to zero in a
+copy of each input's weightmap, the .resamp.<cutstring>_<part>.maskweight.fits used by
+the weighted stack; stacks with other cuts share the inputs but not their masks.
+This replaces running MaskMap and then combining its masks with the weightmaps.
+The running coadds of coadd_engine instead keep one mask per exposure, made the first
+time it is clipped (.resamp.coadd.maskweight.fits), so that it goes in and out of the
+coadd with the same weights whatever the cuts.
+
+The masked weightmaps are streamed: the weightmap is memory-mapped and copied into a
+temporary file a block of rows at a time, masking each block on the way, which is then
+moved into place.'''
+
+import os
+import logging
+import threading
+import numpy as np
+import astropy.io.fits as fits
+from concurrent.futures import ThreadPoolExecutor
+
+from des_stacks.utils.header_cache import getheader, get_headers
+from des_stacks.utils.resamp_cache import get_resamp_cache
+from des_stacks.utils.stack_tools import write_list
+
+# rows of a weightmap to read, mask and write at a time
+block_rows = 512
+# number of weightmaps to mask at once
+mask_threads = 4
+# tag of the masked weightmaps kept by the running coadds
+coadd_tag = 'coadd'
+
+def stream_weight(wn,out_fn,mask_block,block_rows=block_rows):
+    '''Writes a float32 copy of a weightmap, a block of rows at a time.
+    arguments:
+    wn (str): the weightmap
+    out_fn (str): where to write the masked weightmap
+    mask_block (callable): called as mask_block(block,y0,y1) to mask rows y0:y1 in place
+    '''
+    # write to a name of our own, so that nobody reads it half written
+    temp_fn = '%s.%s.%s'%(out_fn,os.getpid(),threading.get_ident())
+    if os.path.isfile(temp_fn):
+        # a StreamingHDU appends to an existing file
+        os.remove(temp_fn)
+    with fits.open(wn,memmap=True) as w:
+        header = w[0].header.copy()
+        for kw in ['BZERO','BSCALE']:
+            header.remove(kw,ignore_missing=True)
+        header['BITPIX'] = -32
+        wd = w[0].data
+        out = fits.StreamingHDU(temp_fn,header)
+        try:
+            for y0 in range(0,wd.shape[0],block_rows):
+                y1 = min(y0+block_rows,wd.shape[0])
+                block = np.array(wd[y0:y1],dtype=np.float32)
+                mask_block(block,y0,y1)
+                out.write(block)
+        except Exception:
+            out.close()
+            os.remove(temp_fn)
+            raise
+        out.close()
+        del wd
+    os.replace(temp_fn,out_fn)
+    return out_fn
+
+def _weight_names(f,tag):
+    '''Names of the weightmap and masked weightmap of a resampled image, the latter for the part tagged tag'''
+    if f[-3:]=='[0]':
+        f = f[:-3]
+    return f[:-5]+'.weight.fits',f[:-5]+'.%s.maskweight.fits'%tag
+
+def maskweight_name(f,tag):
+    '''Name of the masked weightmap of a resampled image tagged tag'''
+    return _weight_names(f,tag)[1]
+
+def read_clip_log(cliplog_fn):
+    '''Reads a SWarp clip log.
+    returns:
+    idx, x, y (arrays): input image and 0-based pixel in the stack of each outlier
+    '''
+    empty = np.zeros(0,dtype=np.int64)
+    if not os.path.isfile(cliplog_fn) or os.path.getsize(cliplog_fn)==0:
+        return empty,empty,empty
+    tab = np.loadtxt(cliplog_fn,usecols=(0,1,2),ndmin=2)
+    tab = tab.astype(np.int64)
+    return tab[:,0],tab[:,1]-1,tab[:,2]-1
+
+def _offset(stackhead,head):
+    '''Integer offset between the pixels of the stack and those of one of its inputs'''
+    offsets = []
+    for ax in [1,2]:
+        off = stackhead['CRPIX%s'%ax]-head['CRPIX%s'%ax]
+        if abs(off-round(off))>1e-3:
+            raise ValueError('Input is not on the grid of the stack (offset %.4f pixels)'%off)
+        offsets.append(int(round(off)))
+    return offsets
+
+def outlier_pixels(cliplog_fn,stackhead,heads,grow=1):
+    '''Maps the outliers of a clipped stack onto its inputs.
+    arguments:
+    cliplog_fn (str): the clip log written by SWarp
+    stackhead (Header): header of the clipped stack
+    heads (list): headers of the inputs, in the order they went into SWarp
+    grow (int): number of pixels to grow each outlier by in every direction
+    returns:
+    pixels (list): (y, x) arrays of the pixels to mask in each input
+    '''
+    idx,x,y = read_clip_log(cliplog_fn)
+    order = np.argsort(idx,kind='stable')
+    idx,x,y = idx[order],x[order],y[order]
+    bounds = np.searchsorted(idx,np.arange(len(heads)+1))
+    if grow>0:
+        steps = np.arange(-grow,grow+1)
+        gy,gx = [g.ravel() for g in np.meshgrid(steps,steps,indexing='ij')]
+    pixels = []
+    for i,head in enumerate(heads):
+        dx,dy = _offset(stackhead,head)
+        fx = x[bounds[i]:bounds[i+1]]-dx
+        fy = y[bounds[i]:bounds[i+1]]-dy
+        if grow>0 and len(fx)>0:
+            fx = np.add.outer(fx,gx).ravel()
+            fy = np.add.outer(fy,gy).ravel()
+        inside = (fx>=0)&(fx<head['NAXIS1'])&(fy>=0)&(fy<head['NAXIS2'])
+        pixels.append((fy[inside],fx[inside]))
+    return pixels
+
+def mask_weights(s,chip,j,outname,logger=None,grow=1,tag=None,only=None):
+    '''Writes the masked weightmaps of one part of a chip from the clip log of its clipped stack.
+    Returns the list of masked weightmaps, which is also written next to the list of resampled images.
+    tag (str): tag the masks with this rather than the cuts and part (the list is then not written)
+    only (list): the resampled images to mask (default = all of them)'''
+    if not logger:
+        logger = logging.getLogger(__name__)
+    resamplist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.resamp.lst'%(s.my,s.field,s.band,chip,s.cutstring,j))
+    headlist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.head.lst'%(s.my,s.field,s.band,chip,s.cutstring,j))
+    cliplog_fn = os.path.join(s.temp_dir,'cliptabs','%s_%s_%s_%s_%s_%s_clipped.tab'%(s.my,s.field,s.band,chip,s.cutstring,j))
+    resamplist = np.atleast_1d(np.genfromtxt(resamplist_name,dtype='str',delimiter='\n'))
+    heads = get_headers(np.atleast_1d(np.genfromtxt(headlist_name,dtype='str',delimiter='\n')),logger=logger)
+    pixels = outlier_pixels(cliplog_fn,getheader(outname),heads,grow=grow)
+    write = tag is None
+    if write:
+        tag = '%s_%s'%(s.cutstring,j)
+    if only is not None:
+        only = set(only)
+        pixels = [p for f,p in zip(resamplist,pixels) if f in only]
+        resamplist = [f for f in resamplist if f in only]
+    def _mask_one(f,ys,xs):
+        wn,mwn = _weight_names(f,tag)
+        # the weightmaps may be shared with other stacks, so mask a copy
+        order = np.argsort(ys,kind='stable')
+        ys,xs = ys[order],xs[order]
+        def _zero(block,y0,y1):
+            lo,hi = np.searchsorted(ys,[y0,y1])
+            block[ys[lo:hi]-y0,xs[lo:hi]] = 0
+        return stream_weight(wn,mwn,_zero)
+    with ThreadPoolExecutor(max_workers=mask_threads) as ex:
+        maskweightlist = list(ex.map(lambda a: _mask_one(a[0],*a[1]),zip(resamplist,pixels)))
+    if write:
+        write_list(resamplist_name.replace('resamp','maskweight'),maskweightlist)
+    # the masks are kept (and evicted) with the images they were made from
+    cache = get_resamp_cache(s)
+    cache.update_size([os.path.split(f[:-3] if f[-3:]=='[0]' else f)[-1][:-12] for f in resamplist])
+    cache.evict(logger)
+    logger.info('Masked %s outlying pixels in %s weightmaps of chip %s, part %s'%(sum(len(p[0]) for p in pixels),len(maskweightlist),chip,j))
+    return maskweightlist
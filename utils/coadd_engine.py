@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+'''coadd_engine.py: Weighted-mean coadds that can be updated one exposure at a time.
+
+A weighted mean stack is sum(w*x)/sum(w), so the numerator and denominator can be kept
+on disk (as float64 memmaps on the common grid of the chip) and exposures added to or
+taken out of them. Going from one set of cuts to the next then costs as much as the
+exposures that differ between the two sets, rather than the whole season.
+
+The inputs are the resampled single-epoch images made by stack_tools.resample, which
+all share the fixed grid of their chip, so each one is placed with an integer offset.
+Each goes in with the masked weightmap clip_mask made for it the first time it was
+clipped, which is kept from one set of cuts to the next, so that the frames two sets
+share stay in the coadd as they are. A frame given with another weightmap than the one
+it went in with is taken out and put back.'''
+
+import os
+import json
+import logging
+import numpy as np
+import astropy.io.fits as fits
+from astropy import wcs
+
+from des_stacks.utils.header_cache import getheader
+
+class CoaddEngine():
+    '''Running numerator and denominator of the weighted stack of one chip'''
+
+    def __init__(self,engine_dir,shape=(4400,4400),logger=None):
+        '''parameters:
+        engine_dir: (str) directory to keep the accumulators and manifest in
+        shape: (tuple) (ny,nx) size of the canvas, centred on the tangent point of the grid
+        logger: (Logger, optional)
+        '''
+        if not logger:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+        self.engine_dir = engine_dir
+        if not os.path.isdir(engine_dir):
+            os.makedirs(engine_dir)
+        self.manifest_fn = os.path.join(engine_dir,'manifest.json')
+        if os.path.isfile(self.manifest_fn):
+            with open(self.manifest_fn) as f:
+                self.manifest = json.load(f)
+            mode = 'r+'
+        else:
+            self.manifest = {'shape':list(shape),'crpix':None,'header':None,'exptime':0.,'frames':{}}
+            mode = 'w+'
+        shape = tuple(self.manifest['shape'])
+        self.num = np.lib.format.open_memmap(os.path.join(engine_dir,'num.npy'),mode=mode,dtype=np.float64,shape=shape)
+        self.den = np.lib.format.open_memmap(os.path.join(engine_dir,'den.npy'),mode=mode,dtype=np.float64,shape=shape)
+
+    def _save(self):
+        self.num.flush()
+        self.den.flush()
+        temp_fn = self.manifest_fn+'.tmp'
+        with open(temp_fn,'w') as f:
+            json.dump(self.manifest,f)
+        os.replace(temp_fn,self.manifest_fn)
+
+    def _place(self,header):
+        '''Returns the slices of the canvas and of the frame where they overlap'''
+        ny,nx = self.manifest['shape']
+        if self.manifest['crpix'] is None:
+            # line the canvas up with the pixels of the grid
+            frac = [header['CRPIX1']%1,header['CRPIX2']%1]
+            self.manifest['crpix'] = [nx//2+frac[0],ny//2+frac[1]]
+            # only the grid is shared by the frames: keywords such as FLXSCALE, EXPNUM and MJD-OBS
+            # belong to the first one, and SWarp would apply its FLXSCALE to the coadd
+            h = fits.Header([('SIMPLE',True),('BITPIX',-32),('NAXIS',2),('NAXIS1',nx),('NAXIS2',ny)])
+            h.update(wcs.WCS(header,naxis=2).to_header())
+            for kw in ['MJDREF','MJD-OBS','DATE-OBS','MJD-END','DATE-END']:
+                h.remove(kw,ignore_missing=True)
+            h['CRPIX1'],h['CRPIX2'] = self.manifest['crpix']
+            h['FLXSCALE'] = 1.0
+            self.manifest['header'] = h.tostring()
+        offsets = []
+        for ax in [0,1]:
+            off = self.manifest['crpix'][ax]-header['CRPIX%s'%(ax+1)]
+            if abs(off-round(off))>1e-3:
+                raise ValueError('Frame is not on the grid of the coadd (offset %.4f pixels)'%off)
+            offsets.append(int(round(off)))
+        dx,dy = offsets
+        fy,fx = header['NAXIS2'],header['NAXIS1']
+        x0,x1 = max(dx,0),min(dx+fx,nx)
+        y0,y1 = max(dy,0),min(dy+fy,ny)
+        if x1<=x0 or y1<=y0:
+            return None
+        if x0!=dx or y0!=dy or x1!=dx+fx or y1!=dy+fy:
+            self.logger.warning('Frame is partly off the canvas of the coadd; cropping it')
+        return (slice(y0,y1),slice(x0,x1)),(slice(y0-dy,y1-dy),slice(x0-dx,x1-dx))
+
+    def _accumulate(self,entry,sign):
+        header = getheader(entry['sci'])
+        place = self._place(header)
+        if place is None:
+            return
+        canvas,frame = place
+        # the same flux scaling SWarp applies when it coadds
+        fscale = header.get('FLXSCALE',1.0)
+        sci = fits.getdata(entry['sci'],memmap=True)[frame].astype(np.float64)*fscale
+        wgt = fits.getdata(entry['wgt'],memmap=True)[frame].astype(np.float64)/fscale**2
+        wgt[~np.isfinite(sci)] = 0
+        sci[~np.isfinite(sci)] = 0
+        self.num[canvas]+=sign*wgt*sci
+        self.den[canvas]+=sign*wgt
+        self.manifest['exptime'] = self.manifest.get('exptime',0.)+sign*header.get('EXPTIME',0.)
+
+    def _entry(self,imgroot,sci_fn,wgt_fn):
+        '''Describes a frame and the weightmap it goes in with, so it can be taken out again'''
+        return {'sci':sci_fn,'wgt':wgt_fn,
+                'sci_mtime':os.path.getmtime(sci_fn),'wgt_mtime':os.path.getmtime(wgt_fn)}
+
+    def _unchanged(self,entry):
+        try:
+            return (os.path.getmtime(entry['sci'])==entry['sci_mtime'] and
+                    os.path.getmtime(entry['wgt'])==entry['wgt_mtime'])
+        except OSError:
+            return False
+
+    def reset(self):
+        '''Empties the coadd'''
+        self.num[:] = 0
+        self.den[:] = 0
+        self.manifest['exptime'] = 0.
+        self.manifest['frames'] = {}
+        self._save()
+
+    def sync(self,frames):
+        '''Makes the coadd contain exactly these frames, adding and taking out only those that changed.
+        parameters:
+        frames: (dict) imgroot: (path of the resampled image, path of its masked weightmap)
+        returns:
+        (n_added,n_removed)
+        '''
+        current = self.manifest['frames']
+        to_remove = [r for r in current if r not in frames or frames[r]!=(current[r]['sci'],current[r]['wgt'])]
+        if not all(self._unchanged(e) for e in current.values()):
+            # a frame in the coadd has been remade since it went in, so start again
+            self.logger.warning('Frames in the coadd in %s have changed on disk; rebuilding it'%self.engine_dir)
+            self.reset()
+            current = self.manifest['frames']
+            to_remove = []
+        to_add = [r for r in frames if r not in current or r in to_remove]
+        for r in to_remove:
+            self._accumulate(current[r],-1)
+            del current[r]
+        for r in to_add:
+            entry = self._entry(r,*frames[r])
+            self._accumulate(entry,1)
+            current[r] = entry
+        self._save()
+        self.logger.info('Coadd in %s: added %s frames and took out %s; it now has %s'%(self.engine_dir,len(to_add),len(to_remove),len(current)))
+        return len(to_add),len(to_remove)
+
+    def write(self,sci_fn,wgt_fn):
+        '''Writes the current weighted mean and its weight out as FITS images'''
+        header = fits.Header.fromstring(self.manifest['header'])
+        # as SWarp does, the exposure time the coadd is equivalent to
+        header['EXPTIME'] = self.manifest.get('exptime',0.)
+        den = np.asarray(self.den)
+        sci = np.zeros(den.shape,dtype=np.float32)
+        # ignore the rounding left behind where every frame has been taken out again
+        good = den>1e-9*np.max(den)
+        sci[good] = (np.asarray(self.num)[good]/den[good])
+        fits.writeto(sci_fn,sci,header=header,overwrite=True)
+        fits.writeto(wgt_fn,den.astype(np.float32),header=header,overwrite=True)
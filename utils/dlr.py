@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+'''dlr.py: Directional light radius (DLR) of SN-galaxy pairs, and the host ranking by it.
+
+Everything works on flat arrays of pairs: the position of the SN and the position and
+shape of the galaxy of each pair, plus a key saying which SN a pair belongs to, so that
+any number of SNe are done at once and the ranking is a grouped rank over the pairs.'''
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+rad  = np.pi/180                   # convert deg to rad
+pix_arcsec = 0.264                 # pixel scale (arcsec per pixel)
+# galaxies further than this many DLRs from the SN get a negative rank
+dlr_cut = 4
+
+def get_DLR_ABT(RA_SN, DEC_SN, RA, DEC, A_IMAGE, B_IMAGE, THETA_IMAGE, angsep):
+    '''Function for calculating the DLR of a galaxy - SN pair (taken from dessne)'''
+
+    # inputs are arrays
+    # convert from IMAGE units (pixels) to WORLD (arcsec^2)
+    A_ARCSEC = A_IMAGE*pix_arcsec
+    B_ARCSEC = B_IMAGE*pix_arcsec
+
+    # angle between RA-axis and SN-host vector
+    GAMMA = np.arctan((DEC_SN - DEC)/(np.cos(DEC_SN*rad)*(RA_SN - RA)))
+
+    # angle between semi-major axis of host and SN-host vector
+    PHI = np.radians(THETA_IMAGE) + GAMMA # angle between semi-major axis of host and SN-host vector
+
+    rPHI = A_ARCSEC*B_ARCSEC/np.sqrt((A_ARCSEC*np.sin(PHI))**2 +
+                                     (B_ARCSEC*np.cos(PHI))**2)
+
+    # directional light radius
+    #  where 2nd moments are bad, set d_DLR = 99.99
+    d_DLR = angsep/rPHI
+
+    return [d_DLR, A_ARCSEC, B_ARCSEC, rPHI]
+
+def angsep_arcsec(ra1,dec1,ra2,dec2):
+    '''Angular separation in arcsec of positions in degrees (the Vincenty formula astropy uses)'''
+    ra1,dec1,ra2,dec2 = [np.radians(np.asarray(v,dtype=np.float64)) for v in [ra1,dec1,ra2,dec2]]
+    dra = ra2-ra1
+    num1 = np.cos(dec2)*np.sin(dra)
+    num2 = np.cos(dec1)*np.sin(dec2)-np.sin(dec1)*np.cos(dec2)*np.cos(dra)
+    denom = np.sin(dec1)*np.sin(dec2)+np.cos(dec1)*np.cos(dec2)*np.cos(dra)
+    return np.degrees(np.arctan2(np.hypot(num1,num2),denom))*3600.
+
+def find_pairs(sn_ra,sn_dec,gal_ra,gal_dec,radius):
+    '''Finds every SN-galaxy pair closer than radius (arcsec).
+    returns:
+    sn_inds,gal_inds (arrays): the SN and galaxy of each pair, sorted by SN then galaxy
+    angsep (array): their separations in arcsec
+    '''
+    sn_ra,sn_dec,gal_ra,gal_dec = [np.atleast_1d(np.asarray(v,dtype=np.float64)) for v in [sn_ra,sn_dec,gal_ra,gal_dec]]
+    empty = np.array([],dtype=int)
+    if len(sn_ra)==0 or len(gal_ra)==0:
+        return empty,empty,np.array([])
+    def xyz(ra,dec):
+        ra,dec = np.radians(ra),np.radians(dec)
+        return np.column_stack([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)])
+    chord = 2*np.sin(np.radians(radius/3600.)/2)
+    hits = cKDTree(xyz(gal_ra,gal_dec)).query_ball_point(xyz(sn_ra,sn_dec),chord*(1+1e-9))
+    counts = np.array([len(h) for h in hits])
+    if counts.sum()==0:
+        return empty,empty,np.array([])
+    sn_inds = np.repeat(np.arange(len(sn_ra)),counts)
+    gal_inds = np.concatenate([np.sort(h) for h in hits if len(h)]).astype(int)
+    angsep = angsep_arcsec(sn_ra[sn_inds],sn_dec[sn_inds],gal_ra[gal_inds],gal_dec[gal_inds])
+    close = angsep<radius
+    return sn_inds[close],gal_inds[close],angsep[close]
+
+def signed_rank(dlr,groups=None,method='dense',cut=dlr_cut):
+    '''Ranks the galaxies of each SN by DLR, negating the rank of those beyond cut DLRs.
+    arguments:
+    dlr (array): DLR of each pair
+    groups (array): the SN each pair belongs to (default = all one SN)
+    method (str): how to rank ties, as in pandas rank
+    returns:
+    rank (array): integers, unless there are NaNs or split ties
+    '''
+    dlr = pd.Series(np.asarray(dlr,dtype=np.float64))
+    if groups is None:
+        rank = dlr.rank(method=method)
+    else:
+        rank = dlr.groupby(np.asarray(groups)).rank(method=method)
+    rank = rank.values
+    if np.isfinite(rank).all() and (rank==np.round(rank)).all():
+        rank = rank.astype(int)
+    return np.where(dlr.values>cut,-rank,rank)
+
+def dlr_pairs(sn_ra,sn_dec,ra,dec,a_image,b_image,theta_image,groups=None,angsep=None,method='dense'):
+    '''Separation, DLR and signed DLR_RANK of a flat list of SN-galaxy pairs.
+    arguments:
+    sn_ra,sn_dec (arrays or floats): the SN of each pair
+    ra,dec,a_image,b_image,theta_image (arrays): the galaxy of each pair
+    groups (array): the SN each pair belongs to, to rank within (default = all one SN)
+    angsep (array): the separations in arcsec, if they are already known
+    method (str): how to rank ties, as in pandas rank
+    returns:
+    angsep,dlr,rank (arrays)
+    '''
+    ra,dec,a_image,b_image,theta_image = [np.asarray(v,dtype=np.float64) for v in [ra,dec,a_image,b_image,theta_image]]
+    if angsep is None:
+        angsep = angsep_arcsec(sn_ra,sn_dec,ra,dec)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        dlr = get_DLR_ABT(np.asarray(sn_ra,dtype=np.float64),np.asarray(sn_dec,dtype=np.float64),
+                          ra,dec,a_image,b_image,theta_image,angsep)[0]
+    return angsep,dlr,signed_rank(dlr,groups,method)
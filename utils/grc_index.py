@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''grc_index.py: The good redshifts of the OzDES Global Redshift Catalogue (GRC), indexed on the sky.
+
+The GRC is read once, cut to the (survey, flag) pairs in survey_flags with one isin on a
+combined key, sorted by declination and saved as a structured .npy next to it, which is
+used for as long as the GRC has the same mtime and size. Every process memory-maps that
+.npy, so the pool workers share one copy through the page cache. A box or cone query
+finds its declination strip with a binary search and only reads that strip. The rows
+come back in the same order the per-survey loop used to give them.'''
+
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+from astropy.table import Table
+
+grc_name = 'OzDES_GRC_2020_08_01.fits'
+
+vipers_flags = ['23.4', '2.4', '4.4', '3.5', '4.5', '2.2', '3.2', '4.2',
+   '2.5', '9.5', '3.4', '19.5', '12.2', '9.4', '9.2', '13.2',
+   '22.5', '24.2', '24.4', '14.2', '12.4', '24.5', '12.5', '22.2',
+   '29.2', '23.5', '29.1', '22.1', '19.2', '13.5', '22.4', '29.5',
+   '14.4', '23.2', '13.4', '14.5', '19.4', '23.1', '29.4', '2.1',
+   '24.1', '4.1', '3.1', '219.', '13.1', '14.1', '9.1', '19.1',
+   '12.1']
+
+# the flags of each survey that count as a good redshift
+survey_flags = {
+    'DES_AAOmega':['1','2','3','4','6'],
+    'DEVILS':['1','2','3','4','6'],
+    'ZFIRE_UDS':['3'],
+    'NOAO_0522':['3','4','6'],
+    'NOAO_0334':['3','4','6'],
+    'N17B331':['4','6'],
+    'MOSDEF':['Any'],
+    'SpARCS':['1','2'],
+    'PanSTARRS_AAOmega':['3','4','6'],
+    'PanSTARRS_MMT': ['3','4','6'],
+    'PRIMUS': ['3','4'],
+    'NED': ['Any'],
+    'UDS_FORS2':['A','B'],
+    'UDS_VIMOS':['3','4'],
+    'ACES': ['3','4'],
+    'SDSS': ['0'],
+    '6dF': ['4'],
+    'ATLAS':['Any'],
+    '2dFGRS':['3','4'],
+    'GAMA':['4'],
+    'SNLS_FORS':['1','2'],
+    'CDB':['Any'],
+    'VVDS_DEEP':['3','4','13','14','23','24','213','214'],
+    'VVDS_CDFS':['3','4','13','14','23','24'],
+    'MUSE':['3','2'],
+    'SAGA':['4'],
+    'SNLS_AAOmega':['3','4','6'],
+    'VIPERS':vipers_flags,
+    'VIPERS_private_communication':vipers_flags,
+    'DEEP2_DR4':['-1','3','4'],
+    'VUDS_COSMOS':['3','4','13','14','23','24','43','44'],
+    'VUDS_ECDFS':['3','4','13','14','23','24','43','44'],
+    'XMM__Stalin':['1'],
+    'KMOS':['0'],
+    '2dF Archive':['1','2','3','4','6'],
+    }
+
+_indexes = {}
+
+def _good_order(grc):
+    '''The position of each row in the order of survey_flags (-1 if it is not a good redshift),
+    which is the order the rows were appended in survey by survey, flag by flag'''
+    keys,any_surveys = {},{}
+    n = 0
+    for survey,flags in survey_flags.items():
+        if flags==['Any']:
+            any_surveys[survey] = n
+            n+=1
+        else:
+            for flag in flags:
+                keys['%s|%s'%(survey,flag)] = n
+                n+=1
+    order = grc['source'].map(any_surveys)
+    combined = grc['source']+'|'+grc['flag']
+    good = combined.isin(keys.keys())
+    order[good] = combined[good].map(keys)
+    return order.fillna(-1).astype(np.int64).values
+
+def _build(grc_fn):
+    '''Reads the GRC and returns its good redshifts as a structured array sorted by declination'''
+    grc = Table.read(grc_fn)
+    for col in ['ID','flag','source','Comment','Object_types','Transient_type']:
+        grc[col] = grc[col].astype(str)
+    grc = grc.to_pandas()
+    grc['flag'] = grc['flag'].str.strip(' ')
+    order = _good_order(grc)
+    good = np.nonzero(order>=0)[0]
+    # within a survey and flag the rows keep the order they have in the GRC
+    good = good[np.argsort(order[good],kind='stable')]
+    grc = grc.iloc[good]
+    cols,names = [np.arange(len(grc)),good],['_order','_row']
+    for col in grc.columns:
+        vals = grc[col]
+        if vals.dtype==object or pd.api.types.is_string_dtype(vals):
+            # fixed-width strings, so the table can be memory-mapped
+            cols.append(np.array(vals.fillna('').astype(str).tolist(),dtype=str))
+        else:
+            cols.append(vals.values)
+        names.append(col)
+    arr = np.rec.fromarrays(cols,names=names)
+    return arr[np.argsort(arr['DEC'],kind='stable')]
+
+class GRCIndex():
+    '''The good redshifts of the GRC, memory-mapped and sorted by declination'''
+
+    def __init__(self,grc_fn,logger=None):
+        if not logger:
+            logger = logging.getLogger(__name__)
+        self.grc_fn = grc_fn
+        index_fn = os.path.splitext(grc_fn)[0]+'.index.npy'
+        meta_fn = index_fn.replace('.npy','.json')
+        stat = os.stat(grc_fn)
+        meta = {'mtime':stat.st_mtime,'size':stat.st_size,'survey_flags':survey_flags}
+        stored = None
+        if os.path.isfile(meta_fn) and os.path.isfile(index_fn):
+            with open(meta_fn) as f:
+                try:
+                    stored = json.load(f)
+                except ValueError:
+                    stored = None
+        if stored!=meta:
+            logger.info('Indexing the good redshifts of %s in %s'%(grc_fn,index_fn))
+            arr = _build(grc_fn)
+            pid = os.getpid()
+            with open('%s.%s'%(index_fn,pid),'wb') as f:
+                np.save(f,arr)
+            with open('%s.%s'%(meta_fn,pid),'w') as f:
+                json.dump(meta,f)
+            os.replace('%s.%s'%(index_fn,pid),index_fn)
+            os.replace('%s.%s'%(meta_fn,pid),meta_fn)
+        self.table = np.load(index_fn,mmap_mode='r')
+        self.dec = np.asarray(self.table['DEC'])
+        self.columns = [c for c in self.table.dtype.names if c not in ['_order','_row']]
+
+    def __len__(self):
+        return len(self.table)
+
+    def _strip(self,dec_lo,dec_hi):
+        '''The rows with dec_lo < DEC < dec_hi'''
+        lo = np.searchsorted(self.dec,dec_lo,side='right')
+        hi = np.searchsorted(self.dec,dec_hi,side='left')
+        return self.table[lo:max(lo,hi)]
+
+    def _to_frame(self,rows):
+        rows = np.sort(rows,order='_order')
+        df = pd.DataFrame({c:rows[c] for c in self.columns},index=pd.Index(rows['_row']))
+        for c in self.columns:
+            if rows.dtype[c].kind=='U':
+                df[c] = df[c].astype(object)
+        return df
+
+    def box(self,ra,dec,rad):
+        '''The good redshifts within rad degrees of (ra, dec) in RA and in Dec'''
+        rows = self._strip(dec-rad,dec+rad)
+        rows = rows[(rows['RA']<ra+rad)&(rows['RA']>ra-rad)]
+        return self._to_frame(rows)
+
+    def cone(self,ra,dec,rad):
+        '''The good redshifts within an angle of rad degrees of (ra, dec)'''
+        rows = self._strip(dec-rad,dec+rad)
+        r1,d1,r2,d2 = [np.radians(v) for v in [ra,dec,rows['RA'],rows['DEC']]]
+        hav = np.sin((d2-d1)/2)**2+np.cos(d1)*np.cos(d2)*np.sin((r2-r1)/2)**2
+        return self._to_frame(rows[2*np.arcsin(np.sqrt(np.clip(hav,0,1)))<np.radians(rad)])
+
+def get_grc_index(cat_dir,logger=None):
+    '''Returns the index of the GRC in cat_dir, building it the first time'''
+    grc_fn = os.path.abspath(os.path.join(cat_dir,grc_name))
+    if grc_fn not in _indexes:
+        _indexes[grc_fn] = GRCIndex(grc_fn,logger)
+    return _indexes[grc_fn]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+'''header_cache.py: FITS headers, read once and kept next to the files they come from.
+
+The header cards of each file are stored (zlib-compressed) in a small SQLite database,
+.headers.db, in the directory of the file, keyed on the name of the file and the
+extension, and are used for as long as the file has the same mtime and size. Headers are
+asked for in lists: the files are grouped by directory, each directory's database is
+queried once for all of its files, and the headers that had to be read are added to it in
+one transaction. Text headers (.head files) are cached in the same way. Where a database
+can not be written (a read-only data directory, say) the headers are simply read.'''
+
+import os
+import zlib
+import sqlite3
+import logging
+import threading
+import astropy.io.fits as fits
+
+db_name = '.headers.db'
+# names to look up in one query
+query_size = 500
+
+# one connection per directory per process and thread (None where there can be no database)
+_conns = {}
+
+def _connect(d,logger):
+    '''Returns the connection to the database of directory d, or None if it can not be used'''
+    key = (os.getpid(),threading.get_ident(),d)
+    if key not in _conns:
+        try:
+            conn = sqlite3.connect(os.path.join(d,db_name),timeout=120)
+            with conn:
+                conn.execute('''CREATE TABLE IF NOT EXISTS headers (
+                    name TEXT, ext INTEGER, mtime_ns INTEGER, size INTEGER, cards BLOB,
+                    PRIMARY KEY (name,ext))''')
+        except sqlite3.Error as e:
+            logger.debug('Not caching the headers in %s: %s'%(d,e))
+            conn = None
+        _conns[key] = conn
+    return _conns[key]
+
+def _read(fn,ext):
+    '''Reads a header from a FITS file, or from a text file if it is a .head'''
+    if fn.endswith('.head'):
+        return fits.Header.fromtextfile(fn)
+    return fits.getheader(fn,ext=ext)
+
+def _pack(h):
+    return zlib.compress(h.tostring().encode('ascii'))
+
+def _unpack(cards):
+    return fits.Header.fromstring(zlib.decompress(cards).decode('ascii'))
+
+def get_headers(fns,ext=0,strict=True,logger=None):
+    '''Returns the headers of a list of files, in the same order.
+    arguments:
+    fns (list): the FITS files (or .head text files)
+    ext (int): the extension to take the header of (default = 0)
+    strict (bool): raise if a file can not be read; otherwise its header is None
+    returns:
+    headers (list): fits.Header of each file (None if it could not be read and strict is False)
+    '''
+    if not logger:
+        logger = logging.getLogger(__name__)
+    fns = list(fns)
+    headers = [None]*len(fns)
+    by_dir = {}
+    for i,fn in enumerate(fns):
+        d,name = os.path.split(os.path.abspath(fn))
+        by_dir.setdefault(d,[]).append((i,name))
+    for d,items in by_dir.items():
+        names = sorted(set(name for i,name in items))
+        stats = {}
+        for name in names:
+            try:
+                stats[name] = os.stat(os.path.join(d,name))
+            except OSError:
+                if strict:
+                    raise
+        conn = _connect(d,logger)
+        stored = {}
+        if conn is not None:
+            try:
+                for start in range(0,len(names),query_size):
+                    chunk = names[start:start+query_size]
+                    rows = conn.execute('SELECT name, mtime_ns, size, cards FROM headers WHERE ext=? AND name IN (%s)'%
+                        ','.join('?'*len(chunk)),[ext]+chunk).fetchall()
+                    stored.update({r[0]:r[1:] for r in rows})
+            except sqlite3.Error as e:
+                logger.debug('Could not read the header cache of %s: %s'%(d,e))
+        found,new = {},{}
+        for name,st in stats.items():
+            row = stored.get(name)
+            if row and row[0]==st.st_mtime_ns and row[1]==st.st_size:
+                found[name] = _unpack(row[2])
+                continue
+            try:
+                found[name] = new[name] = _read(os.path.join(d,name),ext)
+            except Exception:
+                if strict:
+                    raise
+        if new and conn is not None:
+            try:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO headers VALUES (?,?,?,?,?)',
+                        [(name,ext,stats[name].st_mtime_ns,stats[name].st_size,_pack(h)) for name,h in new.items()])
+            except sqlite3.Error as e:
+                logger.debug('Could not add to the header cache of %s: %s'%(d,e))
+        given = set()
+        for i,name in items:
+            if name in found:
+                # every header handed out is its own, even if a file is asked for twice
+                headers[i] = found[name].copy() if name in given else found[name]
+                given.add(name)
+    return headers
+
+def getheader(fn,ext=0):
+    '''The header of one file, through the cache (as fits.getheader)'''
+    return get_headers([fn],ext)[0]
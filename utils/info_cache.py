@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''info_cache.py: Loads the snobsinfo table once per process.
+
+The FITS table is converted once into a typed pickle next to it, with FIELD and BAND
+stored as categoricals. The pickle is used as long as the FITS file has the same
+mtime and size, or failing that the same MD5. Views of a single field and band are
+memoized, so every Stack made in a process shares the same frames: treat them as
+read-only.'''
+
+import os
+import hashlib
+import logging
+import _pickle as cpickle
+from astropy.table import Table
+
+# (fits_fn) -> full table, (fits_fn,field,band) -> view
+_tables = {}
+_views = {}
+
+def _md5(fn):
+    md5 = hashlib.md5()
+    with open(fn,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20),b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def _convert(fits_fn):
+    '''Reads the FITS table and types it for pandas'''
+    info_tab = Table.read(fits_fn)
+    info_tab['BAND'] = info_tab['BAND'].astype(str)
+    info_tab['FIELD'] = info_tab['FIELD'].astype(str)
+    info_tab['NITE'] = info_tab['NITE'].astype(str)
+    info_df = info_tab.to_pandas()
+    info_df['FIELD'] = info_df['FIELD'].astype('category')
+    info_df['BAND'] = info_df['BAND'].astype('category')
+    return info_df
+
+def _load(fits_fn,logger):
+    '''Returns the table from the pickle cache, remaking the cache if it is out of date'''
+    cache_fn = os.path.splitext(fits_fn)[0]+'.pkl'
+    stat = os.stat(fits_fn)
+    cache = None
+    if os.path.isfile(cache_fn):
+        try:
+            with open(cache_fn,'rb') as f:
+                cache = cpickle.load(f)
+        except Exception:
+            logger.warning('Could not read the snobsinfo cache %s; remaking it'%cache_fn)
+    if cache and cache['mtime']==stat.st_mtime and cache['size']==stat.st_size:
+        return cache['info']
+    md5 = _md5(fits_fn)
+    if cache and cache['md5']==md5:
+        # same contents, only touched
+        info_df = cache['info']
+    else:
+        logger.info('Converting %s into the snobsinfo cache %s'%(fits_fn,cache_fn))
+        info_df = _convert(fits_fn)
+    cache = {'mtime':stat.st_mtime,'size':stat.st_size,'md5':md5,'info':info_df}
+    temp_fn = '%s.%s'%(cache_fn,os.getpid())
+    try:
+        with open(temp_fn,'wb') as f:
+            cpickle.dump(cache,f,protocol=-1)
+        os.replace(temp_fn,cache_fn)
+    except OSError:
+        logger.warning('Could not write the snobsinfo cache %s'%cache_fn)
+    return info_df
+
+def get_info(fits_fn,field=None,band=None,logger=None):
+    '''Returns the snobsinfo table, or the part of it for a field (and band).
+    arguments:
+    fits_fn (str): path to snobsinfo.fits
+    field (str, optional): e.g. 'SN-X2'
+    band (str, optional): e.g. 'r'
+    returns:
+    info_df (DataFrame): shared between callers; do not modify it in place
+    '''
+    if not logger:
+        logger = logging.getLogger(__name__)
+    fits_fn = os.path.abspath(fits_fn)
+    if fits_fn not in _tables:
+        _tables[fits_fn] = _load(fits_fn,logger)
+    info_df = _tables[fits_fn]
+    if not field and not band:
+        return info_df
+    key = (fits_fn,field,band)
+    if key not in _views:
+        view = info_df
+        if field:
+            view = view[view['FIELD']==field]
+        if band:
+            view = view[view['BAND']==band]
+        _views[key] = view
+    return _views[key]
@@ -37,7 +37,7 @@ def init_source_loop(logger,f,b,my,chips,loop_type,init_cut,init_step,workdir):
 
     return (qual,limmags, qual_stringe, limmags_stringe, qual_gen, limmags_gen)
 
-def iterate_source_loop(logger,f,b,my,chip,loop_type,init_cut,init_step,workdir,direction,limmag):
+def iterate_source_loop(logger,f,b,my,chip,loop_type,init_cut,init_step,workdir,direction,limmag,incremental=False):
     s = stack.Stack(f,b,my,[chip],workdir)
     if direction == 'ge':
         f = -1
@@ -62,7 +62,7 @@ def iterate_source_loop(logger,f,b,my,chip,loop_type,init_cut,init_step,workdir,
             carryon = False
         else:
            cuts = {'zp':zp_start,'psf':psf_start}
-        s.do_my_stack(cuts,final=False)
+        s.do_my_stack(cuts,final=False,incremental=incremental)
         new_qual = s.run_stack_source(cuts)
         new_limmag = np.median(list(s.init_phot()[chip]))
         impr = new_limmag-limmag
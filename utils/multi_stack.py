@@ -1,163 +1,103 @@
 # -*- coding: utf-8 -*-
 
-import pathos.pools as pp
 import multiprocessing
-from multiprocessing import Process
 import os
-import subprocess
-import time
 import numpy as np
-import os
 import logging
 import pandas as pd
-import astropy.io.fits as fits
 
-from des_stacks.utils.stack_tools import make_swarp_cmds, combine_mask_weight
+from des_stacks.utils.stack_tools import make_swarp_cmds, resample, read_part_plan
+from des_stacks.utils.scheduler import Scheduler
+from des_stacks.utils.resamp_cache import get_resamp_cache
+from des_stacks.utils.coadd_engine import CoaddEngine
+from des_stacks.utils.clip_mask import mask_weights, maskweight_name, coadd_tag
+from des_stacks.utils.tool_runner import run_tool, tool_log, tool_xml
+from des_stacks.utils.pipeline_pool import pool_map
 from des_stacks.utils.source_tools import source_for_psfex, psfex, source_for_cat
 from des_stacks.analysis.astro import init_phot, init_calib
 
-def stack_worker(arg_pair):
-    logger = logging.getLogger(__name__)
-    logger.handlers =[]
-    ch = logging.StreamHandler()
-    '''if zp_cut>0:
-        logger.setLevel(logging.DEBUG)
-        ch.setLevel(logging.DEBUG)
-    else:'''
-    logger.setLevel(logging.INFO)
-    ch.setLevel(logging.INFO)
-    formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    chip,args =arg_pair[1],arg_pair[0]
-    s,logger2= [args[i]for i in range(len(args))]
-    field,band,y,cuts,final = s.field,s.band,s.my,s.cuts,s.final
-    started = float(time.time())
-    #logger.info('Stacking chip %s; starting by creating mini-stacks to save time'%chip)
-    cmd_list = make_swarp_cmds(s,chip,s.logger,cuts,final)
-    #logger.info("Pulled commands list")
-    staged_imgs = []
-    for key,value in cmd_list.items():
+# cores given to each run of SWarp, and the memory (MB) each stage is expected to need
+swarp_threads = 4
+stage_mem = {'resample':1024,'clip':1024,'clipmask':512,'weighted':1024,
+             'final_resample':1024,'final':1024,'coadd':1024}
 
-        clip_cmd,wgt_cmd,outname = value
-        print (clip_cmd,wgt_cmd,outname)
-        if outname:
+def _run_cmd(s,name,cmd,cwd,what,logger):
+    '''Runs an external program in cwd, keeping its output in the log dir.
+    Raises if it fails or times out, so that the scheduler marks the node failed and skips what depends on it'''
+    if os.path.split(cmd[0])[-1]=='swarp':
+        cmd = list(cmd)+['-XML_NAME',tool_xml(s,name)]
+    ret = run_tool(cmd,cwd=cwd,log_fn=tool_log(s,name),logger=logger,what=what)
+    if ret!=0:
+        raise RuntimeError('%s failed (exit code %s); see %s'%(what,ret,tool_log(s,name)))
+    return ret
 
-            staged_imgs.append(outname.replace('clipped','weighted'))
-        if clip_cmd == False:
-            print ('Already stacked chip %s, part %s with these cuts, going straight to the next chip'%(chip,key))
-            #logger.info("Already stacked this chip with these cuts, going straight to astrometry")
-            pass
-        else:
-            #s.logger.info('Stacking... please be patient.'.format(cmd))
-            os.chdir(s.temp_dir)
-            try:
-
-                print ('Stacking chip %s, part %s, clipped'%(chip,key))
-                print ('Current dir: %s'%os.curdir)
-                print ('This command: %s'%clip_cmd)
-                starttime=float(time.time())
-                pcli = subprocess.Popen(clip_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-                outs,errs = pcli.communicate()
-                endtime=float(time.time())
-                print('Finished doing chip %s, part %s, clipped. Took %.3f seconds' %(chip,key,endtime-starttime))
-            except (OSError, IOError):
-                #s.logger.warn("Swarp failed.", exc_info=1)
-                print ('Swarp failed for some reason in chip %s'%chip)
+def _threaded(cmd,nthreads=swarp_threads):
+    return list(cmd)+['-NTHREADS','%s'%nthreads]
+
+def stack_prep(s,chip,sched,logger):
+    '''Works out the sub-stacks of a chip and adds the nodes to stack them to the graph'''
+    cmd_list = make_swarp_cmds(s,chip,s.logger,s.cuts,s.final,do_resample=False)
+    plan = read_part_plan(s,chip)
+    staged_imgs,leaves = [],[]
+    for key,value in cmd_list.items():
+        clip_cmd,wgt_cmd,outname = value
         if outname==False:
-            print ('No outname - assume you are skipping this for a reason')
-        elif wgt_cmd==False:
-            print ('Already done the weighted stack of chip %s, part %s, going to the next, or the combination'%(chip,key))
+            logger.info('No outname for chip %s, part %s - assume you are skipping this for a reason'%(chip,key))
+            continue
+        staged_imgs.append(outname.replace('clipped','weighted'))
+        if wgt_cmd==False:
+            logger.info('Already done the weighted stack of chip %s, part %s, going to the next, or the combination'%(chip,key))
+            continue
+        # SWarp holds every frame of a part while it clips and weights it
+        part_mem = plan['sizes'][key]*plan['frame_bytes']/1024.**2
+        # always go through resample: it only runs SWarp on images that are not in the cache
+        deps = [sched.add('%s:resample_%s'%(chip,key),stack_resample,(s,chip,key,logger),
+            cpus=swarp_threads,mem=stage_mem['resample'])]
+        if clip_cmd == False:
+            logger.info('Already stacked chip %s, part %s with these cuts, going straight to the mask'%(chip,key))
         else:
-            ## Start by making a mask
-            mm_conf_name = os.path.join(s.temp_dir,'cliptabs','%s_%s_%s_%s_%s_%s_mm.config'%(y,field,band,chip,s.cutstring,key))
-            mm_conf = open(mm_conf_name, 'w')
-            stackhead = fits.getheader(outname)
-            stackhead_name = outname.replace('.fits','.head')
-            try:
-                stackhead.totextfile(stackhead_name)
-            except:
-                pass
-            outhead = fits.getheader(outname)
-            headlistlst = np.genfromtxt(os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.head.lst'%(y,field,band,chip,s.cutstring,key)),dtype=str,delimiter='\n')
-            widths, lengths = [],[]
-            for headfname in headlistlst:
-                inth = fits.Header.fromtextfile(headfname)
-                widths.append(inth['NAXIS1'])
-                lengths.append(inth['NAXIS2'])
-            xsize,ysize = max(widths),max(lengths)
-            params = {
-            'outliers': os.path.join(s.temp_dir,'cliptabs','%s_%s_%s_%s_%s_%s_clipped.tab'%(y,field,band,chip,s.cutstring,key)),
-            'stackhead': stackhead_name,
-            'headlist': os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.head.lst'%(y,field,band,chip,s.cutstring,key)),
-            'mask':os.path.join(s.temp_dir,'mask.conf'),
-            'masksuffix':'.mask.fits',
-            'xsize':'%s'%int(xsize),
-            'ysize':'%s'%int(ysize)
-            }
-            for p in params.keys():
-                mm_conf.write('%s  = %s     ;\n'%(p,params[p]))
-            mm_conf.close()
-            print ('Wrote mm_conf to: %s'%mm_conf_name)
-            maskmap_cmd = ['/home/wiseman/software/cliputils/MaskMap']
-            try:
-                print ('Making mask for chip %s, part %s'%(chip,key))
-                print ('Current dir: %s'%os.curdir)
-                print ('This command: %s'%maskmap_cmd)
-                config_file = open(mm_conf_name)
-                print ('Stdin: %s'%mm_conf_name)
-                starttime=float(time.time())
-                maskp = subprocess.Popen(maskmap_cmd,stdin=config_file,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-                outs,errs = maskp.communicate()
-                endtime=float(time.time())
-
-                print('Finished masking chip %s, part %s. Took %.3f seconds' %(chip,key,endtime-starttime))
-            except (OSError, IOError):
-                #s.logger.warn("Swarp failed.", exc_info=1)
-                print ('MaskMap failed for some reason in chip %s'%chip)
-            ## Combine the masks with the weightmaps
-            print ('Combining masks with weightmaps for chip %s, part %s'%(chip,key))
-            starttime=float(time.time())
-            combine_mask_weight(s,chip,key)
-            endtime=float(time.time())
-            print('Finished creating masked weightmaps for chip %s, part %s. Took %.3f seconds' %(chip,key,endtime-starttime))
-            ##  And here the weighted stack
-            try:
-                print ('Stacking chip %s, part %s, weighted'%(chip,key))
-                print ('Current dir: %s'%os.curdir)
-                print ('This command: %s'%wgt_cmd)
-                starttime=float(time.time())
-                pwgt = subprocess.Popen(wgt_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-                outs,errs = pwgt.communicate()
-                endtime=float(time.time())
-                print('Finished doing chip %s, part %s, weighted. Took %.3f seconds' %(chip,key,endtime-starttime))
-            except (OSError, IOError):
-                #s.logger.warn("Swarp failed.", exc_info=1)
-                print ('Swarp failed for some reason in chip %s'%chip)
-
-        if outname!=False:
-            print('Added %s to list of images to make final stack' %outname.replace('clipped','weighted'))
-
-    print('Now combining mini-stacks into final science frame for chip %s'%chip)
+            deps = [sched.add('%s:clip_%s'%(chip,key),_run_cmd,
+                (s,'%s_%s_%s_%s_%s_clip_%s'%(s.my,s.field,s.band,chip,s.cutstring,key),_threaded(clip_cmd),s.temp_dir,'stacking chip %s, part %s, clipped'%(chip,key),logger),
+                deps=deps,cpus=swarp_threads,mem=max(stage_mem['clip'],part_mem))]
+        deps = [sched.add('%s:clipmask_%s'%(chip,key),mask_weights,(s,chip,key,outname,logger),
+            deps=deps,cpus=1,mem=stage_mem['clipmask'])]
+        deps = [sched.add('%s:weighted_%s'%(chip,key),stack_weighted,(s,chip,key,wgt_cmd,logger),
+            deps=deps,cpus=swarp_threads,mem=max(stage_mem['weighted'],part_mem))]
+        leaves+=deps
+    if len(staged_imgs)==0:
+        logger.warning('Nothing to stack for chip %s'%chip)
+        return
+    resamp = sched.add('%s:final_resample'%chip,stack_final_resample,(s,chip,staged_imgs,logger),
+        deps=leaves,cpus=swarp_threads,mem=stage_mem['final_resample'])
+    sched.add('%s:final'%chip,stack_final,(s,chip,staged_imgs,logger),
+        deps=[resamp],cpus=swarp_threads,mem=stage_mem['final'])
+
+def stack_resample(s,chip,key,logger):
+    '''Resamples the input exposures of one part of a chip'''
+    fn_list = os.path.join(s.temp_dir,'stack_fns_MY%s_%s_%s_%s_%s_%s.lst' %(s.my,s.field,s.band,chip,s.cutstring,key))
+    return resample(s,fn_list,s.my,chip,s.cuts,key,logger,nthreads=swarp_threads)
+
+def stack_weighted(s,chip,key,wgt_cmd,logger):
+    '''Does the weighted stack of one part of a chip, after which its resampled inputs can be evicted'''
+    resamplist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.resamp.lst'%(s.my,s.field,s.band,chip,s.cutstring,key))
+    try:
+        _run_cmd(s,'%s_%s_%s_%s_%s_weighted_%s'%(s.my,s.field,s.band,chip,s.cutstring,key),_threaded(wgt_cmd),s.temp_dir,'stacking chip %s, part %s, weighted'%(chip,key),logger)
+    finally:
+        get_resamp_cache(s).release(resamplist_name)
+
+def stack_final_resample(s,chip,staged_imgs,logger):
+    '''Resamples the mini-stacks of a chip onto a common grid'''
+    y,field,band = s.my,s.field,s.band
     staged_list = np.array(staged_imgs)
-    print('Combining these frames for chip %s:'%chip)
-    print(staged_list)
+    logger.info('Combining these frames for chip %s: %s'%(chip,staged_list))
     staged_listname = os.path.join(s.temp_dir,'%s_%s_%s_%s_%s_staged.lst'%(y,field,band,chip,s.cutstring))
     np.savetxt(staged_listname,staged_list,fmt='%s')
-    imgout_name = staged_list[0][:-16]+'_clipweighted_sci.fits'
     resamp_cmd =['swarp',
     '@%s'%staged_listname,
     '-COMBINE','N',
-    '-RESAMPLE','Y']
-    os.chdir(s.band_dir)
-    #s.logger.info('Resampling and weighting the intermediate images:\n %s'%resamp_cmd)
-    print ('Making weights for intermediate images with: %s'%resamp_cmd)
-    res_start = float(time.time())
-    rf = subprocess.Popen(resamp_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    r_out,r_errs = rf.communicate()
-    res_end = float(time.time())
-    print ('Done weighting intermediate images on chip %s in %.3f seconds'%(chip,(res_end-res_start)))
-    #s.logger.info('Done resampling intermediate stacks, took %.3f seconds'%(res_end-res_start))
+    '-RESAMPLE','Y',
+    '-RESAMPLE_DIR',s.band_dir]
+    _run_cmd(s,'%s_%s_%s_%s_%s_final_resample'%(y,field,band,chip,s.cutstring),_threaded(resamp_cmd),s.band_dir,'weighting intermediate images on chip %s'%chip,logger)
     resamplist = []
     weightlist = []
     for img in staged_list:
@@ -170,36 +110,127 @@ def stack_worker(arg_pair):
     np.savetxt(final_resampname,resamplist,fmt='%s')
     np.savetxt(final_weightname,weightlist,fmt='%s')
 
+def stack_final(s,chip,staged_imgs,logger):
+    '''Combines the resampled mini-stacks of a chip into the final science frame'''
+    y,field,band = s.my,s.field,s.band
+    imgout_name = staged_imgs[0][:-16]+'_clipweighted_sci.fits'
     weightout_name = imgout_name.replace('_sci.fits','_wgt.fits')
+    final_resampname = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_final.lst'%(y,field,band,chip,s.cutstring))
+    final_weightname = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_final.wgt.lst'%(y,field,band,chip,s.cutstring))
     final_cmd = ['swarp','@%s'%final_resampname,'-IMAGEOUT_NAME',imgout_name,
     '-WEIGHTOUT_NAME',weightout_name,
     '-COMBINE_TYPE','WEIGHTED',
     '-WEIGHT_TYPE','MAP_WEIGHT',
     '-WEIGHT_IMAGE','@%s'%final_weightname]
-    #s.logger.info('Doing this command to do the final stack:\n %s'%final_cmd)
-    print ('Doing final stack with command: %s'%final_cmd)
-    final_start = float(time.time())
-    pf = subprocess.Popen(final_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    f_out,f_errs = pf.communicate()
-    final_end = float(time.time())
-
-    print("Done combining intermediate stacks, took %.3f seconds"%(final_end -final_start))
-    print("Saved final science frame at %s"%imgout_name)
-    #print("And final weightmap at %s"%weightout_name)
-    t_tot = float(time.time()) - started
-    return t_tot
+    _run_cmd(s,'%s_%s_%s_%s_%s_final'%(y,field,band,chip,s.cutstring),_threaded(final_cmd),s.band_dir,'combining intermediate stacks of chip %s'%chip,logger)
+    logger.info("Saved final science frame at %s"%imgout_name)
+
+def stack_prep_incremental(s,chip,sched,logger):
+    '''Works out the parts of a chip and adds the nodes to resample them, mask the frames that are new to the coadd and update it'''
+    cmd_list = make_swarp_cmds(s,chip,s.logger,s.cuts,s.final,do_resample=False)
+    plan = read_part_plan(s,chip)
+    deps,keys,outnames = [],[],[]
+    for key,value in cmd_list.items():
+        clip_cmd,wgt_cmd,outname = value
+        if outname==False:
+            continue
+        keys.append(key)
+        outnames.append(outname)
+        resamp = sched.add('%s:resample_%s'%(chip,key),stack_resample,(s,chip,key,logger),
+            cpus=swarp_threads,mem=stage_mem['resample'])
+        deps.append(sched.add('%s:clipmask_%s'%(chip,key),stack_mask_new,(s,chip,key,clip_cmd,outname,logger),
+            deps=[resamp],cpus=swarp_threads,mem=max(stage_mem['clip'],plan['sizes'][key]*plan['frame_bytes']/1024.**2)))
+    if len(outnames)==0:
+        logger.warning('Nothing to stack for chip %s'%chip)
+        return
+    sched.add('%s:coadd'%chip,stack_coadd,(s,chip,keys,outnames[0],logger),
+        deps=deps,cpus=1,mem=stage_mem['coadd'])
+
+def stack_mask_new(s,chip,key,clip_cmd,outname,logger):
+    '''Masks the outliers of the frames of one part of a chip that do not have a mask for the running coadd yet.
+    Parts whose frames all have one are not clipped again, and masks are never remade, so the frames
+    that stay in the coadd from one set of cuts to the next keep their weights'''
+    resamplist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.resamp.lst'%(s.my,s.field,s.band,chip,s.cutstring,key))
+    resamplist = np.atleast_1d(np.genfromtxt(resamplist_name,dtype='str',delimiter='\n'))
+    new = [f for f in resamplist if not os.path.isfile(maskweight_name(f,coadd_tag))]
+    if len(new)==0:
+        logger.info('All the frames of chip %s, part %s are already masked for the coadd'%(chip,key))
+        return
+    if clip_cmd != False:
+        _run_cmd(s,'%s_%s_%s_%s_%s_clip_%s'%(s.my,s.field,s.band,chip,s.cutstring,key),_threaded(clip_cmd),s.temp_dir,'stacking chip %s, part %s, clipped'%(chip,key),logger)
+    mask_weights(s,chip,key,outname,logger,tag=coadd_tag,only=new)
+
+def stack_coadd(s,chip,keys,outname,logger):
+    '''Brings the running coadd of a chip up to date with the resampled images of its parts and their masked weightmaps'''
+    frames = {}
+    for key in keys:
+        resamplist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.resamp.lst'%(s.my,s.field,s.band,chip,s.cutstring,key))
+        for f in np.atleast_1d(np.genfromtxt(resamplist_name,dtype='str',delimiter='\n')):
+            if os.path.isfile(f):
+                frames[os.path.split(f)[-1][:-12]] = (str(f),maskweight_name(str(f),coadd_tag))
+    engine_dir = os.path.join(s.temp_dir,'coadd_engine','MY%s_%s_%s_%s'%(s.my,s.field,s.band,chip))
+    engine = CoaddEngine(engine_dir,logger=logger)
+    # keep the frames in the coadd in the cache so that they can be taken out again
+    cache = get_resamp_cache(s)
+    engine.sync(frames)
+    cache.acquire(engine_dir,list(engine.manifest['frames'].keys()))
+    for key in keys:
+        cache.release(os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.resamp.lst'%(s.my,s.field,s.band,chip,s.cutstring,key)))
+    # the same name as the final frame from the full stack
+    imgout_name = outname.replace('clipped','weighted')[:-16]+'_clipweighted_sci.fits'
+    engine.write(imgout_name,imgout_name.replace('_sci.fits','_wgt.fits'))
+    logger.info("Saved final science frame at %s"%imgout_name)
+
+def stack_dag(s,ncores=None,mem=None,incremental=False):
+    '''Stacks all the chips of a Stack as one graph of (chip, part, stage) tasks.
+    With incremental=True the chips are coadded by updating their running coadds instead of with SWarp.
+    Returns the time taken for each chip, and writes the timings of every task to the log dir'''
+    logger = logging.getLogger(__name__)
+    logger.handlers =[]
+    logger.setLevel(logging.INFO)
+    formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    sched = Scheduler(ncores=ncores,mem=mem,logger=logger)
+    # size the parts of each chip for this budget
+    s.stack_ncores,s.stack_mem = sched.ncores,sched.mem
+    chips = [str(c) for c in s.chips]
+    # the lists of the parts of this stack hold on to their images only while it runs
+    cache = get_resamp_cache(s)
+    list_prefixes = [os.path.join(s.list_dir,'%s_%s_%s_%s_%s_'%(s.my,s.field,s.band,c,s.cutstring)) for c in chips]
+    for prefix in list_prefixes:
+        cache.clear_refs(prefix)
+    for c in chips:
+        if incremental:
+            sched.add('%s:prep'%c,stack_prep_incremental,(s,c,sched,logger),cpus=1)
+        else:
+            sched.add('%s:prep'%c,stack_prep,(s,c,sched,logger),cpus=1)
+    try:
+        sched.run()
+    finally:
+        # including those of parts that failed or were skipped
+        for prefix in list_prefixes:
+            cache.clear_refs(prefix)
+    timings = sched.timings()
+    timings['chip'] = timings['node'].str.split(':').str[0]
+    timings_fn = os.path.join(s.log_dir,'stack_timings_%s_%s_%s_%s.csv'%(s.my,s.field,s.band,s.cutstring))
+    timings.to_csv(timings_fn,index=False)
+    logger.info('Written the timings of each stacking task to %s'%timings_fn)
+    by_chip = timings.groupby('chip')
+    t_chips = by_chip['finished'].max()-by_chip['started'].min()
+    return [t_chips[c] for c in chips]
 
 def source_worker(arg_pair):
     print ('Attempting to run a source worker')
     chip,args =arg_pair[1],arg_pair[0]
     s,logger2= [args[i]for i in range(len(args))]
-    field,band,y,cuts,final = s.field,s.band,s.my,s.cuts,s.final
-    started = float(time.time())
+    cuts = s.cuts
 
     source_for_psfex(s,chip,cuts)
 
     model_fwhm = psfex(s,chip,retval='FWHM',cuts=cuts)
-    os.chdir(os.path.join(s.band_dir,str(chip)))
 
     sourcecat = source_for_cat(s,chip,cuts)
 
@@ -217,14 +248,11 @@ def source_worker(arg_pair):
     print("******************************************************")
     return sourcecat
 def multitask(s,w='stack'):
+    if w =='stack':
+        return stack_dag(s)
+    elif w =='incremental':
+        return stack_dag(s,incremental=True)
     args = [s]
-    pool_size = multiprocessing.cpu_count()*2
-    act = multiprocessing.active_children()
-    pool = pp.ProcessPool(processes=pool_size,
-                                maxtasksperchild=2,
-                                )
-    pool._clear()
-    pool._serve()
     chips = list(s.chips)
     logger = multiprocessing.get_logger()
     logger.setLevel(logging.INFO)
@@ -235,10 +263,6 @@ def multitask(s,w='stack'):
         #p = Process(target=worker,args=(args,c))
         #p.start()
         #p.join()
-    if w =='stack':
-        results = pool.map(stack_worker,all_args)
-    elif w=='source':
-        results = pool.map(source_worker,all_args)
-    pool.close()
-    pool.join()
+    if w=='source':
+        results = pool_map(source_worker,all_args)
     return results
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+'''obs_index.py: A persistent index of the DES-SN single-epoch images on disk.
+
+The data directories are crawled once and every (field, band, night, expnum, ccdnum)
+is stored with the path of its image in a small SQLite database, so that
+get_dessn_obs() is a lookup rather than a walk through the directory tree.
+Only nights containing a directory whose mtime has changed are crawled again.'''
+
+import os
+import re
+import sqlite3
+import logging
+import time
+import threading
+
+from des_stacks.utils.header_cache import get_headers
+
+_night_re = re.compile(r'^(\d{8})-r\d{4}$')
+_field_band_re = re.compile(r'(SN-[A-Z]\d)_([grizY])')
+_expnum_re = re.compile(r'D(\d{8})')
+# only these are images; logs, .head files and the like can carry the exposure number too
+img_exts = ('.fits','.fits.fz')
+
+# one index per database file per process
+_indexes = {}
+
+class ObsIndex():
+    '''Index of the images in the DES-SN data directories'''
+
+    def __init__(self,db_fn,data_dirs):
+        '''parameters:
+        db_fn: (str) the SQLite file in which to keep the index
+        data_dirs: (dict) the data directory for each year, as in Stack.data_dirs
+        '''
+        self.db_fn = db_fn
+        self.data_dirs = data_dirs
+        self.refreshed = False
+        self._conns = {}
+        self._init_db()
+
+    def _connect(self):
+        '''Returns a connection belonging to this process and thread (they can not be shared)'''
+        key = (os.getpid(),threading.get_ident())
+        if key not in self._conns:
+            self._conns[key] = sqlite3.connect(self.db_fn,timeout=120)
+        return self._conns[key]
+
+    def _init_db(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS obs (
+                year_dir TEXT, night_dir TEXT, field_dir TEXT,
+                field TEXT, band TEXT, night TEXT, expnum INTEGER, ccdnum INTEGER,
+                path TEXT)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS obs_lookup ON obs (field,band,night,ccdnum)')
+            conn.execute('CREATE INDEX IF NOT EXISTS obs_night ON obs (night_dir)')
+            conn.execute('''CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY, night_dir TEXT, mtime REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS dirs_night ON dirs (night_dir)')
+            # earlier crawls took any file with an exposure number in its name
+            conn.execute("DELETE FROM obs WHERE path NOT LIKE '%.fits' AND path NOT LIKE '%.fits[0]' AND path NOT LIKE '%.fits.fz'")
+
+    def refresh(self,logger=None):
+        '''Crawls every night directory that is new or has changed since the last crawl'''
+        if not logger:
+            logger = logging.getLogger(__name__)
+        conn = self._connect()
+        start = float(time.time())
+        n_scanned = 0
+        for year_dir in sorted(set(self.data_dirs.values())):
+            if not os.path.isdir(year_dir):
+                logger.warning('Data directory %s does not exist; not indexing it'%year_dir)
+                continue
+            on_disk = set()
+            for entry in os.scandir(year_dir):
+                if not entry.is_dir() or not _night_re.match(entry.name):
+                    continue
+                on_disk.add(entry.path)
+                if self._is_stale(conn,entry.path):
+                    self._scan_night(conn,year_dir,entry.path)
+                    n_scanned+=1
+            # forget any nights that have disappeared
+            known = [r[0] for r in conn.execute('SELECT DISTINCT night_dir FROM obs WHERE year_dir=?',(year_dir,))]
+            with conn:
+                for night_dir in set(known)-on_disk:
+                    conn.execute('DELETE FROM obs WHERE night_dir=?',(night_dir,))
+                    conn.execute('DELETE FROM dirs WHERE night_dir=?',(night_dir,))
+        self.refreshed = True
+        logger.info('Refreshed the exposure index %s: re-crawled %s nights in %.3f seconds'%(self.db_fn,n_scanned,float(time.time())-start))
+
+    def _is_stale(self,conn,night_dir):
+        '''Checks whether any directory we recorded for this night has been modified'''
+        rows = conn.execute('SELECT path, mtime FROM dirs WHERE night_dir=?',(night_dir,)).fetchall()
+        if len(rows)==0:
+            return True
+        for path,mtime in rows:
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _scan_night(self,conn,year_dir,night_dir):
+        '''Crawls a single night directory, mirroring the choices made by get_dessn_obs'''
+        night = _night_re.match(os.path.basename(night_dir)).group(1)
+        dirs,rows = [],[]
+        dirs.append((night_dir,night_dir,os.stat(night_dir).st_mtime))
+        for field_entry in sorted(os.scandir(night_dir),key=lambda e: e.name):
+            fb = _field_band_re.search(field_entry.name)
+            if not field_entry.is_dir() or not fb:
+                continue
+            field,band = fb.group(1),fb.group(2)
+            field_dir = field_entry.path
+            dirs.append((field_dir,night_dir,os.stat(field_dir).st_mtime))
+            # take the latest processing of this field
+            procs = []
+            for p in os.listdir(field_dir):
+                try:
+                    procs.append((int(p[1:]),p))
+                except ValueError:
+                    continue
+            if len(procs)==0:
+                continue
+            proc_dir = os.path.join(field_dir,max(procs)[1])
+            dirs.append((proc_dir,night_dir,os.stat(proc_dir).st_mtime))
+            for ccd_entry in os.scandir(proc_dir):
+                if not ccd_entry.is_dir() or not ccd_entry.name.startswith('ccd'):
+                    continue
+                try:
+                    ccdnum = int(ccd_entry.name[3:])
+                except ValueError:
+                    continue
+                dirs.append((ccd_entry.path,night_dir,os.stat(ccd_entry.path).st_mtime))
+                for expnum,path in self._scan_chip(ccd_entry.path,night_dir,dirs):
+                    rows.append((year_dir,night_dir,field_dir,field,band,night,expnum,ccdnum,path))
+        with conn:
+            conn.execute('DELETE FROM obs WHERE night_dir=?',(night_dir,))
+            conn.execute('DELETE FROM dirs WHERE night_dir=?',(night_dir,))
+            conn.executemany('INSERT INTO obs VALUES (?,?,?,?,?,?,?,?,?)',rows)
+            conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?,?,?)',dirs)
+
+    def _scan_chip(self,chip_dir,night_dir,dirs):
+        '''Goes down the red/ directory of a chip until it finds the images'''
+        obs_dir = os.path.join(chip_dir,'red')
+        while True:
+            try:
+                contents = sorted(os.listdir(obs_dir))
+            except OSError:
+                return []
+            dirs.append((obs_dir,night_dir,os.stat(obs_dir).st_mtime))
+            if len(contents)==0:
+                return []
+            if os.path.isfile(os.path.join(obs_dir,contents[0])):
+                break
+            obs_dir = os.path.join(obs_dir,contents[0])
+        if os.path.split(obs_dir)[-1]=='red':
+            imgs = [c for c in contents if 'immasked' in c]
+            if len(imgs)==0:
+                imgs = contents
+        else:
+            imgs = contents
+        imgs = [img for img in imgs if img[:3]!='DSN' and img.endswith(img_exts)]
+        # the images without the exposure number in their name have their headers read together
+        no_expnum = [os.path.join(obs_dir,img) for img in imgs if not _expnum_re.search(img)]
+        heads = dict(zip(no_expnum,get_headers(no_expnum,strict=False)))
+        found = []
+        for img in imgs:
+            obs_fn = os.path.join(obs_dir,img)
+            expnum = _expnum_re.search(img)
+            if expnum:
+                expnum = int(expnum.group(1))
+            else:
+                try:
+                    expnum = int(heads[obs_fn]['EXPNUM'])
+                except Exception:
+                    continue
+            if obs_fn[-9:]=='sked.fits':
+                obs_fn = obs_fn+'[0]'
+            found.append((expnum,obs_fn))
+        return found
+
+    def lookup(self,field,band,night,ccdnum,expnum=None,year_dir=None):
+        '''Returns the list of images for a field, band, night and chip, or None if there are none
+
+        Like the directory crawl it replaces, this returns every image of the chip
+        from the night; give expnum to restrict it to a single exposure.'''
+        query = 'SELECT night_dir, field_dir, expnum, path FROM obs WHERE field=? AND band=? AND night=?'
+        args = [field,band,str(night)]
+        if year_dir:
+            query+=' AND year_dir=?'
+            args.append(year_dir)
+        rows = self._connect().execute(query,args).fetchall()
+        if len(rows)==0:
+            return None
+        # the latest version of the night and field that was processed
+        latest = max((r[0],r[1]) for r in rows)
+        rows = self._connect().execute(query+' AND night_dir=? AND field_dir=? AND ccdnum=? ORDER BY path',
+            args+[latest[0],latest[1],int(ccdnum)]).fetchall()
+        fns = [r[3] for r in rows if expnum is None or r[2]==int(expnum)]
+        if len(fns)==0:
+            return None
+        return fns
+
+def get_obs_index(s,logger=None):
+    '''Returns the exposure index for a Stack, crawling anything that has changed
+    the first time it is asked for in each process'''
+    db_fn = os.path.join(s.db_dir,'dessn_obs_index.db')
+    try:
+        index = _indexes[db_fn]
+    except KeyError:
+        index = ObsIndex(db_fn,s.data_dirs)
+        _indexes[db_fn] = index
+    if not index.refreshed:
+        index.refresh(logger)
+    return index
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+'''pipeline_pool.py: One pool of worker processes for the whole pipeline.
+
+Starting a pool costs a fork per worker plus importing numpy, pandas, astropy and the
+pipeline itself in each of them, so instead of a new pool for every field, band and
+year, the pool is started once per process and kept until it exits. Each worker
+imports the heavy modules as it starts, so the first task it gets does not pay for
+them. Workers are still replaced every so often, to hand back memory that leaks.'''
+
+import atexit
+import logging
+import importlib
+import multiprocessing
+from multiprocess import Pool
+
+# modules each worker imports when it starts
+warm_modules = ['numpy','pandas','astropy.io.fits','astropy.table','astropy.coordinates',
+                'des_stacks.des_stack','des_stacks.analysis.astro']
+# tasks each worker does before it is replaced
+pool_maxtasks = 20
+
+_pool = None
+_pool_size = None
+
+def _warm_start(modules):
+    '''Initialiser of the workers: imports the modules they will need'''
+    for m in modules:
+        try:
+            importlib.import_module(m)
+        except ImportError:
+            pass
+
+def get_pool(processes=None,logger=None):
+    '''Returns the pool of workers, starting it the first time.
+    arguments:
+    processes (int): number of workers (default = twice the number of cores). If the pool is
+        already running with a different number it is restarted
+    returns:
+    pool (multiprocess.Pool)
+    '''
+    global _pool,_pool_size
+    if not logger:
+        logger = logging.getLogger(__name__)
+    if _pool is not None and processes and processes!=_pool_size:
+        logger.info('Restarting the pool of workers with %s processes instead of %s'%(processes,_pool_size))
+        close_pool()
+    if _pool is None:
+        _pool_size = processes or multiprocessing.cpu_count()*2
+        logger.info('Starting a pool of %s workers'%_pool_size)
+        _pool = Pool(processes=_pool_size,initializer=_warm_start,initargs=(warm_modules,),
+                     maxtasksperchild=pool_maxtasks)
+    return _pool
+
+def pool_map(func,args,processes=None,logger=None):
+    '''Maps func over args with the pool of workers'''
+    return get_pool(processes,logger).map(func,args)
+
+def close_pool():
+    '''Stops the workers'''
+    global _pool,_pool_size
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+    _pool,_pool_size = None,None
+
+atexit.register(close_pool)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''ref_cat.py: The Y3A1 reference catalogues, loaded and indexed once per process.
+
+The csv of each field and band is converted once into an .npz next to it, holding the
+positions as float64 unit vectors and the magnitudes and star/galaxy separators as
+float32. The .npz is used for as long as the csv has the same mtime and size. The
+stars used for calibration are put in a KD-tree on the unit sphere, kept per (field,
+band, star cut), so that every chip of every stack of a field shares one tree, and
+objects from many chips can be matched in one call.'''
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# the stars used to calibrate: SPREAD_MODEL+3*SPREADERR_MODEL below this, and MAG_AUTO in this range
+default_star_cut = (0.003,19.5,23.5)
+
+_cats = {}
+_trees = {}
+
+def radec_to_xyz(ra,dec):
+    '''Unit vectors of positions in degrees'''
+    ra,dec = np.radians(ra),np.radians(dec)
+    return np.stack([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)],axis=-1)
+
+def _chord(arcsec):
+    '''Straight-line distance between two unit vectors the given angle apart'''
+    return 2*np.sin(np.radians(np.asarray(arcsec)/3600.)/2)
+
+def _angle(chord):
+    return np.degrees(2*np.arcsin(np.clip(chord/2,0,1)))*3600.
+
+def _convert(csv_fn,band):
+    '''Reads the columns needed for one band from a Y3A1 csv'''
+    Band = band.capitalize()
+    y3a1 = pd.read_csv(csv_fn,index_col=0)
+    return {'ra':y3a1['RA'].values.astype(np.float64),
+            'dec':y3a1['DEC'].values.astype(np.float64),
+            'xyz':radec_to_xyz(y3a1['RA'].values,y3a1['DEC'].values),
+            'mag':y3a1['MAG_AUTO_%s'%Band].values.astype(np.float32),
+            'magerr':y3a1['MAGERR_AUTO_%s'%Band].values.astype(np.float32),
+            'spread':y3a1['SPREAD_MODEL_%s'%Band].values.astype(np.float32),
+            'spreaderr':y3a1['SPREADERR_MODEL_%s'%Band].values.astype(np.float32)}
+
+def _load(csv_fn,band,logger):
+    '''Returns the arrays of a catalogue from the .npz cache, remaking it if it is out of date'''
+    cache_fn = os.path.splitext(csv_fn)[0]+'.npz'
+    stat = os.stat(csv_fn)
+    if os.path.isfile(cache_fn):
+        try:
+            with np.load(cache_fn) as npz:
+                if npz['mtime']==stat.st_mtime and npz['size']==stat.st_size:
+                    return {k:npz[k] for k in npz.files if k not in ['mtime','size']}
+        except Exception:
+            logger.warning('Could not read the reference catalogue cache %s; remaking it'%cache_fn)
+    logger.info('Converting %s into the reference catalogue cache %s'%(csv_fn,cache_fn))
+    cat = _convert(csv_fn,band)
+    temp_fn = '%s.%s.npz'%(cache_fn[:-4],os.getpid())
+    try:
+        np.savez(temp_fn,mtime=stat.st_mtime,size=stat.st_size,**cat)
+        os.replace(temp_fn,cache_fn)
+    except OSError:
+        logger.warning('Could not write the reference catalogue cache %s'%cache_fn)
+    return cat
+
+class RefStars():
+    '''The calibration stars of one field and band, with a KD-tree to match against'''
+
+    def __init__(self,cat,star_cut=default_star_cut):
+        spread_cut,mag_lo,mag_hi = star_cut
+        stars = ((cat['spread']+3*cat['spreaderr'])<spread_cut)&(cat['mag']>mag_lo)&(cat['mag']<mag_hi)
+        self.ra,self.dec = cat['ra'][stars],cat['dec'][stars]
+        self.mag,self.magerr = cat['mag'][stars],cat['magerr'][stars]
+        self.tree = cKDTree(cat['xyz'][stars])
+
+    def __len__(self):
+        return len(self.mag)
+
+    def match(self,ra,dec,radius=2.0):
+        '''Finds the nearest star to each position.
+        arguments:
+        ra, dec (arrays): positions in degrees, which may come from many chips at once
+        radius (float): largest separation to match at, in arcsec
+        returns:
+        idx (array): index of the nearest star, -1 where there is none within radius
+        sep (array): separation in arcsec, inf where there is no match
+        '''
+        d,idx = self.tree.query(radec_to_xyz(ra,dec),distance_upper_bound=_chord(radius))
+        matched = np.isfinite(d)
+        sep = np.full(len(d),np.inf)
+        sep[matched] = _angle(d[matched])
+        idx = np.where(matched,idx,-1)
+        return idx,sep
+
+def get_ref_stars(cat_dir,field,band,star_cut=default_star_cut,logger=None):
+    '''Returns the calibration stars of a field and band, loading and indexing them the first time'''
+    if not logger:
+        logger = logging.getLogger(__name__)
+    csv_fn = os.path.abspath(os.path.join(cat_dir,'y3a1_%s_%s.csv'%(field[3],band)))
+    key = (csv_fn,band,tuple(star_cut))
+    if key not in _trees:
+        if (csv_fn,band) not in _cats:
+            _cats[(csv_fn,band)] = _load(csv_fn,band,logger)
+        _trees[key] = RefStars(_cats[(csv_fn,band)],star_cut)
+        logger.info('Indexed %s calibration stars from %s'%(len(_trees[key]),csv_fn))
+    return _trees[key]
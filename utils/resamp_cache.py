@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+'''resamp_cache.py: Keeps track of the resampled single-epoch images in the temp dir.
+
+A resampled image (imgroot.resamp.fits, its .resamp.weight.fits and .resamp.head) is
+valid for as long as its input has the same path, mtime and size and it was made with
+the same SWarp arguments, config file and target grid. Stacks with different cuts that
+share exposures therefore share resampled images instead of making them again.
+Every list of images that is being stacked holds a reference to its images; images
+that nothing refers to are deleted, least recently used first, once the cache is
+bigger than its quota. The masked weightmaps made from an image for each set of cuts
+(.resamp.*.maskweight.fits) count towards its size and are deleted along with it.'''
+
+import os
+import glob
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+
+_caches = {}
+
+def _md5(fn):
+    md5 = hashlib.md5()
+    with open(fn,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20),b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def _strip_ext(fn):
+    '''Removes the extension number from a filename, e.g. img.fits[0]'''
+    if fn[-1]==']':
+        return fn[:fn.rindex('[')]
+    return fn
+
+class ResampCache():
+    '''Index of the resampled images in a directory'''
+
+    def __init__(self,resamp_dir,quota_gb=200.):
+        '''parameters:
+        resamp_dir: (str) the directory SWarp writes the resampled images to
+        quota_gb: (float) size above which unused images are deleted
+        '''
+        self.resamp_dir = resamp_dir
+        self.quota = quota_gb*1024.**3
+        self.db_fn = os.path.join(resamp_dir,'resamp_cache.db')
+        self._conns = {}
+        self._lock = threading.Lock()
+        conn = self._connect()
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS resamp (
+                imgroot TEXT PRIMARY KEY, src TEXT, src_mtime REAL, src_size INTEGER,
+                key TEXT, nbytes INTEGER, last_used REAL)''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS refs (
+                list_name TEXT, imgroot TEXT, PRIMARY KEY (list_name,imgroot))''')
+
+    def _connect(self):
+        key = (os.getpid(),threading.get_ident())
+        if key not in self._conns:
+            self._conns[key] = sqlite3.connect(self.db_fn,timeout=120)
+        return self._conns[key]
+
+    def _files(self,imgroot):
+        return [os.path.join(self.resamp_dir,imgroot+ext) for ext in ['.resamp.fits','.resamp.weight.fits','.resamp.head']]
+
+    def _mask_files(self,imgroot):
+        return glob.glob(os.path.join(glob.escape(self.resamp_dir),glob.escape(imgroot)+'.resamp.*.maskweight.fits'))
+
+    def _nbytes(self,imgroot):
+        return sum(os.path.getsize(f) for f in self._files(imgroot)+self._mask_files(imgroot) if os.path.isfile(f))
+
+    def make_key(self,swarp_args,config_fn):
+        '''Returns the key for resampling with these SWarp arguments (including the grid) and config file'''
+        md5 = hashlib.md5(' '.join(swarp_args).encode())
+        if os.path.isfile(config_fn):
+            md5.update(_md5(config_fn).encode())
+        return md5.hexdigest()
+
+    def lookup(self,src,imgroot,key):
+        '''Checks whether there is a valid resampled version of src, and marks it as used'''
+        stat = os.stat(_strip_ext(src))
+        conn = self._connect()
+        row = conn.execute('SELECT src, src_mtime, src_size, key FROM resamp WHERE imgroot=?',(imgroot,)).fetchone()
+        if row is None or tuple(row)!=(src,stat.st_mtime,stat.st_size,key):
+            return False
+        if not all(os.path.isfile(f) for f in self._files(imgroot)):
+            return False
+        with conn:
+            conn.execute('UPDATE resamp SET last_used=? WHERE imgroot=?',(float(time.time()),imgroot))
+        return True
+
+    def add(self,src,imgroot,key):
+        '''Records a freshly resampled version of src'''
+        stat = os.stat(_strip_ext(src))
+        nbytes = self._nbytes(imgroot)
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO resamp VALUES (?,?,?,?,?,?,?)',
+                (imgroot,src,stat.st_mtime,stat.st_size,key,nbytes,float(time.time())))
+
+    def update_size(self,imgroots):
+        '''Measures the images again, e.g. once masked weightmaps have been made from them'''
+        conn = self._connect()
+        with conn:
+            conn.executemany('UPDATE resamp SET nbytes=? WHERE imgroot=?',[(self._nbytes(r),r) for r in imgroots])
+
+    def acquire(self,list_name,imgroots):
+        '''Makes the images of a list of resampled images safe from eviction'''
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM refs WHERE list_name=?',(list_name,))
+            conn.executemany('INSERT OR IGNORE INTO refs VALUES (?,?)',[(list_name,r) for r in imgroots])
+
+    def release(self,list_name):
+        '''Lets go of the images of a list once they have been stacked'''
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM refs WHERE list_name=?',(list_name,))
+
+    def clear_refs(self,prefix):
+        '''Lets go of the images of every list whose name starts with prefix, e.g. those left behind by a run that stopped early'''
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM refs WHERE substr(list_name,1,?)=?',(len(prefix),prefix))
+
+    def evict(self,logger=None):
+        '''Deletes the least recently used unreferenced images until the cache fits in its quota'''
+        if not logger:
+            logger = logging.getLogger(__name__)
+        conn = self._connect()
+        with self._lock:
+            total = conn.execute('SELECT COALESCE(SUM(nbytes),0) FROM resamp').fetchone()[0]
+            if total<=self.quota:
+                return 0
+            unused = conn.execute('''SELECT imgroot, nbytes FROM resamp WHERE imgroot NOT IN
+                (SELECT imgroot FROM refs) ORDER BY last_used''').fetchall()
+            n = 0
+            for imgroot,nbytes in unused:
+                if total<=self.quota:
+                    break
+                # a stack may have taken the image since the list of unused ones was made
+                if conn.execute('SELECT 1 FROM refs WHERE imgroot=?',(imgroot,)).fetchone():
+                    continue
+                for f in self._files(imgroot)+self._mask_files(imgroot):
+                    if os.path.isfile(f):
+                        os.remove(f)
+                with conn:
+                    conn.execute('DELETE FROM resamp WHERE imgroot=?',(imgroot,))
+                total-=nbytes
+                n+=1
+        logger.info('Evicted %s resampled images from %s; it now holds %.1f GB'%(n,self.resamp_dir,total/1024.**3))
+        return n
+
+def get_resamp_cache(s):
+    '''Returns the cache of resampled images in the temp dir of a Stack'''
+    if s.temp_dir not in _caches:
+        _caches[s.temp_dir] = ResampCache(s.temp_dir,getattr(s,'resamp_quota',200.))
+    return _caches[s.temp_dir]
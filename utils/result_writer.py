@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+'''result_writer.py: Writes the ds9 region and result files of init_phot.
+
+Each file is formatted in one go with np.savetxt, header included, straight into its
+final place, so no temporary file is shared between the workers. The result can also be
+written as a FITS table (or Parquet, if pyarrow is installed) next to the text one, with
+the values of the text header stored as header keywords (or Parquet metadata).'''
+
+import json
+import numpy as np
+import astropy.io.fits as fits
+
+# column: format in the text result file
+result_fmts = {'CLASS_STAR':'%s','FLUX_RADIUS':'%s','MAG_AUTO':'%4.3f','MAGERR_AUTO':'%4.3f',
+    'MAG_PSF':'%4.3f','MAGERR_PSF':'%4.3f','MAG_APER':'%4.3f','MAGERR_APER':'%4.3f',
+    'FWHM_WORLD':'%4.3f','ELONGATION':'%4.3f','X_WORLD':'%7.5f','Y_WORLD':'%7.5f'}
+
+def write_region(fn,ra,dec,mag,magerr,radius='1"'):
+    '''Writes a ds9 region file of circles labelled with their magnitudes'''
+    rows = np.rec.fromarrays([np.asarray(ra,dtype=np.float64),np.asarray(dec,dtype=np.float64),
+        np.asarray(mag,dtype=np.float64),np.asarray(magerr,dtype=np.float64)])
+    np.savetxt(fn,rows,fmt='fk5; circle(%%s,%%s,%s) # text={%%.2f +/- %%.2f}'%radius)
+    return fn
+
+def write_result(fn,cat,header,columns,meta=None,binary=None):
+    '''Writes a result file: the header lines, a line of column names, then the columns.
+    arguments:
+    fn (str): the text file to write
+    cat (DataFrame): the catalogue
+    header (str): the comment lines to start the file with
+    columns (list): the columns to write, in order; each needs a format in result_fmts
+    meta (dict): the values in the header, to store with a binary copy (those that are not finite are left out of a FITS header)
+    binary (str): also write the result as 'fits' (fn.fits) or 'parquet' (fn.parquet)
+    returns:
+    fn (str)
+    '''
+    data = np.rec.fromarrays([np.asarray(cat[c].values) for c in columns],names=columns)
+    with open(fn,'w') as f:
+        f.write(header)
+        np.savetxt(f,data,fmt=' '.join(result_fmts[c] for c in columns),header=' '.join(columns),comments='')
+    if binary in [None,'','none']:
+        return fn
+    meta = meta or {}
+    if binary=='fits':
+        hdr = fits.Header()
+        for k,v in meta.items():
+            # FITS headers can not hold NaN or inf (e.g. a limit from an empty window), so those are left out
+            if isinstance(v,(float,np.floating)) and not np.isfinite(v):
+                continue
+            hdr['HIERARCH %s'%k] = v
+        fits.BinTableHDU(data,header=hdr).writeto(fn+'.fits',overwrite=True)
+    elif binary=='parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(cat[columns].reset_index(drop=True),preserve_index=False)
+        table = table.replace_schema_metadata(dict(table.schema.metadata or {},
+            des_stacks=json.dumps(meta)))
+        pq.write_table(table,fn+'.parquet')
+    else:
+        raise ValueError("binary must be 'fits', 'parquet' or none, not %s"%binary)
+    return fn
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+'''scheduler.py: A small task-graph scheduler for the stacking pipeline.
+
+Each node is a function with explicit dependencies and a declared cost in cores and
+memory. Nodes run in threads (the heavy lifting is done by external programs such as
+SWarp), and are started as soon as their dependencies have finished and their cost
+fits in what is left of the core and memory budgets. Nodes may add further nodes
+while they run, e.g. one per sub-stack once the lists of images are known.'''
+
+import os
+import time
+import logging
+import threading
+import multiprocessing
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def get_total_memory():
+    '''Returns the physical memory of this machine in MB'''
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1024.**2
+    except (ValueError, OSError, AttributeError):
+        return 8192.
+
+class Node():
+    '''A single task in the graph'''
+
+    def __init__(self,name,func,args,deps,cpus,mem):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.mem = mem
+        self.status = 'pending'
+        self.result = None
+        self.queued = float(time.time())
+        self.started = None
+        self.finished = None
+
+class Scheduler():
+    '''Runs a graph of Nodes within a budget of cores and memory'''
+
+    def __init__(self,ncores=None,mem=None,logger=None):
+        '''parameters:
+        ncores: (int, optional) number of cores to use (default = all of them)
+        mem: (float, optional) memory budget in MB (default = 80% of the machine)
+        logger: (Logger, optional)
+        '''
+        self.ncores = ncores or multiprocessing.cpu_count()
+        self.mem = mem or 0.8*get_total_memory()
+        if not logger:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+        self.nodes = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def add(self,name,func,args=(),deps=(),cpus=1,mem=0):
+        '''Adds a node to the graph; safe to call from inside a running node.
+        parameters:
+        name: (str) unique name of the node, e.g. 'clip_12_0'
+        func: (callable) called as func(*args)
+        deps: (list) names of nodes that have to finish first
+        cpus: (int) number of cores the node keeps busy
+        mem: (float) memory the node needs in MB
+        returns:
+        name: (str)
+        '''
+        with self._lock:
+            if name in self.nodes:
+                raise ValueError('There is already a node called %s'%name)
+            self.nodes[name] = Node(name,func,args,deps,min(cpus,self.ncores),mem)
+            self._order.append(name)
+        return name
+
+    def _run_node(self,node):
+        node.started = float(time.time())
+        try:
+            node.result = node.func(*node.args)
+            node.status = 'done'
+        except Exception:
+            node.status = 'failed'
+            self.logger.exception('Node %s failed'%node.name)
+        node.finished = float(time.time())
+        return node
+
+    def run(self):
+        '''Runs every node in the graph, returning once they have all finished or been skipped'''
+        free_cpus,free_mem = self.ncores,self.mem
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.ncores) as ex:
+            while True:
+                with self._lock:
+                    pending = [self.nodes[n] for n in self._order if self.nodes[n].status=='pending']
+                ready = []
+                for node in pending:
+                    states = [self.nodes[d].status if d in self.nodes else 'failed' for d in node.deps]
+                    if any(st in ['failed','skipped'] for st in states):
+                        node.status = 'skipped'
+                        node.started = node.finished = float(time.time())
+                        self.logger.warning('Skipping %s as something it depends on failed'%node.name)
+                    elif all(st=='done' for st in states):
+                        ready.append(node)
+                for node in ready:
+                    # a node bigger than the whole budget is run on its own
+                    if (node.cpus<=free_cpus and node.mem<=free_mem) or len(running)==0:
+                        node.status = 'running'
+                        free_cpus-=node.cpus
+                        free_mem-=node.mem
+                        running[ex.submit(self._run_node,node)] = node
+                if len(running)==0:
+                    with self._lock:
+                        stuck = [self.nodes[n] for n in self._order if self.nodes[n].status=='pending']
+                    if len(stuck)==0:
+                        break
+                    if len(stuck)==len(pending) and len(ready)==0:
+                        # nothing can ever start: the dependencies go round in a circle
+                        for node in stuck:
+                            node.status = 'skipped'
+                            self.logger.error('Skipping %s as its dependencies can never finish'%node.name)
+                        break
+                    continue
+                done,_ = wait(list(running.keys()),return_when=FIRST_COMPLETED)
+                for fut in done:
+                    node = running.pop(fut)
+                    free_cpus+=node.cpus
+                    free_mem+=node.mem
+                    self.logger.info('%s %s in %.3f seconds'%(node.name,node.status,node.finished-node.started))
+
+    def timings(self):
+        '''Returns a DataFrame with the cost, status and timing of every node'''
+        rows = []
+        for n in self._order:
+            node = self.nodes[n]
+            rows.append({'node':node.name,'status':node.status,'cpus':node.cpus,'mem':node.mem,
+                         'queued':node.queued,'started':node.started,'finished':node.finished})
+        timings = pd.DataFrame(rows,columns=['node','status','cpus','mem','queued','started','finished'])
+        timings['waited'] = timings['started']-timings['queued']
+        timings['took'] = timings['finished']-timings['started']
+        return timings
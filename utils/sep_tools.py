@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+'''sep_tools.py: Source extraction inside Python with SEP, as an alternative to running sex.
+
+SEP (https://sep.readthedocs.io) is the SExtractor algorithms as a library, so the coadd
+and its weightmap are read once, the sources are found and measured in memory, and the
+catalogue comes back as a NumPy structured array with the SExtractor column names the
+pipeline uses. The settings (threshold, deblending, apertures, Kron parameters, filter)
+are read from the same default.sex the sex backend uses.
+
+Detection runs over horizontal tiles of the chip in threads; an object belongs to the tile
+its centre is in, and the tiles overlap so that objects on a boundary are whole in one of
+them. A few columns are approximations: FWHM_IMAGE is twice the half-light radius (exact
+for a Gaussian profile) and CLASS_STAR, which needs the SExtractor neural network, is NaN.
+PSFEx needs the vignettes of a FITS_LDAC catalogue, so the catalogue for it still
+comes from sex.
+
+sep is optional, and only imported when this backend is used.'''
+
+import os
+import logging
+import numpy as np
+import astropy.io.fits as fits
+from astropy.wcs import WCS
+from concurrent.futures import ThreadPoolExecutor
+
+from des_stacks.utils.header_cache import getheader
+
+# rows shared by neighbouring tiles
+tile_overlap = 64
+
+cat_dtype = [('NUMBER','i4'),('X_IMAGE','f8'),('Y_IMAGE','f8'),('X_WORLD','f8'),('Y_WORLD','f8'),
+    ('FLUX_AUTO','f8'),('FLUXERR_AUTO','f8'),('MAG_AUTO','f8'),('MAGERR_AUTO','f8'),
+    ('FLUX_APER','f8'),('FLUXERR_APER','f8'),('MAG_APER','f8'),('MAGERR_APER','f8'),
+    ('KRON_RADIUS','f8'),('FLUX_RADIUS','f8'),('A_IMAGE','f8'),('B_IMAGE','f8'),('THETA_IMAGE','f8'),
+    ('CXX_IMAGE','f8'),('CYY_IMAGE','f8'),('CXY_IMAGE','f8'),('ELONGATION','f8'),
+    ('FWHM_IMAGE','f8'),('FWHM_WORLD','f8'),('CLASS_STAR','f8'),('FLAGS','i4')]
+
+def read_sex_config(config_fn):
+    '''Reads the settings SEP can use from a SExtractor config file'''
+    conf = {'DETECT_THRESH':1.5,'DETECT_MINAREA':5,'DEBLEND_NTHRESH':32,'DEBLEND_MINCONT':0.005,
+            'CLEAN':'Y','CLEAN_PARAM':1.0,'PHOT_APERTURES':'5','PHOT_AUTOPARAMS':'2.5,3.5',
+            'BACK_SIZE':'64','MAG_ZEROPOINT':0.0,'FILTER':'Y','FILTER_NAME':None}
+    with open(config_fn) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            parts = line.split(None,1)
+            if parts[0] in conf and len(parts)>1:
+                conf[parts[0]] = parts[1].strip()
+    kron_fact,min_radius = [float(p) for p in conf['PHOT_AUTOPARAMS'].replace(',',' ').split()[:2]]
+    back_size = [int(b) for b in str(conf['BACK_SIZE']).replace(',',' ').split()]
+    kernel = None
+    if conf['FILTER']=='Y' and conf['FILTER_NAME']:
+        conv_fn = conf['FILTER_NAME']
+        if not os.path.isabs(conv_fn):
+            conv_fn = os.path.join(os.path.split(os.path.abspath(config_fn))[0],conv_fn)
+        if os.path.isfile(conv_fn):
+            kernel = np.loadtxt(conv_fn,skiprows=1,comments='#',ndmin=2)
+    return {'thresh':float(conf['DETECT_THRESH']),'minarea':int(conf['DETECT_MINAREA']),
+            'deblend_nthresh':int(conf['DEBLEND_NTHRESH']),'deblend_cont':float(conf['DEBLEND_MINCONT']),
+            'clean':conf['CLEAN']=='Y','clean_param':float(conf['CLEAN_PARAM']),
+            'aper':float(conf['PHOT_APERTURES'].replace(',',' ').split()[0]),
+            'kron_fact':kron_fact,'min_radius':min_radius,
+            'bw':back_size[0],'bh':back_size[-1],'zp':float(conf['MAG_ZEROPOINT']),'kernel':kernel}
+
+def _native(a):
+    '''Copies memory-mapped FITS data (big-endian) into the native byte order SEP needs'''
+    return np.array(a,dtype=a.dtype.newbyteorder('=') if a.dtype.kind=='f' else np.float32)
+
+def _load(fn,wgt_fn=None):
+    '''Reads an image and the variance and mask from its weightmap'''
+    data = _native(fits.getdata(fn,memmap=True))
+    header = getheader(fn)
+    var,mask = None,None
+    if wgt_fn and os.path.isfile(wgt_fn):
+        wgt = _native(fits.getdata(wgt_fn,memmap=True))
+        mask = ~(wgt>0)
+        var = np.ones_like(wgt)
+        var[~mask] = 1/wgt[~mask]
+    bad = ~np.isfinite(data)
+    if bad.any():
+        data[bad] = 0
+        mask = bad if mask is None else mask|bad
+    return data,header,var,mask
+
+def _extract_tiles(sep,data,var,mask,conf,ntiles,nthreads):
+    '''Finds the objects in horizontal tiles of the image, in threads'''
+    ny = data.shape[0]
+    edges = np.linspace(0,ny,ntiles+1).astype(int)
+    def _tile(i):
+        y0,y1 = max(edges[i]-tile_overlap,0),min(edges[i+1]+tile_overlap,ny)
+        objs = sep.extract(data[y0:y1],conf['thresh'],
+            var=None if var is None else var[y0:y1],mask=None if mask is None else mask[y0:y1],
+            minarea=conf['minarea'],filter_kernel=conf['kernel'],filter_type='conv',
+            deblend_nthresh=conf['deblend_nthresh'],deblend_cont=conf['deblend_cont'],
+            clean=conf['clean'],clean_param=conf['clean_param'])
+        objs['y']+=y0
+        for col in ['ymin','ymax','ycpeak','ypeak']:
+            objs[col]+=y0
+        # keep the objects whose centre is in the tile itself rather than the overlap
+        return objs[(objs['y']>=edges[i]-0.5)&(objs['y']<edges[i+1]-0.5)]
+    with ThreadPoolExecutor(max_workers=nthreads) as ex:
+        tiles = list(ex.map(_tile,range(ntiles)))
+    return np.concatenate(tiles)
+
+def _measure(sep,data,var,mask,objs,header,conf,zp):
+    '''Measures the objects on an image, returning a SExtractor-like catalogue'''
+    x,y,a,b,theta = objs['x'],objs['y'],objs['a'],objs['b'],objs['theta']
+    theta = np.clip(theta,-np.pi/2,np.pi/2)
+    kronrad,krflag = sep.kron_radius(data,x,y,a,b,theta,6.0,mask=mask)
+    # use a circle where the Kron ellipse is too small, as SExtractor does (min_radius is a diameter)
+    r_min = conf['min_radius']/2.
+    small = kronrad*np.sqrt(a*b)<r_min
+    kronrad[~np.isfinite(kronrad)|(kronrad<=0)] = 0
+    flux,fluxerr,flag = sep.sum_ellipse(data,x,y,a,b,theta,conf['kron_fact']*np.maximum(kronrad,1e-3),
+        var=var,mask=mask,subpix=1)
+    if small.any():
+        cflux,cfluxerr,cflag = sep.sum_circle(data,x[small],y[small],r_min,var=var,mask=mask,subpix=1)
+        flux[small],fluxerr[small],flag[small] = cflux,cfluxerr,cflag
+    aflux,afluxerr,aflag = sep.sum_circle(data,x,y,conf['aper']/2.,var=var,mask=mask,subpix=5)
+    rhalf,rflag = sep.flux_radius(data,x,y,6.*a,0.5,normflux=flux,mask=mask,subpix=5)
+    cat = np.zeros(len(objs),dtype=cat_dtype)
+    cat['NUMBER'] = np.arange(1,len(objs)+1)
+    cat['X_IMAGE'],cat['Y_IMAGE'] = x+1,y+1
+    wcs = WCS(header,naxis=2)
+    cat['X_WORLD'],cat['Y_WORLD'] = wcs.all_pix2world(x,y,0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        cat['FLUX_AUTO'],cat['FLUXERR_AUTO'] = flux,fluxerr
+        cat['MAG_AUTO'] = np.where(flux>0,zp-2.5*np.log10(flux),99.)
+        cat['MAGERR_AUTO'] = np.where(flux>0,1.0857*fluxerr/flux,99.)
+        cat['FLUX_APER'],cat['FLUXERR_APER'] = aflux,afluxerr
+        cat['MAG_APER'] = np.where(aflux>0,zp-2.5*np.log10(aflux),99.)
+        cat['MAGERR_APER'] = np.where(aflux>0,1.0857*afluxerr/aflux,99.)
+        cat['ELONGATION'] = a/b
+    cat['KRON_RADIUS'] = kronrad
+    cat['FLUX_RADIUS'] = rhalf
+    cat['A_IMAGE'],cat['B_IMAGE'] = a,b
+    cat['THETA_IMAGE'] = np.degrees(theta)
+    cat['CXX_IMAGE'],cat['CYY_IMAGE'],cat['CXY_IMAGE'] = objs['cxx'],objs['cyy'],objs['cxy']
+    cat['FWHM_IMAGE'] = 2*rhalf
+    pixscale = np.sqrt(np.abs(np.linalg.det(wcs.pixel_scale_matrix)))
+    cat['FWHM_WORLD'] = cat['FWHM_IMAGE']*pixscale
+    cat['CLASS_STAR'] = np.nan
+    cat['FLAGS'] = objs['flag']|flag|krflag|rflag
+    return cat
+
+def sep_extract(img_fn,config_fn,wgt_fn=None,det_fn=None,det_wgt_fn=None,zp=None,ntiles=4,nthreads=4,logger=None):
+    '''Extracts and measures the sources on an image with SEP.
+    arguments:
+    img_fn (str): image to measure
+    config_fn (str): SExtractor config file to take the settings from
+    wgt_fn (str): weightmap of the image
+    det_fn (str): image to detect on, for dual image mode (default = img_fn)
+    det_wgt_fn (str): weightmap of the detection image
+    zp (float): zeropoint of the magnitudes (default = MAG_ZEROPOINT of the config)
+    ntiles (int): number of tiles to detect on
+    nthreads (int): number of threads to detect with
+    returns:
+    cat (ndarray): structured array with SExtractor column names
+    '''
+    try:
+        import sep
+    except ImportError:
+        raise ImportError('The sep backend for source extraction needs the sep package (pip install sep)')
+    if not logger:
+        logger = logging.getLogger(__name__)
+    conf = read_sex_config(config_fn)
+    if zp is None:
+        zp = conf['zp']
+    data,header,var,mask = _load(img_fn,wgt_fn)
+    bkg = sep.Background(data,mask=mask,bw=conf['bw'],bh=conf['bh'])
+    bkg.subfrom(data)
+    if det_fn and det_fn!=img_fn:
+        det,det_header,det_var,det_mask = _load(det_fn,det_wgt_fn)
+        if det.shape!=data.shape:
+            raise ValueError('The detection image %s and %s are not the same size'%(det_fn,img_fn))
+        sep.Background(det,mask=det_mask,bw=conf['bw'],bh=conf['bh']).subfrom(det)
+        det_rms = None if det_var is not None else sep.Background(det,mask=det_mask).globalrms
+    else:
+        det,det_var,det_mask = data,var,mask
+        det_rms = None if var is not None else bkg.globalrms
+    if det_rms is not None:
+        # without a weightmap the threshold is relative to the background noise
+        conf = dict(conf,thresh=conf['thresh']*det_rms)
+    objs = _extract_tiles(sep,det,det_var,det_mask,conf,max(1,min(ntiles,data.shape[0]//(4*tile_overlap))),nthreads)
+    if var is None:
+        var = np.full(data.shape,bkg.globalrms**2,dtype=np.float32)
+    cat = _measure(sep,data,var,mask,objs,header,conf,zp)
+    logger.info('SEP found %s objects on %s'%(len(cat),img_fn))
+    return cat
+
+def write_catalog(cat,fn):
+    '''Writes a catalogue from sep_extract as a FITS table in the place sex would have put it'''
+    fits.BinTableHDU(cat).writeto(fn,overwrite=True)
+    return fn
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+'''sky_noise.py: The background level and noise of a coadd, from a subsample of its pixels.
+
+The coadd is memory-mapped and only the sampled pixels are read into memory, then
+sigma-clipped in the same way as nddata_stats (clipping about the median, with the
+standard deviation, until nothing more is clipped). The sample can leave out the pixels
+with no weight and those within a radius of the detected sources, and the weight map
+can be used to weight the statistics.
+
+Accuracy against speed: the standard deviation of N independent pixels has a relative
+error of about 1/sqrt(2N), so the default of 500000 pixels gives ~0.1% on the sky noise,
+against ~0.02% from all the pixels of a chip coadd, in a fraction of the time and memory.
+  method='random': pixels drawn uniformly from the image. The least biased, but every
+      page of the file is read once the sample is more than ~1/1000 of the pixels.
+  method='stride': every k-th row, whole. Only those rows are read from disk, so it is
+      the fastest on a cold cache; pixels in a row are correlated by the resampling,
+      so it needs ~2x the pixels for the same accuracy.
+
+The result is stored in a .skynoise.json next to the coadd, keyed on the checksum of the
+coadd and the settings, so calling it again for the same coadd costs nothing.'''
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import astropy.io.fits as fits
+from scipy.spatial import cKDTree
+
+from des_stacks.utils.header_cache import getheader
+
+default_npix = 500000
+
+def _md5(fn):
+    md5 = hashlib.md5()
+    with open(fn,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20),b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def _checksum(fn,header):
+    '''The DATASUM of the coadd if it has one, otherwise the md5 of the file'''
+    if header.get('DATASUM') not in [None,'','0']:
+        return 'datasum:%s'%header['DATASUM']
+    return 'md5:%s'%_md5(fn)
+
+def _sources_key(sources):
+    if sources is None:
+        return None
+    arr = np.column_stack(np.broadcast_arrays(*[np.atleast_1d(np.asarray(a,dtype=np.float64)) for a in sources]))
+    return hashlib.md5(arr.tobytes()).hexdigest()
+
+def sigma_clipped_stats(x,w=None,sigma=2.8,iters=10):
+    '''Mean and standard deviation of x after sigma clipping about the median.
+    arguments:
+    x (array): the values
+    w (array): weights for the mean and standard deviation (default = none)
+    sigma (float): number of standard deviations to clip at
+    iters (int): most iterations to clip for
+    returns:
+    mean,std (float)
+    '''
+    keep = np.isfinite(x)
+    for i in range(iters):
+        xk = x[keep]
+        med,std = np.median(xk),np.std(xk)
+        new = keep&(np.abs(x-med)<=sigma*std)
+        if new.sum()==keep.sum():
+            break
+        keep = new
+    if w is None:
+        return float(np.mean(x[keep])),float(np.std(x[keep]))
+    mean = np.average(x[keep],weights=w[keep])
+    return float(mean),float(np.sqrt(np.average((x[keep]-mean)**2,weights=w[keep])))
+
+def _sample(data,npix,method,rng):
+    '''Returns the (row, column) of the pixels to use and their values'''
+    ny,nx = data.shape
+    if npix>=ny*nx:
+        rows,cols = np.divmod(np.arange(ny*nx),nx)
+    elif method=='stride':
+        step = max(1,int(ny*nx/npix))
+        rows = np.repeat(np.arange(0,ny,step),nx)
+        cols = np.tile(np.arange(nx),len(rows)//nx)
+    elif method=='random':
+        # sorted, so the memmap is read in order
+        flat = np.unique(rng.integers(0,ny*nx,npix))
+        rows,cols = np.divmod(flat,nx)
+    else:
+        raise ValueError("method must be 'random' or 'stride', not %s"%method)
+    if method=='stride' and npix<ny*nx:
+        vals = np.asarray(data[rows[::nx]],dtype=np.float64).ravel()
+    else:
+        vals = np.asarray(data[rows,cols],dtype=np.float64)
+    return rows,cols,vals
+
+def _measure(img_fn,wgt_fn,sources,npix,method,weighted,sigma,iters,seed):
+    with fits.open(img_fn,memmap=True) as hdul:
+        data = hdul[0].data
+        rows,cols,vals = _sample(data,npix,method,np.random.default_rng(seed))
+    keep = np.isfinite(vals)
+    w = None
+    if wgt_fn:
+        with fits.open(wgt_fn,memmap=True) as hdul:
+            w = np.asarray(hdul[0].data[rows,cols],dtype=np.float64)
+        keep &= w>0
+    if sources is not None and len(sources[0])>0:
+        # leave out the pixels near a source (positions are 1-based, as from SExtractor)
+        x,y,r = [np.atleast_1d(np.asarray(a,dtype=np.float64)) for a in sources]
+        r = np.broadcast_to(r,x.shape)
+        tree = cKDTree(np.column_stack([cols+1,rows+1])[keep])
+        near = np.zeros(keep.sum(),dtype=bool)
+        for rad in np.unique(r):
+            this = r==rad
+            for hits in tree.query_ball_point(np.column_stack([x[this],y[this]]),rad):
+                near[hits] = True
+        idx = np.nonzero(keep)[0]
+        keep[idx[near]] = False
+    mean,std = sigma_clipped_stats(vals[keep],w[keep] if (weighted and w is not None) else None,sigma,iters)
+    return {'mean':mean,'std':std,'npix':int(keep.sum())}
+
+def sky_noise(img_fn,wgt_fn=None,sources=None,npix=default_npix,method='random',weighted=False,
+              sigma=2.8,iters=10,seed=0,cache=True,logger=None):
+    '''Measures the background level and noise of an image from a subsample of its pixels.
+    arguments:
+    img_fn (str): the coadd
+    wgt_fn (str): its weight map; pixels with zero weight are left out (default = none)
+    sources (tuple): (x, y, radius) in pixels of the sources to leave out (default = none)
+    npix (int): number of pixels to sample; larger is more accurate and slower
+    method (str): 'random' or 'stride', see the module docstring
+    weighted (bool): weight the statistics by the weight map
+    sigma (float), iters (int): the sigma clipping, as in nddata_stats
+    seed (int): seed of the random sample, so the result is repeatable
+    cache (bool): read and write the result in the .skynoise.json of the coadd
+    returns:
+    mean,std (float): the clipped mean and standard deviation of the background
+    '''
+    if not logger:
+        logger = logging.getLogger(__name__)
+    settings = json.dumps([os.path.basename(wgt_fn) if wgt_fn else None,_sources_key(sources),
+        int(npix),method,bool(weighted),float(sigma),int(iters),int(seed)])
+    cache_fn = img_fn+'.skynoise.json'
+    stat = os.stat(img_fn)
+    stored = {}
+    if cache and os.path.isfile(cache_fn):
+        try:
+            with open(cache_fn) as f:
+                stored = json.load(f)
+        except ValueError:
+            logger.warning('Could not read the sky noise cache %s; remaking it'%cache_fn)
+    if stored.get('mtime_ns')==stat.st_mtime_ns and stored.get('size')==stat.st_size:
+        checksum = stored['checksum']
+    else:
+        checksum = _checksum(img_fn,getheader(img_fn))
+    if stored.get('checksum')!=checksum:
+        stored = {'checksum':checksum,'results':{}}
+    if settings in stored['results'] and stored.get('mtime_ns')==stat.st_mtime_ns:
+        res = stored['results'][settings]
+        logger.info('Using the sky noise of %s from %s'%(img_fn,cache_fn))
+        return res['mean'],res['std']
+    if settings in stored['results']:
+        res = stored['results'][settings]
+        logger.info('%s has been touched but not changed; using its sky noise from %s'%(img_fn,cache_fn))
+    else:
+        res = _measure(img_fn,wgt_fn,sources,npix,method,weighted,sigma,iters,seed)
+        logger.info('Measured the sky noise of %s on %s pixels'%(img_fn,res['npix']))
+        stored['results'][settings] = res
+    stored.update(mtime_ns=stat.st_mtime_ns,size=stat.st_size)
+    if cache:
+        temp_fn = '%s.%s'%(cache_fn,os.getpid())
+        try:
+            with open(temp_fn,'w') as f:
+                json.dump(stored,f,indent=1)
+            os.replace(temp_fn,cache_fn)
+        except OSError:
+            logger.warning('Could not write the sky noise cache %s'%cache_fn)
+    return res['mean'],res['std']
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+'''snobs_config.py: The settings in snobs_params.ini, parsed once per process.
+
+The .ini is read the first time its settings are asked for, and kept as a read-only
+SnobsConfig: the season limits become sorted arrays, so that the season of any number of
+nights (or MJDs) is found with one np.searchsorted, and the data directories, the optimised
+cuts and the other settings are stored as the types they are used as.'''
+
+import os
+import configparser
+import numpy as np
+from types import MappingProxyType
+
+default_config_dir = '/media/data3/wiseman/des/coadding/config'
+default_ini = 'snobs_params.ini'
+
+_configs = {}
+
+def _none_or_float(val):
+    '''Parses a cut, which is a number or None'''
+    if val is None or val.strip() in ['','None','none']:
+        return None
+    return float(val)
+
+class SnobsConfig():
+    '''The settings in snobs_params.ini. They can not be changed once read.'''
+
+    def __init__(self,ini_fn):
+        cp = configparser.ConfigParser(inline_comment_prefixes=('#',))
+        # read the .ini file
+        if not cp.read(ini_fn):
+            raise IOError('Could not read the config file %s'%ini_fn)
+        self.ini_fn = ini_fn
+        years = list(cp['year_night_lims'].keys())
+        years = [y.upper() for y in years]
+        night_lims = np.array([[int(lim) for lim in cp.get('year_night_lims',y).split(',')] for y in years],dtype=np.int64)
+        mjd_lims = np.array([[float(lim) for lim in cp.get('year_mjd_lims',y).split(',')] for y in years])
+        # keep the seasons in order of their start
+        order = np.argsort(night_lims[:,0],kind='stable')
+        self.years = tuple(str(y) for y in np.array(years)[order])
+        self.year_night_lims = night_lims[order]
+        self.year_mjd_lims = mjd_lims[order]
+        for arr in [self.year_night_lims,self.year_mjd_lims]:
+            arr.flags.writeable = False
+        self.data_dirs = MappingProxyType({y:cp.get('data_dirs',y).strip() for y in self.years})
+        cuts = {}
+        for sec in cp.sections():
+            if sec.endswith('_shallow') or sec.endswith('_deep'):
+                band,depth = sec.rsplit('_',1)
+                cuts[(band,depth)] = MappingProxyType({k:_none_or_float(v) for k,v in cp[sec].items()})
+        self.cuts = MappingProxyType(cuts)
+        # disk space (GB) the resampled single-epoch images may take up in temp_dir
+        self.resamp_quota = cp.getfloat('resamp_cache','quota_gb',fallback=200.)
+        # what to extract sources from the stacks with: sex, or sep to do it in memory
+        self.source_backend = cp.get('source','backend',fallback='sex')
+        # also write the init_phot results as a binary table: none, fits or parquet
+        self.result_binary = cp.get('results','binary',fallback='none')
+        self._frozen = True
+
+    def __setattr__(self,name,value):
+        if getattr(self,'_frozen',False):
+            raise AttributeError('SnobsConfig is read-only')
+        object.__setattr__(self,name,value)
+
+    def __reduce__(self):
+        # a copy sent to another process reads the .ini there once, as get_config does
+        return (get_config,(None,self.ini_fn))
+
+    def _year(self,vals,lims):
+        '''The season each value is strictly inside, '' where it is in none'''
+        vals = np.asarray(vals)
+        # the last season that starts before each value
+        i = np.searchsorted(lims[:,0],vals,side='left')-1
+        inside = (i>=0)&(vals<lims[np.clip(i,0,None),1])
+        return np.where(inside,np.array(self.years,dtype=object)[np.clip(i,0,None)],'')
+
+    def night_year(self,nights):
+        '''Returns the season (Y1...) of each night (YYYYMMDD), '' where it is in none'''
+        return self._year(np.asarray(nights).astype(np.int64),self.year_night_lims)
+
+    def mjd_year(self,mjds):
+        '''Returns the season (Y1...) of each MJD, '' where it is in none'''
+        return self._year(np.asarray(mjds,dtype=np.float64),self.year_mjd_lims)
+
+    def get_cuts(self,f,b):
+        '''The optimised teff and psf cuts for a field and band, as a new dict'''
+        depth = 'deep' if f[-1]=='3' else 'shallow'
+        return dict(self.cuts[(b,depth)])
+
+def get_config(config_dir=None,ini=default_ini):
+    '''Returns the settings in ini, which is in config_dir unless it is a path,
+    reading them the first time'''
+    if os.path.split(ini)[0]=='':
+        ini = os.path.join(config_dir or default_config_dir,ini)
+    ini = os.path.abspath(ini)
+    if ini not in _configs:
+        _configs[ini] = SnobsConfig(ini)
+    return _configs[ini]
@@ -8,12 +8,14 @@ import os
 import logging
 from shutil import copyfile
 import time
-import subprocess
-import _pickle as cpickle
-import easyaccess as ea
 import glob
 from astropy.table import Table
 
+from des_stacks.utils.tool_runner import run_tool, tool_log
+from des_stacks.utils.sep_tools import sep_extract, write_catalog
+from des_stacks.utils.chip_index import get_chip_index
+from des_stacks.utils.header_cache import getheader
+
 def source_for_psfex(s,chip,cuts=None):
     '''Runs source extractor on a certain stacked frame, to send to PSFex'''
     logger = logging.getLogger(__name__)
@@ -46,23 +48,17 @@ def source_for_psfex(s,chip,cuts=None):
             img = band_dir+'/ccd_%s.fits'%chip
         else:
             img = os.path.join(band_dir,'ccd_%s_%s_%s_clipweighted_sci.fits'%(chip,s.band,s.cutstring))
-    os.chdir(os.path.join(band_dir,chip,'psf'))
+    psf_dir = os.path.join(band_dir,chip,'psf')
     #run source extractor
     logger.info('Got as far as starting source extractor')
-    source_cmd = ['sex','-CATALOG_NAME',sourcecat,'-CATALOG_TYPE','FITS_LDAC',img]
-    start = float(time.time())
-    try:
-        logger.info("Running source extractor on {0}".format(img))
-        source_process = subprocess.Popen(source_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        out,errs = source_process.communicate()
-        end = float(time.time())
-        logger.info("Successfully ran source extractor on {0}".format(img))
-        logger.info("Took %.2f seconds" %(end - start))
-        logger.info("Saved at {0}".format(sourcecat))
-        return sourcecat
-    except (OSError, IOError):
+    source_cmd = ['sex',img,'-CATALOG_NAME',sourcecat,'-CATALOG_TYPE','FITS_LDAC']
+    ret = run_tool(source_cmd,cwd=psf_dir,log_fn=tool_log(s,'%s_%s_%s_%s_%s_sex_psf'%(s.my,s.field,s.band,chip,s.cutstring)),
+        logger=logger,what="Running source extractor on {0}".format(img))
+    if ret is None:
         logger.info("source extractor failed...")
         return None
+    logger.info("Saved at {0}".format(sourcecat))
+    return sourcecat
 
 def psfex(s,chip,retval='FWHM',cuts=None):
     '''Runs PSFex on a source exetracted catalog to get the PSF Model'''
@@ -82,19 +78,14 @@ def psfex(s,chip,retval='FWHM',cuts=None):
     init_cat = os.path.join(band_dir,chip,'%s_%s_temp.sourcecat'%(chip,s.band))
     logger.info("Getting the PSF from the stack")
     logger.info("Running PSFex on %s" %init_cat)
-    start =float(time.time())
-    psfex_cmd = ['psfex', init_cat]
-    os.chdir(os.path.join(band_dir,chip))
-    psf_process = subprocess.Popen(psfex_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    out,errs = psf_process.communicate()
-    end = float(time.time())
-    logger.info("Successfully made the PSF model")
-    logger.info("Took %.2f secconds" % (end-start))
+    psfex_cmd = ['psfex', init_cat,'-PSF_DIR',os.path.join(band_dir,chip)]
+    run_tool(psfex_cmd,cwd=os.path.join(band_dir,chip),log_fn=tool_log(s,'%s_%s_%s_%s_%s_psfex'%(s.my,s.field,s.band,chip,s.cutstring)),
+        logger=logger,what='Making the PSF model')
     copyfile(os.path.join(band_dir,chip,'%s_%s_temp.psf'%(chip,s.band)),os.path.join(band_dir,chip,'ana','default.psf'))
     if retval == 'FWHM':
 
         psf_out = os.path.join(band_dir,chip,'ana','default.psf')
-        h = fits.getheader(psf_out,ext=1)
+        h = getheader(psf_out,ext=1)
         fwhm = h['PSF_FWHM']*0.27 #convert from pixels to arcsec using DES chip pixel scale of 0.27 pix/arcsec
         return fwhm
 
@@ -114,7 +105,6 @@ def source_for_cat(s,chip,cuts = None):
     logger.addHandler(ch)
     band_dir = os.path.join(s.out_dir, 'MY%s' %s.my, s.field, s.band)
     ana_dir = os.path.join(band_dir,chip,'ana')
-    os.chdir(ana_dir)
     if not cuts:
         sourcecat = os.path.join(ana_dir,'MY%s_%s_%s_%s.sourcecat' %(s.my,s.field,s.band,chip))
     else:
@@ -135,27 +125,74 @@ def source_for_cat(s,chip,cuts = None):
             img = band_dir+'/ccd_%s.fits'%chip
         else:
             img = os.path.join(band_dir,'ccd_%s_%s_%s_clipweighted_sci.fits'%(chip,s.band,s.cutstring))
-    logger.info("Starting source extraction using the modelled PSF")
-    start = float(time.time())
-    source_cmd = ['sex','-CATALOG_NAME',sourcecat,img]
-    try:
-        logger.info("Running source extractor on {0}".format(img))
-        source_process = subprocess.Popen(source_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        out,errs = source_process.communicate()
-        logger.info("Successfully ran source extractor on {0}".format(img))
-        end = float(time.time())
-        logger.info("Took %.2f seconds" % (end-start))
+    if getattr(s,'source_backend','sex')=='sep':
+        logger.info("Extracting sources from {0} with SEP".format(img))
+        wgt = img.replace('_sci.fits','_wgt.fits')
+        cat = sep_extract(img,os.path.join(ana_dir,'default.sex'),wgt_fn=wgt if wgt!=img else None,logger=logger)
+        # keep the catalogue on disk too, but hand it on from memory
+        write_catalog(cat,sourcecat)
         logger.info("Saved at {0}".format(sourcecat))
-        return sourcecat
-    except (OSError, IOError):
+        return cat
+    logger.info("Starting source extraction using the modelled PSF")
+    source_cmd = ['sex',img,'-CATALOG_NAME',sourcecat]
+    ret = run_tool(source_cmd,cwd=ana_dir,log_fn=tool_log(s,'%s_%s_%s_%s_%s_sex'%(s.my,s.field,s.band,chip,s.cutstring)),
+        logger=logger,what="Running source extractor on {0}".format(img))
+    if ret is None:
         logger.info("source extractor failed...")
         return None
+    logger.info("Saved at {0}".format(sourcecat))
+    return sourcecat
 
-def get_sn_dat(sn_name = None, snid = None):
-    f=open('/media/data3/wiseman/des/coadding/config/chiplims.pkl','rb')
-    chiplims = cpickle.load(f)
+def load_sncand():
+    '''Reads the table of SN candidates'''
+    return pd.read_csv('/media/data3/wiseman/des/coadding/catalogs/sncand_db.csv')
 
-    sncand = pd.read_csv('/media/data3/wiseman/des/coadding/catalogs/sncand_db.csv')
+def load_chiplims():
+    '''Returns the index of the chips of every field'''
+    return get_chip_index()
+
+def get_sn_dats(sn_names,sncand = None, chiplims = None):
+    '''Returns ra, dec, field, season and chip of many SNe in one go.
+    arguments:
+    sn_names (list): SNIDs or transient names
+    sncand (DataFrame): the SN candidates (default = read them)
+    chiplims (ChipIndex): the chips (default = load them)
+    returns:
+    sns (DataFrame): ra, dec, field, season and chip, indexed by the names that were found on a chip
+    '''
+    if chiplims is None:
+        chiplims = load_chiplims()
+    if sncand is None:
+        sncand = load_sncand()
+    by_snid = pd.Series(np.arange(len(sncand)),index=sncand['snid'].values)
+    by_snid = by_snid[~by_snid.index.duplicated()]
+    by_name = pd.Series(np.arange(len(sncand)),index=sncand['transient_name'].values)
+    by_name = by_name[~by_name.index.duplicated()]
+    rows = []
+    for sn_name in sn_names:
+        try:
+            row = by_snid.get(int(sn_name))
+        except (ValueError,TypeError):
+            row = None
+        if row is None:
+            row = by_name.get(sn_name)
+        rows.append(-1 if row is None else row)
+    rows = np.array(rows,dtype=int)
+    names = np.array(list(sn_names),dtype=object)[rows>=0]
+    dat = sncand.iloc[rows[rows>=0]]
+    obj_fields = dat['field'].astype(str).str.strip(' ').values
+    field,ccd,x,y = chiplims.locate(dat['ra'].values,dat['dec'].values,fields=obj_fields)
+    sns = pd.DataFrame({'ra':dat['ra'].values,'dec':dat['dec'].values,'field':field,
+        'season':dat['season'].values,'chip':ccd},index=names)
+    return sns[pd.notnull(field)]
+
+def get_sn_dat(sn_name = None, snid = None, sncand = None, chiplims = None):
+    '''Returns ra, dec, field, season and chip of a SN.
+    sncand and chiplims can be passed in to save reading them again for every SN'''
+    if chiplims is None:
+        chiplims = load_chiplims()
+    if sncand is None:
+        sncand = load_sncand()
 
     if snid:
         dat = sncand[sncand['snid']==snid]
@@ -167,24 +204,13 @@ def get_sn_dat(sn_name = None, snid = None):
 
     #################
     obj_field = dat['field'].values[0].strip(' ')
-    if len(obj_field)>2:
-        obj_field = obj_field.split(',')[0]
-    the_field = chiplims[obj_field]
-    try:
-        for ccd in the_field.keys():
-            if the_field[ccd][0][0] > ra > the_field[ccd][2][0]:
-                if the_field[ccd][0][1] < dec < the_field[ccd][1][1]:
-                    return (ra,dec,'SN-%s'%obj_field,y,ccd)
-
-        if len(obj_field)>2:
-            obj_field = obj_field.split(',')[1]
-        the_field = chiplims[obj_field]
-        for ccd in the_field.keys():
-            if the_field[ccd][0][0] > ra > the_field[ccd][2][0]:
-                if the_field[ccd][0][1] < dec < the_field[ccd][1][1]:
-                    return (ra,dec,'SN-%s'%obj_field,y,ccd)
-    except KeyError:
+    if obj_field.split(',')[0] not in chiplims.chiplims:
         return False
+    field,ccd,x,y_pix = chiplims.locate(ra,dec,fields=obj_field)
+    if field[0] is None:
+        return None
+    return (ra,dec,field[0],y,ccd.tolist()[0])
+
 def cap_source_sn(sg,sr,si,sz,chip,sn_name,leave_if_done = False):
     '''Runs source extractor in dual image mode to get common aperture photometry'''
     logger = logging.getLogger(__name__)
@@ -197,8 +223,7 @@ def cap_source_sn(sg,sr,si,sz,chip,sn_name,leave_if_done = False):
     logger.addHandler(ch)
     # get to the right directory
     sn_dir = os.path.join(sg.out_dir,'CAP',sn_name)
-    os.chdir(sn_dir)
-    white_name = sn_name+'_white_stamp.fits'
+    white_name = os.path.join(sn_dir,sn_name+'_white_stamp.fits')
     # get the right config files in the directory
     for ext in ['sex','param','conv','nnw']:
         copyfile(os.path.join(sg.config_dir,'cap','default.%s'%ext),os.path.join(sn_dir,'default.%s'%ext))
@@ -211,9 +236,8 @@ def cap_source_sn(sg,sr,si,sz,chip,sn_name,leave_if_done = False):
             glob_string = os.path.join(sn_dir,'ccd_%s_%s_*_sci.resamp.fits'%(str(chip),s.band))
             resamp_name = glob.glob(glob_string)[0]
             source_cmd = ['sex','-CATALOG_NAME',sourcecat,'%s,%s'%(white_name,resamp_name)]
-            logger.info('Running source extractor in dual image mode in order to get common aperture photometry in the %s band'%s.band)
-            source_process = subprocess.Popen(source_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            out,errs = source_process.communicate()
+            run_tool(source_cmd,cwd=sn_dir,log_fn=tool_log(sg,'%s_%s_cap'%(sn_name,s.band)),logger=logger,
+                what='Running source extractor in dual image mode in order to get common aperture photometry in the %s band'%s.band)
             logger.info('Dual image source extractor complete in the %s band: you now have common aperture photometry on chip %s!'%(s.band,chip))
         sourcecats[s.band]=sourcecat
     return sourcecats
@@ -233,7 +257,6 @@ def cap_source_chip(sg,sr,si,sz,chip):
     cap_chip_dir = os.path.join(sg.out_dir,'MY%s'%sg.my,sg.field,'CAP',str(chip))
     if not os.path.isdir(cap_chip_dir):
         os.mkdir(cap_chip_dir)
-    os.chdir(cap_chip_dir)
     # get the right config files in the directory
     for ext in ['sex','param','conv','nnw']:
         copyfile(os.path.join(sg.config_dir,'cap','default.%s'%ext),os.path.join(cap_chip_dir,'default.%s'%ext))
@@ -245,7 +268,7 @@ def cap_source_chip(sg,sr,si,sz,chip):
             s.run_stack_source(cuts=s.cuts,final=True)
             quals= np.loadtxt(os.path.join(s.band_dir,str(chip),'ana','%s_ana.qual'%s.cutstring))
         zp = float(quals[0])
-        riz_name = '%s_%s_%s_riz.fits'%(s.my,s.field,chip)
+        riz_name = os.path.join(cap_chip_dir,'%s_%s_%s_riz.fits'%(s.my,s.field,chip))
         sourcecat = os.path.join(cap_chip_dir,'%s_%s_%s_%s_cap_sci.sourcecat'%(s.my,s.field,chip,s.band))
         redo = False
         if os.path.isfile(sourcecat):
@@ -268,6 +291,12 @@ def cap_source_chip(sg,sr,si,sz,chip):
             glob_string = os.path.join(cap_chip_dir,'ccd_%s_%s_%s*_clipweighted*.resamp.fits'%(str(chip),s.band,s.cutstring))
             logger.debug('Searching for files that look like: \n %s'%glob_string)
             resamp_name = glob.glob(glob_string)[0]
+            if getattr(sg,'source_backend','sex')=='sep':
+                logger.info('Extracting sources on %s and measuring them in the %s band with SEP'%(riz_name,s.band))
+                cat = sep_extract(resamp_name,os.path.join(cap_chip_dir,'default.sex'),det_fn=riz_name,zp=zp,logger=logger)
+                write_catalog(cat,sourcecat)
+                sourcecats[s.band]=sourcecat
+                continue
             check_name = os.path.join(cap_chip_dir,'%s_%s_%s_%s_check_aper.fits'%(s.my,s.field,chip,s.band))
             source_cmd = [
             'sex',
@@ -277,10 +306,8 @@ def cap_source_chip(sg,sr,si,sz,chip):
             '-CHECKIMAGE_NAME',check_name,
             '%s,%s'%(riz_name,resamp_name)
             ]
-            logger.info('Running source extractor in dual image mode in order to get common aperture photometry in the %s band'%s.band)
-            logger.debug(source_cmd)
-            source_process = subprocess.Popen(source_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            out,errs = source_process.communicate()
+            run_tool(source_cmd,cwd=cap_chip_dir,log_fn=tool_log(sg,'%s_%s_%s_%s_cap'%(s.my,s.field,chip,s.band)),logger=logger,
+                what='Running source extractor in dual image mode in order to get common aperture photometry in the %s band'%s.band)
             logger.info('Dual image source extractor complete in the %s band: you now have common aperture photometry on chip %s!'%(s.band,chip))
         sourcecats[s.band]=sourcecat
         logger.info('Returning sourcecats for %s,%s,%s,%s'%(sg.my,sg.field,chip,sg.band))
@@ -2,19 +2,34 @@
 
 import numpy as np
 import pandas as pd
-import seaborn as sns
 from astropy.table import Table
 from astropy.io import fits
 from astropy.time import Time
-import matplotlib.pyplot as plt
 import datetime
-import configparser
 import os
 import glob
 import logging
 import time
 import subprocess
-import _pickle as cpickle
+import json
+import multiprocessing
+import threading
+
+from des_stacks.utils.obs_index import get_obs_index
+from des_stacks.utils.info_cache import get_info
+from des_stacks.utils.resamp_cache import get_resamp_cache
+from des_stacks.utils.scheduler import get_total_memory
+from des_stacks.utils.tool_runner import run_tool, tool_log, tool_xml
+from des_stacks.utils.chip_index import get_chip_index
+from des_stacks.utils.snobs_config import get_config
+from des_stacks.utils.header_cache import getheader, get_headers
+
+# pixel scale (arcsec) of the grid the single-epoch images are resampled onto
+resamp_pixel_scale = 0.263
+# bytes of one resampled frame and its weightmap (float32) on that grid
+resamp_frame_bytes = 4200*2200*4*2
+# most frames to clip together in one part of a chip
+max_part_frames = 100
 
 def make_good_frame_list(s,cuts={'teff':0.2, 'zp':None,'psf':None}):
     """Returns a list of images for a certain chip that are of quality better than a given cut.
@@ -48,133 +63,66 @@ def make_good_frame_list(s,cuts={'teff':0.2, 'zp':None,'psf':None}):
     ch.setFormatter(formatter)
     logger.addHandler(ch)
     logger.info('Initiating make_good_frame_list.py')
-    info = s.info_df
     import math
-    band,field,cuts = s.field,s.band,s.cuts
-    info = info[info['FIELD']==field]
+    field,band,cuts = s.field,s.band,s.cuts
+    info_fn = os.path.join(s.config_dir,'snobsinfo.fits')
+    info = get_info(info_fn,field,logger=logger)
     logger.info('These are the bands available for field {0}'.format(field))
-    logger.info(info.BAND.unique())
-    info = info[info['BAND']==band]
+    logger.info(list(info.BAND.unique()))
+    info = get_info(info_fn,field,band,logger=logger)
     logger.info(cuts)
 
     if cuts['zp']!= 'None' and cuts['zp']!= None:
         logger.warning('Gone to do ZP residuals, not sure you want this.')
         logger.info(cuts['zp'])
-        info['ZP_EXPRES']=''
-        for counter,exp in enumerate(info.EXPNUM.unique()):
-            this_exp = info[info['EXPNUM']==exp]
-            exp_idx = this_exp.index
-            med_zp = this_exp['CHIP_ZERO_POINT'].median()
-            info.loc[exp_idx,'ZP_EXPRES'] = this_exp['CHIP_ZERO_POINT']-med_zp
-
-        logger.info('Here is the column of initial residuals for each exposure')
-        logger.info(info['ZP_EXPRES'])
-        ######################################################
-        ## 2
-        ## Calculate the average residual from part 1 over all exposures for that chip (field,band)
-        logger.info('Getting the median zeropoint residual for all exposures for each chip')
-        info['ZP_ADJ1'] = ''
-        info['ZP_SIG_ADJ1'] = ''
-        for counter, chip in enumerate(info.CCDNUM.unique()):
-
-            this_chip = info[info['CCDNUM']==chip]
-            chip_idx = this_chip.index
-            med_zp = this_chip['ZP_EXPRES'].median()
-            sig_chip_zps = this_chip['ZP_EXPRES'].std()
-            ## 3
-            ## Subtract that average residual from the given ZP to give an adjusted ZP
-            info.loc[chip_idx,'ZP_ADJ1']=this_chip['CHIP_ZERO_POINT']-med_zp
-            info.loc[chip_idx,'ZP_SIG_ADJ1']=sig_chip_zps
-        logger.debug('Here is the column of adjusted zeropoints')
-        logger.debug(info['ZP_ADJ1'])
-        #####################################################
-        ## 4
-        ## Subtract the average ZP for each year off the individual zps for that year
-
-        years =[1,2,3,4,5]
-        info['ZP_RES']=''
-        for year in years:
-            logger.info('Subtracting the median zeropoint for {0} from all exposures that year'.format(year))
-            this_year = info[info['YEAR']==year]
-            year_idx = this_year.index
-            year_med = this_year['ZP_ADJ1'].median()
-            year_sig = this_year['ZP_ADJ1'].std()
-            final_resid = this_year['ZP_ADJ1']-year_med
-            info.loc[year_idx,'ZP_RES']=final_resid
-
-        #####################################################################
-        ## 5
-        ## Now cut exposures (field,band,chip) based on whether they make the cut and return them
-        logger.info('Getting rid of exposures whose ZP residual is below {0}'.format(zp_cut))
-        exps = info.EXPNUM.unique()
-        zp_cut     = float(zp_cut)
+        zp_cut = float(cuts['zp'])
         if cuts['psf']:
             psf_cut = float(cuts['psf'])
-        nbad = 15
-        good_exps = []
-        good_frame = pd.DataFrame()
-        for exp in exps:
-            this_exp = info[info['EXPNUM']==exp]
-            logger.debug('Cutting in exposure {0}'.format(exp))
-            resids = this_exp['ZP_RES']
-            resids = resids.as_matrix()
-
-            bad_resids = 0
-            reformatted_resids = []
-            for i in range(len(resids)):
-                res = resids[i]
-                res = float(res)
-                reformatted_resids.append(res)
-                if float(res)<zp_cut:
-                    bad_resids +=1
-            this_exp['ZP_RES']=np.array(reformatted_resids)
-            logger.debug('Number of frames in exposure {0} that fail the ZP cut: {1}'.format(exp,bad_resids))
-            bads =bad_resids+len(this_exp[this_exp['PSF_NEA']>psf_cut])
-            logger.info("Number of frames failing the combined ZP and PSF cut: %s" %bads)
-            if bads <nbad:
-                #is a good frame
-                logger.debug('...is a good frame!')
-                good_exps.append(exp)
-
-                good_frame = good_frame.append(this_exp)
+        else:
+            psf_cut = 5
+        exps = info.EXPNUM.unique()
+        logger.info('Getting rid of exposures whose ZP residual is below {0}'.format(zp_cut))
+        good_frame,good_exps = select_good_frames_zp(info,zp_cut,psf_cut)
         good_fn = os.path.join(s.list_dir,'good_exps_%s_%s_%s_%s.fits'%(field,band,zp_cut,psf_cut))
         logger.info("%s exposures were rejected!" %(len(exps)-len(good_exps)))
     ## Save results
     elif -1 < cuts['teff'] < 500:
         logger.info('Doing the cut based on T_eff > %s'%cuts['teff'])
-        good_frame = pd.DataFrame()
-        good_exps = []
-
-        for counter,exp in enumerate(info.EXPNUM.unique()):
+        good_frame,good_exps = select_good_frames_teff(info,[(cuts['teff'],cuts['psf'])])[0]
+        good_fn = os.path.join(s.list_dir,'good_exps_%s_%s_%s_%s.csv'%(field,band,cuts['teff'],cuts['psf']))
+    good_frame = write_good_frame_list(good_frame,good_exps,good_fn,logger)
+    return good_frame
 
-            this_exp = info[info['EXPNUM']==exp]
-            exp_idx = this_exp.index
-            try:
-                t_eff = this_exp['T_EFF'].values[0]
-            except:
-                t_eff = 2
-            if t_eff < -1:
-                t_eff = 2
-            elif not t_eff:
-                t_eff = 2
-            try:
-                fwhm = this_exp['FWHM_ASEC'].values[0]
-            except:
-                fwhm = 2
-            if fwhm < -1:
-                fwhm = 5
-            elif not fwhm:
-                fwhm = 5
-            if not cuts['psf']:
-                psf_cut=5
-            else:
-                psf_cut = cuts['psf']
+def make_good_frame_lists(s,cut_pairs):
+    """Makes the lists of good exposures for several T_eff and PSF cuts at once,
+    e.g. for every point of an optimisation grid.
+    Arguments:
+    s (obj): Stack object
+    cut_pairs (list): (teff, psf) cuts to make lists for
 
-            if t_eff > cuts['teff'] and len(this_exp[this_exp['PSF_NEA']>psf_cut])<15 :
-                this_exp['T_EFF']= t_eff
-                good_frame = good_frame.append(this_exp)
-                good_exps.append(exp)
-        good_fn = os.path.join(s.list_dir,'good_exps_%s_%s_%s_%s.csv'%(field,band,cuts['teff'],cuts['psf']))
+    Returns:
+    good_frames (list): A reduced DataFrame of good exposures for each pair of cuts
+    """
+    logger = logging.getLogger(__name__)
+    logger.handlers =[]
+    logger.setLevel(logging.DEBUG)
+    formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    field,band = s.field,s.band
+    info = get_info(os.path.join(s.config_dir,'snobsinfo.fits'),field,band,logger=logger)
+    logger.info('Making good frame lists for %s %s with %s pairs of cuts'%(field,band,len(cut_pairs)))
+    good_frames = []
+    for (teff_cut,psf_cut),(good_frame,good_exps) in zip(cut_pairs,select_good_frames_teff(info,cut_pairs)):
+        good_fn = os.path.join(s.list_dir,'good_exps_%s_%s_%s_%s.csv'%(field,band,teff_cut,psf_cut))
+        good_frames.append(write_good_frame_list(good_frame,good_exps,good_fn,logger))
+    return good_frames
+
+def write_good_frame_list(good_frame,good_exps,good_fn,logger):
+    '''Writes out a good frame list along with a text file of its exposure numbers,
+    and returns the frame as written'''
     txtname = good_fn[:-4]+'txt'
     np.savetxt(txtname,good_exps,fmt='%s')
     logger.info('Writing out good exposure list to {0}'.format(good_fn))
@@ -186,8 +134,106 @@ def make_good_frame_list(s,cuts={'teff':0.2, 'zp':None,'psf':None}):
     good_frame.to_csv(good_fn)
     return good_frame
 
-def make_swarp_cmds(s,chip,logger = None,cuts={'teff':0.2, 'zp':None,'psf':None},final=True):
-    """function to make swarp command to stack Nminus1_year, field chip, band"""
+def _order_by_exposure(info):
+    '''Returns the positions that put the rows of info in order of exposure, with the
+    exposures in the order they first appear (as a loop over EXPNUM.unique() would)'''
+    codes = pd.factorize(info['EXPNUM'])[0]
+    return np.argsort(codes,kind='stable')
+
+def select_good_frames_zp(info,zp_cut,psf_cut,nbad=15):
+    '''Selects the exposures whose chips pass the zeropoint residual and PSF cuts.
+    The residual of each chip is taken relative to the median of its exposure, then the
+    median residual of that chip over all exposures, then the median of its year.
+    arguments:
+    info (DataFrame): the snobsinfo rows for a single field and band
+    zp_cut (float): chips with a final zeropoint residual below this are bad
+    psf_cut (float): chips with PSF_NEA above this are bad
+    nbad (int): exposures are rejected when they have this many bad chips
+    returns:
+    good_frame (DataFrame): the rows of the good exposures, with the residual columns
+    good_exps (list): the good exposure numbers
+    '''
+    info = info.copy()
+    zp = info['CHIP_ZERO_POINT'].astype(float)
+    info['ZP_EXPRES'] = zp - zp.groupby(info['EXPNUM']).transform('median')
+    by_chip = info['ZP_EXPRES'].groupby(info['CCDNUM'])
+    info['ZP_ADJ1'] = zp - by_chip.transform('median')
+    info['ZP_SIG_ADJ1'] = by_chip.transform('std')
+    in_years = info['YEAR'].isin([1,2,3,4,5])
+    adj = info['ZP_ADJ1'].where(in_years)
+    info['ZP_RES'] = adj - adj.groupby(info['YEAR']).transform('median')
+    # a chip failing both cuts counts twice
+    bads = (info['ZP_RES']<zp_cut).astype(int) + (info['PSF_NEA']>psf_cut).astype(int)
+    good = (bads.groupby(info['EXPNUM']).transform('sum')<nbad).values
+    order = _order_by_exposure(info)
+    good_frame = info.iloc[order[good[order]]]
+    good_exps = list(good_frame['EXPNUM'].unique())
+    return good_frame,good_exps
+
+def select_good_frames_teff(info,cut_pairs,nbad=15):
+    '''Selects the exposures that pass pairs of T_eff and PSF cuts, in one pass over the table.
+    The T_eff of an exposure is taken from its first chip; values below -1 or zero are
+    replaced by 2 as before. A missing PSF cut means 5.
+    arguments:
+    info (DataFrame): the snobsinfo rows for a single field and band
+    cut_pairs (list): (teff, psf) cuts; exposures need T_EFF > teff
+    nbad (int): exposures are rejected when they have this many chips with PSF_NEA > psf
+    returns:
+    good_frames (list): a (good_frame, good_exps) tuple for each pair of cuts
+    '''
+    info = info.iloc[_order_by_exposure(info)]
+    expnums = info['EXPNUM'].values
+    first = info.drop_duplicates('EXPNUM')
+    t_eff = first['T_EFF'].astype(float).values
+    t_eff = np.where((t_eff<-1)|(t_eff==0),2,t_eff)
+    t_eff = pd.Series(t_eff,index=first['EXPNUM'].values).reindex(expnums).values
+    n_psf_bad = {}
+    good_frames = []
+    for teff_cut,psf_cut in cut_pairs:
+        if not psf_cut:
+            psf_cut = 5
+        if psf_cut not in n_psf_bad:
+            n_psf_bad[psf_cut] = (info['PSF_NEA']>psf_cut).groupby(expnums).transform('sum').values
+        good = (t_eff>teff_cut)&(n_psf_bad[psf_cut]<nbad)
+        good_frame = info[good].copy()
+        good_frame['T_EFF'] = t_eff[good]
+        good_frames.append((good_frame,list(good_frame['EXPNUM'].unique())))
+    return good_frames
+
+def plan_parts(n_frames,frame_bytes=resamp_frame_bytes,mem=None,ncores=None,max_frames=max_part_frames,threads=4):
+    '''Works out how many parts to split the frames of a chip into, and how big each one is.
+    The memory budget is shared between the parts that can be stacked at once on ncores
+    (threads each), and a part holds no more frames than fit in its share, or max_frames.
+    The frames are then spread as evenly as possible over the parts.
+    arguments:
+    n_frames (int): number of frames to stack
+    frame_bytes (int): bytes of one resampled frame and its weightmap
+    mem (float): memory budget in MB (default = 80% of the machine)
+    ncores (int): number of cores (default = all of them)
+    returns:
+    plan (dict): nparts, sizes and part_mem (MB) along with the inputs
+    '''
+    mem = mem or 0.8*get_total_memory()
+    ncores = ncores or multiprocessing.cpu_count()
+    concurrent = max(1,ncores//threads)
+    part_mem = mem/concurrent
+    fit = max(1,int(part_mem*1024.**2//frame_bytes))
+    per_part = min(fit,max_frames)
+    nparts = max(1,int(np.ceil(n_frames/per_part)))
+    sizes = [len(p) for p in np.array_split(np.arange(n_frames),nparts)]
+    return {'n_frames':n_frames,'frame_bytes':frame_bytes,'mem':mem,'ncores':ncores,
+            'max_frames':per_part,'part_mem':max(sizes)*frame_bytes/1024.**2,
+            'nparts':nparts,'sizes':sizes}
+
+def read_part_plan(s,chip):
+    '''Reads the plan make_swarp_cmds made for the parts of a chip'''
+    plan_fn = os.path.join(s.list_dir,'%s_%s_%s_%s_%s.plan.json'%(s.my,s.field,s.band,chip,s.cutstring))
+    with open(plan_fn) as f:
+        return json.load(f)
+
+def make_swarp_cmds(s,chip,logger = None,cuts={'teff':0.2, 'zp':None,'psf':None},final=True,do_resample=True):
+    """function to make swarp command to stack Nminus1_year, field chip, band
+    If do_resample is False, the resampling of the inputs is left to the caller"""
     MY,field,band = s.my,s.field,s.band
     cuts = s.cuts
     if not os.path.isdir(os.path.join(s.out_dir,'MY%s'%MY,field,band)):
@@ -216,30 +262,34 @@ def make_swarp_cmds(s,chip,logger = None,cuts={'teff':0.2, 'zp':None,'psf':None}
     stack_fns = {}
     logger.info('Adding files to the %s, %s band, chip %s stack'%(field, band,chip))
     good_band_my.sort_values('CHIP_ZERO_POINT',ascending=False,inplace=True)
-    n,l=0,0
-    stack_fns[0]=[]
+    all_fns = []
     nights = []
+    # the night of each exposure, and the seasons of all of them in one go
+    exp_nites = good_band_my.drop_duplicates('EXPNUM').set_index('EXPNUM')['NITE'].loc[good_my_exps].values
+    exp_years = get_des_obs_year(exp_nites,logger,getattr(s,'config',None))
     for counter,exp in enumerate(good_my_exps):
 
-        this_exp = good_band_my[good_band_my['EXPNUM']==exp]
-        first = this_exp.iloc[0]
-        night = str(first['NITE'])
+        night = str(exp_nites[counter])
         #chip = first['CCDNUM']
 
-        this_exp_fn = get_dessn_obs(s,night,exp,chip,logger)
+        this_exp_fn = get_dessn_obs(s,night,exp,chip,logger,year=exp_years[counter])
         #logger.info("Adding file from %s" %night)
         if night not in nights:
             if this_exp_fn:
                 nights.append(night)
-                for fn in this_exp_fn:
-                    n+=1
-                    stack_fns[l].append(fn)
-
-                    if n%100.0 == 0:
-                        l+=1
-                        stack_fns[l]=[]
+                all_fns+=list(this_exp_fn)
+    # split the frames into evenly sized parts that fit in memory
+    plan = plan_parts(len(all_fns),mem=getattr(s,'stack_mem',None),ncores=getattr(s,'stack_ncores',None))
+    bounds = np.cumsum([0]+plan['sizes'])
+    for j in range(plan['nparts']):
+        stack_fns[j] = all_fns[bounds[j]:bounds[j+1]]
+    plan['parts'] = {str(j):list(stack_fns[j]) for j in stack_fns}
+    plan_fn = os.path.join(s.list_dir,'%s_%s_%s_%s_%s.plan.json'%(MY,field,band,chip,s.cutstring))
+    with open(plan_fn,'w') as f:
+        json.dump(plan,f,indent=1)
+    logger.info('Stacking %s frames of chip %s in %s parts of %s frames'%(len(all_fns),chip,plan['nparts'],plan['sizes']))
     cmd_list = {}
-    for j in range(0,l+1):
+    for j in range(0,plan['nparts']):
         fns = np.array(stack_fns[j])
         fn_list = os.path.join(s.temp_dir,\
         'stack_fns_MY%s_%s_%s_%s_%s_%s.lst' %(MY,field,band,chip,s.cutstring,j))
@@ -259,7 +309,11 @@ def make_swarp_cmds(s,chip,logger = None,cuts={'teff':0.2, 'zp':None,'psf':None}
 
         weightout_name = fn_out[:-4]+'wgt.fits'
         nofiles = 0
-        if not os.path.isfile(headerlist_name):
+        if not do_resample:
+            if len(fns)==0:
+                logger.info("No files in list: %s" %fn_list)
+                nofiles = 1
+        elif not os.path.isfile(headerlist_name):
             logger.info("%s, %s band, chip %s: Going to do resampling!"%(field,band,chip))
             try:
                 weightlist_name,resamplist_name,headerlist_name = resample(s,fn_list,MY,chip,cuts,j,logger)
@@ -290,6 +344,7 @@ def make_swarp_cmds(s,chip,logger = None,cuts={'teff':0.2, 'zp':None,'psf':None}
                 '@%s'%resamplist_name,
                 '-RESAMPLE','N',
                 '-IMAGEOUT_NAME',fn_out,
+                '-WEIGHTOUT_NAME',weightout_name,
                 '-CLIP_LOGNAME',cliptab_name,
                 '-CLIP_SIGMA',str(clip_sigs[s.field])
                 ]
@@ -303,7 +358,8 @@ def make_swarp_cmds(s,chip,logger = None,cuts={'teff':0.2, 'zp':None,'psf':None}
                 '-COMBINE_TYPE', 'WEIGHTED',
                 '-WEIGHT_TYPE', 'MAP_WEIGHT',
                 '-WEIGHT_IMAGE', '@%s'%maskweightlist_name,
-                '-IMAGEOUT_NAME', fn_out.replace('clipped.fits','weighted.fits')
+                '-IMAGEOUT_NAME', fn_out.replace('clipped.fits','weighted.fits'),
+                '-WEIGHTOUT_NAME', weightout_name.replace('clipped.wgt.fits','weighted.wgt.fits')
                 ]
                 if os.path.isfile(fn_out):
                     cmd_list[j] = (False,swarp_weight,fn_out)
@@ -317,54 +373,27 @@ def make_swarp_cmds(s,chip,logger = None,cuts={'teff':0.2, 'zp':None,'psf':None}
     return cmd_list
 #############################################
 
-def get_des_obs_year(night,logger=None):
-    if not logger:
-        logger = logging.getLogger(__name__)
-        logger.handlers =[]
-        logger.setLevel(logging.DEBUG)
-        formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(formatter)
-        logger.addHandler(ch)
-    night = int(night)
-    cp=configparser.ConfigParser()
-    # read the .ini file
-    cp.read('/media/data3/wiseman/des/coadding/config/snobs_params.ini')
-    # Make a list of years
-    years= ['Y1','Y2','Y3','Y4','Y5']
-    year_night_lims = {}
-    for y in years:
-        year_night_lim = cp.get('year_night_lims',y)
-        year_night_lims[y]=[int(lim.strip()) for lim in year_night_lim.split(',')]
-    if ((night > year_night_lims['Y1'][0]) and
-        (night < year_night_lims['Y1'][1])):
-        year = 'Y1'
-    elif ((night > year_night_lims['Y2'][0]) and
-          (night < year_night_lims['Y2'][1])):
-        year = 'Y2'
-    elif ((night > year_night_lims['Y3'][0]) and
-          (night < year_night_lims['Y3'][1])):
-        year = 'Y3'
-    elif ((night > year_night_lims['Y4'][0]) and
-          (night < year_night_lims['Y4'][1])):
-        year = 'Y4'
-    elif ((night > year_night_lims['Y5'][0]) and
-          (night < year_night_lims['Y5'][1])):
-        year = 'Y5'
-    else:
-        raise ValueError
+def get_des_obs_year(night,logger=None,config=None):
+    '''Returns the season (Y1...) of a night, or of an array of nights.
+    config is the SnobsConfig to take the season limits from (default = the one in coadding/config)'''
+    if config is None:
+        config = get_config()
+    year = config.night_year(night)
+    if np.ndim(year)==0:
+        year = year.item()
+        if not year:
+            raise ValueError('Night %s is not in any season'%night)
     return year
 ###############################################
 
-def get_dessn_obs(s, night, expnum, chipnum,logger=None):
+def get_dessn_obs(s, night, expnum, chipnum,logger=None,year=None):
     '''Function to get the filename for a DES image for a
        given field, band, night, chip, and expnum.
        Uses an object of the Stack class.
        Returns path and name of the file requested.'''
     if not logger:
-        logger.handlers =[]
         logger = logging.getLogger(__name__)
+        logger.handlers =[]
         logger.setLevel(logging.DEBUG)
         formatter =logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
         ch = logging.StreamHandler()
@@ -374,75 +403,17 @@ def get_dessn_obs(s, night, expnum, chipnum,logger=None):
     field, band = s.field,s.band
     #------------------------------------
     chipnum = int(chipnum)
-    # step 1 - get the year of the observation
-    year = get_des_obs_year(night,logger)
+    # step 1 - get the year of the observation, unless it is already known
+    if year is None:
+        year = get_des_obs_year(night,logger,getattr(s,'config',None))
+    elif not year:
+        raise ValueError('Night %s is not in any season'%night)
     #------------------------------------
-    # step 2 - find the directory for this night
-    year_dir = s.data_dirs[year]
-    glob_str = year_dir+night+'-r????'
-    subdir = glob.glob(glob_str)[-1]+'/'
-    # then this field
-    field_glob_str = subdir+'*%s_%s*' % (field, band)
-    try:
-        field_subdir = glob.glob(field_glob_str)[-1]+'/'
-    except IndexError:
-        #that subdir doesn't have obs for our field in it
-        subdir=glob.glob(glob_str)[0]+'/'
-        field_glob_str = subdir+'*%s_%s*' % (field, band)
-        field_subdir = glob.glob(field_glob_str)[-1]+'/'
-    procs = []
-    counts  = []
-    if len(os.listdir(field_subdir))==0:
+    # step 2 - look the chip up in the index of the data directories
+    obs_fns = get_obs_index(s,logger).lookup(field,band,night,chipnum,year_dir=s.data_dirs[year])
+    if not obs_fns:
+        logger.warning('No files for %s %s on %s in chip %s'%(field,band,night,chipnum))
         return None
-
-    for counter,ext in enumerate(os.listdir(field_subdir)):
-        procs.append(int(ext[1:]))
-        counts.append(counter)
-    which = np.argmax(np.array(procs))
-    try:
-        field_subsubdir = field_subdir + os.listdir(field_subdir)[counts[which]]+'/'
-    except:
-        field_subsubdir = field_subdir + os.listdir(field_subdir)[-1]+'/'
-    #field_subsubdir = field_subdir + os.listdir(field_subdir)[-1]+'/'
-    # then the chip
-    chip_subdir = '%sccd%02d' % (field_subsubdir, chipnum)
-    #------------------------------------
-    # step 3 - find the final fits file at the end of the dir structure
-    curr_obs_dir = os.path.join(chip_subdir,'red')
-    rabbit_hole=True
-    while rabbit_hole:
-        obs_subdir_list = os.listdir(curr_obs_dir)
-        try:
-            if os.path.isfile(os.path.join(curr_obs_dir,obs_subdir_list[0])):
-                obs_dir = curr_obs_dir
-                rabbit_hole=False
-            else:
-                curr_obs_dir = os.path.join(curr_obs_dir,obs_subdir_list[0])
-        except:
-            logger.warning('No files in %s'%curr_obs_dir)
-            return None
-
-
-    #------------------------------------
-    # step 4 - CHECK THIS IS THE CORRECT EXPOSURE NUMBER!!!
-    obs_fns = []
-    if os.path.split(obs_dir)[-1] =='red':
-        list_of_imgs = glob.glob(os.path.join(obs_dir,'*immasked*'))
-        if len(list_of_imgs) == 0:
-            list_of_imgs = glob.glob(os.path.join(obs_dir,'*'))
-    else:
-        list_of_imgs = glob.glob(os.path.join(obs_dir,'*'))
-    for obs_fn in list_of_imgs:
-        try:
-            fits_expnum = fits.getheader(obs_fn)['EXPNUM']
-        except:
-            continue
-
-        if obs_fn[-9:] =='sked.fits':
-            obs_fn = obs_fn+'[0]'
-        fn_ext = os.path.split(obs_fn)[-1]
-        if fn_ext[:3]!='DSN':
-            obs_fns.append(obs_fn)
     return obs_fns
 
 def get_y3a1(path):
@@ -482,108 +453,86 @@ def get_y3a1(path):
         dat = conn.query_to_pandas(q)
         dat.to_csv(path+'/y3a1_%s_summary.csv'%f)
 
-def resample(s,lst,y,chip,cuts,j,logger,stamp_sizex=4200,stamp_sizey=2200):
-    '''Resamples a list of raw exposures so that they can be coadded'''
+def write_atomic(fn,text):
+    '''Writes text to fn through a temporary file, so nobody reads it half written and
+    stacks writing the same file at once do not mix their output'''
+    temp_fn = '%s.%s.%s'%(fn,os.getpid(),threading.get_ident())
+    with open(temp_fn,'w') as f:
+        f.write(text)
+    os.replace(temp_fn,fn)
+    return fn
+
+def write_list(fn,items):
+    '''Writes a list of files one per line, as np.savetxt does, through a temporary file'''
+    return write_atomic(fn,''.join('%s\n'%i for i in items))
+
+def resample(s,lst,y,chip,cuts,j,logger,stamp_sizex=4200,stamp_sizey=2200,nthreads=None):
+    '''Resamples a list of raw exposures onto the grid of their chip so that they can be coadded.
+    Exposures that have already been resampled onto that grid are taken from the cache'''
 
-    img_list = np.genfromtxt(lst,dtype='str',delimiter='\n')
+    img_list = np.atleast_1d(np.genfromtxt(lst,dtype='str',delimiter='\n'))
     if len(img_list)==0:
         logger.info('Empty list: %s \n %s'%(lst,img_list))
         return False
 
     starttime=float(time.time())
     logger.info('Creating weightmaps for individual input exposures in %s, %s band, chip %s'%(s.field,s.band,chip))
-    weightlist,resamplist,headerlist,masklist  = [],[],[],[]
-    os.chdir(s.temp_dir)
-    #try:
-    #    pixel_scale = 3600.0*abs(fits.getheader(img_list[0])['CD1_1'])
-    #except:
-        #pixel_scale = 3600.0*abs(fits.getheader(img_list[0][:-3])['CD1_1'])
+    weightlist,resamplist,headerlist  = [],[],[]
     ra_cent,dec_cent = get_chip_vals(s.field,int(chip))
-    try:
-        if len(img_list)>1:
-
-            for img in img_list:
-                imgname = os.path.split(img)[-1]
-                imgroot = imgname[:-5]
-                if imgroot[-2:]=='fi':
-                    imgroot = imgroot[:-3]
-                weightlist.append(os.path.join(s.temp_dir,imgroot +'.resamp.weight.fits'))
-                resamplist.append(os.path.join(s.temp_dir,imgroot+'.resamp.fits'))
-                headerlist.append(os.path.join(s.temp_dir,imgroot+'.resamp.head'))
-                masklist.append(os.path.join(s.temp_dir,imgroot+'.resamp.mask.fits'))
-
-
-            swarp_cmd = [
-            'swarp',
-            '@%s'%lst,
-            '-COMBINE','N',
-            '-RESAMPLE','Y',
-            #'-IMAGE_SIZE','%s,%s'%(4113,2058),
-            #'-CENTER_TYPE','MANUAL',
-            #'-CENTER','%f,%f'%(ra_cent,dec_cent),
-            #'-PIXELSCALE_TYPE','MANUAL',
-            #'-PIXEL_SCALE','0.2363',#'%.03f'%pixel_scale,
-            '-BACK_SIZE','256',
-            ]
-
-    except TypeError:
-        img = str(img_list)
-        swarp_cmd = [
-        'swarp','%s'%img,
-        '-COMBINE','N',
-        '-RESAMPLE','Y',
-        '-IMAGE_SIZE','%s,%s'%(stamp_sizex,stamp_sizey),
-        '-CENTER_TYPE','MANUAL',
-        '-CENTER','%f,%f'%(ra_cent,dec_cent),
-        '-PIXELSCALE_TYPE','MANUAL',
-        '-PIXEL_SCALE','0.2363',#'%.03f'%pixel_scale,
-        '-BACK_SIZE','256',
-        ]
+    # the grid (centre, pixel scale and size) is fixed for each chip so that stacks with different cuts
+    # can share the resampled images; left to itself SWarp sizes the frame to fit the images it is given
+    resamp_args = [
+    '-COMBINE','N',
+    '-RESAMPLE','Y',
+    '-CENTER_TYPE','MANUAL',
+    '-CENTER','%f,%f'%(ra_cent,dec_cent),
+    '-PIXELSCALE_TYPE','MANUAL',
+    '-PIXEL_SCALE','%.3f'%resamp_pixel_scale,
+    '-IMAGE_SIZE','%s,%s'%(stamp_sizex,stamp_sizey),
+    '-BACK_SIZE','256',
+    ]
+    cache = get_resamp_cache(s)
+    key = cache.make_key(resamp_args,os.path.join(s.temp_dir,'default.swarp'))
+    imgroots = []
+    for img in img_list:
         imgname = os.path.split(img)[-1]
         imgroot = imgname[:-5]
         if imgroot[-2:]=='fi':
             imgroot = imgroot[:-3]
+        imgroots.append(imgroot)
         weightlist.append(os.path.join(s.temp_dir,imgroot +'.resamp.weight.fits'))
         resamplist.append(os.path.join(s.temp_dir,imgroot+'.resamp.fits'))
         headerlist.append(os.path.join(s.temp_dir,imgroot+'.resamp.head'))
-        masklist.append(os.path.join(s.temp_dir,imgroot+'.resamp.mask.fits'))
-
-    logger.info('Resampling with command: %s'%swarp_cmd)
-    p = subprocess.Popen(swarp_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    outs,errs = p.communicate()
+    list_root = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s'%(y,s.field,s.band,chip,s.cutstring,j))
+    # keep these images until this part has been stacked (or stack_dag gives up on it); they are held
+    # from before they are looked up, so that another part can not evict those found while the rest are resampled
+    cache.acquire(list_root+'.resamp.lst',imgroots)
+    todo = [(img,imgroot) for img,imgroot in zip(img_list,imgroots) if not cache.lookup(img,imgroot,key)]
+    logger.info('%s of %s exposures in %s are already resampled'%(len(img_list)-len(todo),len(img_list),lst))
+
+    if len(todo)>0:
+        todo_name = write_list(lst.replace('.lst','.todo.lst'),[t[0] for t in todo])
+        name = '%s_%s_%s_%s_%s_resample_%s'%(y,s.field,s.band,chip,s.cutstring,j)
+        swarp_cmd = ['swarp','@%s'%todo_name]+resamp_args+['-RESAMPLE_DIR',s.temp_dir,'-XML_NAME',tool_xml(s,name)]
+        if nthreads:
+            swarp_cmd+=['-NTHREADS','%s'%nthreads]
+        run_tool(swarp_cmd,cwd=s.temp_dir,log_fn=tool_log(s,name),logger=logger,what='Resampling')
+        done = [(img,imgroot) for img,imgroot in todo if os.path.isfile(os.path.join(s.temp_dir,imgroot+'.resamp.fits'))]
+        for img,imgroot in sorted(set(todo)-set(done)):
+            logger.warning('SWarp did not resample %s'%img)
+        # the headers of the new images are read together (and kept for whoever needs them next),
+        # and each .head is renamed into place once written, as the same image may be resampled by another stack
+        heads = get_headers([os.path.join(s.temp_dir,imgroot+'.resamp.fits') for img,imgroot in done],logger=logger)
+        for (img,imgroot),h in zip(done,heads):
+            write_atomic(os.path.join(s.temp_dir,imgroot+'.resamp.head'),h.tostring(sep='\n',endcard=False,padding=False))
+            cache.add(img,imgroot,key)
     endtime=float(time.time())
     logger.info('Finished creating weightmaps for %s, %s band, chip %s; took %.3f seconds'%(s.field,s.band,chip,endtime-starttime))
 
-    weightlist = np.array(weightlist)
-    weightlist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.wgt.lst'%(y,s.field,s.band,chip,s.cutstring,j))
-    np.savetxt(weightlist_name,weightlist,fmt='%s')
-    resamplist = np.array(resamplist)
-    resamplist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.resamp.lst'%(y,s.field,s.band,chip,s.cutstring,j))
-    np.savetxt(resamplist_name,resamplist,fmt='%s')
-    headerlist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.head.lst'%(y,s.field,s.band,chip,s.cutstring,j))
-    np.savetxt(headerlist_name,headerlist,fmt='%s')
-
-    try:
-        for img in resamplist:
-            imgname = os.path.split(img)[-1]
-            imgroot = imgname[:-5]
-
-            if imgroot[-2:]=='fi':
-                imgroot = imgroot[:-3]
-            try:
-                imgn = img[:-3]
-                h = fits.getheader(imgn)
-            except:
-                h = fits.getheader(img)
-            header_name = os.path.join(s.temp_dir,imgroot+'.head')
-            if os.path.isfile(header_name):
-                os.remove(header_name)
-            h.totextfile(header_name)
-
-    except TypeError:
-        img = str(img_list)
-        h = fits.getheader(img)
-        h.totextfile(os.path.join(s.temp_dir,imgroot+'.head'))
+    weightlist_name = write_list(list_root+'.wgt.lst',weightlist)
+    resamplist_name = write_list(list_root+'.resamp.lst',resamplist)
+    write_list(list_root+'.head.lst',headerlist)
+    cache.evict(logger)
     return (weightlist_name,resamplist_name,headerlist)
 
 def make_cap_stamps(sg,sr,si,sz,chip,sn_name,ra,dec,stamp_sizex=4100,stamp_sizey=2100):
@@ -610,8 +559,7 @@ def make_cap_stamps(sg,sr,si,sz,chip,sn_name,ra,dec,stamp_sizex=4100,stamp_sizey
         glob_list = glob.glob(glob_string)
         sci_frames.append(glob_list[0])
         logger.info("Found the correct coadd, exists at: '%s'"%glob_list[0])
-    pixel_scale = 3600.0*abs(fits.getheader(sci_frames[0])['CD1_1'])
-    sci_frame_str = sci_frames[0]+' '+sci_frames[1]+' '+sci_frames[2]+' '+sci_frames[3]
+    pixel_scale = 3600.0*abs(getheader(sci_frames[0])['CD1_1'])
 
     # set up the directory if it doesn't already exist
     cap_dir = os.path.join(sg.out_dir,'CAP')
@@ -620,7 +568,6 @@ def make_cap_stamps(sg,sr,si,sz,chip,sn_name,ra,dec,stamp_sizex=4100,stamp_sizey
     sn_dir = os.path.join(cap_dir,sn_name)
     if not os.path.isdir(sn_dir):
         os.mkdir(sn_dir)
-    os.chdir(sn_dir)
     # make a white stamp as a det image
     logger.info('Resampling all bands in a stamp around %s'%sn_name)
     resamp_cmd = ['swarp',
@@ -632,13 +579,9 @@ def make_cap_stamps(sg,sr,si,sz,chip,sn_name,ra,dec,stamp_sizex=4100,stamp_sizey
     '-PIXELSCALE_TYPE','MANUAL',
     '-PIXEL_SCALE','%.03f'%pixel_scale,
     '-BACK_SIZE','512',
-    sci_frame_str]
-    logger.info("Swarping with the command:\n '%s'"%resamp_cmd)
-    starttime=float(time.time())
-    p = subprocess.Popen(resamp_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    outs,errs = p.communicate()
-    endtime=float(time.time())
-    logger.info('Done resampling a stamp around %s, took %.3f seconds'%(sn_name,endtime-starttime))
+    '-RESAMPLE_DIR',sn_dir]+sci_frames
+    run_tool(resamp_cmd,cwd=sn_dir,log_fn=tool_log(sg,'%s_cap_resample'%sn_name),logger=logger,
+        what='Resampling all bands in a stamp around %s'%sn_name)
 
     # Now resample the  image
     resamp_frames = []
@@ -655,26 +598,19 @@ def make_cap_stamps(sg,sr,si,sz,chip,sn_name,ra,dec,stamp_sizex=4100,stamp_sizey
         '-BACK_SIZE','512',
         '-IMAGEOUT_NAME',glob_list[0],
         glob_list[0]]
-        pr = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        out,errs = pr.communicate()
-    resamp_frame_str = resamp_frames[0]+' '+resamp_frames[1]+' '+resamp_frames[2]+' '+resamp_frames[3]
+        run_tool(cmd,cwd=sn_dir,log_fn=tool_log(sg,'%s_cap_stamp_%s'%(sn_name,s.band)),logger=logger,
+            what='Cutting a stamp around %s in the %s band'%(sn_name,s.band))
 
     return
 
 def get_chip_vals(f,chip,vals = 'center'):
     '''Function to get the ra, dec of the center or corners of one chip in a given field'''
 
-    lim_file=open('/media/data3/wiseman/des/coadding/config/chiplims.pkl','rb')
-    chiplims = cpickle.load(lim_file)
-    short_field = f[-2:]
-    field_lims = chiplims[short_field]
-    this_chip_lims = field_lims[chip]
+    chips = get_chip_index()
     if vals == 'center':
-        ras = [this_chip_lims[i][0] for i in range(4)]
-        decs = [this_chip_lims[i][1] for i in range(4)]
-        return (np.mean(ras),np.mean(decs))
+        return chips.center(f,chip)
     elif vals == 'lims':
-        return this_chip_lims
+        return chips.lims(f,chip)
 
 def resample_chip_for_cap(sg,sr,si,sz,chip,stamp_sizex=4300,stamp_sizey=2300,npix_off1 = 0,npix_off2 = 0):
     '''Function to resample the coadds in each band in order to create a detection image and do common aperture photometry'''
@@ -691,7 +627,6 @@ def resample_chip_for_cap(sg,sr,si,sz,chip,stamp_sizex=4300,stamp_sizey=2300,npi
     # start by getting the science frames for each band
 
     sci_frames = []
-    naxis1s,naxis2s = [],[]
     for s in [sg,sr,si,sz]:
         bd = s.band_dir
         # assume we don't have multiple versions of the science frame
@@ -702,11 +637,11 @@ def resample_chip_for_cap(sg,sr,si,sz,chip,stamp_sizex=4300,stamp_sizey=2300,npi
             logger.info('Failing on %s,%s'%(s.band,chip))
         sci_frames.append(glob_list[0])
         logger.info("Found the correct coadd, exists at: '%s'"%glob_list[0])
-        naxis1s.append(fits.getheader(glob_list[0])['NAXIS1'])
-        naxis2s.append(fits.getheader(glob_list[0])['NAXIS2'])
-    ghead = fits.getheader(sci_frames[0])
+    heads = get_headers(sci_frames,logger=logger)
+    naxis1s = [h['NAXIS1'] for h in heads]
+    naxis2s = [h['NAXIS2'] for h in heads]
+    ghead = heads[0]
     pixel_scale = 3600.0*abs(ghead['CD1_1'])
-    sci_frame_str = sci_frames[0]+' ' +sci_frames[1]+' '+sci_frames[2]+' '+sci_frames[3]
 
     # set up the directory if it doesn't already exist
     cap_dir = os.path.join(sg.out_dir,'MY%s'%sg.my,sg.field,'CAP')
@@ -715,7 +650,6 @@ def resample_chip_for_cap(sg,sr,si,sz,chip,stamp_sizex=4300,stamp_sizey=2300,npi
     cap_chip_dir = os.path.join(cap_dir,str(chip))
     if not os.path.isdir(cap_chip_dir):
         os.mkdir(cap_chip_dir)
-    os.chdir(cap_chip_dir)
     # find the center of the chip
     ra_cent,dec_cent = ghead['CRVAL1'],ghead['CRVAL2']
     smallest1,smallest2 = min(naxis1s),min(naxis2s)
@@ -733,13 +667,9 @@ def resample_chip_for_cap(sg,sr,si,sz,chip,stamp_sizex=4300,stamp_sizey=2300,npi
     '-PIXELSCALE_TYPE','MANUAL',
     '-PIXEL_SCALE','%.03f'%pixel_scale,
     '-BACK_SIZE','512',
-    sci_frame_str]
-    logger.info("Swarping with the command:\n '%s'"%resamp_cmd)
-    starttime=float(time.time())
-    p = subprocess.Popen(resamp_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    outs,errs = p.communicate()
-    endtime=float(time.time())
-    logger.info('Done resampling MY%s, %s, chip %s, took %.3f seconds'%(sg.my,sg.field,chip,endtime-starttime))
+    '-RESAMPLE_DIR',cap_chip_dir]+sci_frames
+    run_tool(resamp_cmd,cwd=cap_chip_dir,log_fn=tool_log(sg,'%s_%s_%s_cap_resample'%(sg.my,sg.field,chip)),logger=logger,
+        what='Resampling MY%s, %s, chip %s'%(sg.my,sg.field,chip))
     # Now resample the  image
     resamp_frames = []
     for s in [sg,sr,si,sz]:
@@ -747,7 +677,7 @@ def resample_chip_for_cap(sg,sr,si,sz,chip,stamp_sizex=4300,stamp_sizey=2300,npi
         glob_list = glob.glob(glob_string)
         resamp_frames.append(glob_list[0])
 
-    resamp_frame_str = resamp_frames[1]+' '+resamp_frames[2]+' '+resamp_frames[3]
+    riz_name = os.path.join(cap_chip_dir,'%s_%s_%s_riz.fits'%(sg.my,sg.field,chip))
     logger.info('Creating riz with size %s x %s'%(stamp_sizex,stamp_sizey))
     riz_cmd = ['swarp',
     '-IMAGE_SIZE','%s,%s'%(stamp_sizex,stamp_sizey),
@@ -758,30 +688,25 @@ def resample_chip_for_cap(sg,sr,si,sz,chip,stamp_sizex=4300,stamp_sizey=2300,npi
     '-COMBINE','Y',
     '-RESAMPLE','N',
     '-BACK_SIZE','512',
-    '-IMAGEOUT_NAME','%s_%s_%s_riz.fits'%(sg.my,sg.field,chip),
-    resamp_frame_str]
-    logger.info("Making a detection image for MY%s, %s, chip %s for CAP"%(sg.my,sg.field,chip))
-    logger.info("Using this command: %s"%riz_cmd)
-    starttime=float(time.time())
-    p = subprocess.Popen(riz_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    outs,errs = p.communicate()
-    endtime=float(time.time())
-    logger.info('Done making detection image for for MY%s, %s, chip %s, took %.3f seconds'%(sg.my,sg.field,chip,endtime-starttime))
+    '-IMAGEOUT_NAME',riz_name]+resamp_frames[1:]
+    run_tool(riz_cmd,cwd=cap_chip_dir,log_fn=tool_log(sg,'%s_%s_%s_cap_riz'%(sg.my,sg.field,chip)),logger=logger,
+        what="Making a detection image for MY%s, %s, chip %s for CAP"%(sg.my,sg.field,chip))
     logger.info('Checking they are the correct size')
-    n_off1,n_off2 = check_resamps('%s_%s_%s_riz.fits'%(sg.my,sg.field,chip),resamp_frames)
-    return '%s_%s_%s_riz.fits'%(sg.my,sg.field,chip),n_off1,n_off2
+    n_off1,n_off2 = check_resamps(riz_name,resamp_frames)
+    return riz_name,n_off1,n_off2
 
 def check_resamps(riz_fn,resamp_frames):
     '''Convenience function to check if a resample is too big'''
 
-    riz_h = fits.getheader(riz_fn)
+    heads = get_headers([riz_fn]+list(resamp_frames))
+    riz_h = heads[0]
     n1riz,n2riz = riz_h['NAXIS1'],riz_h['NAXIS2']
     #print ('Length of riz: %s x %s'%(n1riz,n2riz))
     n_off1 = 0
     n_off2 = 0
     for i in range(len(resamp_frames)):
         print (resamp_frames[i])
-        h = fits.getheader(resamp_frames[i])
+        h = heads[i+1]
         n1,n2 = h['NAXIS1'],h['NAXIS2']
         n_diff1 = n1riz - n1
         n_diff2 = n2riz - n2
@@ -795,65 +720,7 @@ def check_resamps(riz_fn,resamp_frames):
     print ('Returning',n_off1*2,n_off2*2)
     return (n_off1*2,n_off2*2)
 
-def get_cuts(f,b):
+def get_cuts(f,b,config_dir=None):
     '''Function that returns the adopted teff and psf cuts for a given field and band'''
 
-    cp=configparser.ConfigParser()
-    # read the .ini file
-    cp.read('/media/data3/wiseman/des/coadding/config/snobs_params.ini')
-
-    if f[-1]!='3':
-        cuts = cp['%s_shallow'%b]
-    else:
-        cuts = cp['%s_deep'%b]
-    cuts = dict(cuts)
-    try:
-        cuts['teff']=float(cuts['teff'])
-    except:
-        pass
-    try:
-        cuts['psf']=float(cuts['psf'])
-    except:
-        pass
-
-    return cuts
-
-def combine_mask_weight(s,chip,j):
-    '''Function that combines the outlier masks and weightmaps'''
-
-    maskweightlist,masklist = [],[]
-    resamplist_name = os.path.join(s.list_dir,'%s_%s_%s_%s_%s_%s.resamp.lst'%(s.my,s.field,s.band,chip,s.cutstring,j))
-    for f in np.genfromtxt(resamplist_name,dtype='str',delimiter='\n'):
-        if f[-3:]=='[0]':
-            f = f[:-3]
-        #try:
-        wn = os.path.join(s.temp_dir,f.replace('fits','weight.fits'))
-        mn = os.path.join(s.temp_dir,f.replace('fits','head.mask.fits'))
-        masklist.append(mn)
-        w = fits.open(wn)
-        wd = w[0].data
-        m = fits.getdata(mn)
-        try:
-            maskweight = np.multiply(wd,m)
-        except ValueError:
-            if wd.shape[0]<m.shape[0] or wd.shape[1]<m.shape[1]:
-                new_mask = m[:wd.shape[0],:wd.shape[1]]
-            elif wd.shape[0]>m.shape[0] or wd.shape[1]>m.shape[1]:
-                new_mask = np.ones_like(wd)
-                new_mask[:m.shape[0],:m.shape[1]]=m
-            maskweight = np.multiply(wd,new_mask)
-        w[0].data = maskweight
-        #print ('Weight size',w[0].header['NAXIS1'],w[0].header['NAXIS2'])
-        w.writeto(os.path.join(s.temp_dir,f.replace('fits','maskweight.fits')),overwrite=True)
-        maskweightlist.append(os.path.join(s.temp_dir,f.replace('fits','maskweight.fits')))
-
-            #except:
-                #wn = os.path.join(s.temp_dir,f.replace('fits','weight.fits'))
-                #w = fits.open(wn)
-                #w.writeto(os.path.join(s.temp_dir,f.replace('fits','maskweight.fits')),overwrite=True)
-                #maskweightlist.append(os.path.join(s.temp_dir,f.replace('fits','maskweight.fits')))
-
-    np.savetxt(resamplist_name.replace('resamp','maskweight'),np.array(maskweightlist),fmt='%s')
-    for mn in masklist:
-        os.remove(mn)
-    return maskweightlist
+    return get_config(config_dir).get_cuts(f,b)
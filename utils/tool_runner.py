@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''tool_runner.py: Runs SWarp, SExtractor and PSFEx without changing directory.
+
+The external programs look for their default.* config files in the directory they are
+run from, and write some outputs there. Rather than os.chdir (which changes the
+directory of every thread in the process), each call is given its directory with cwd=,
+its config file with -c and absolute paths for its outputs, so that calls from
+different threads do not get in each other's way. The output of each call can be kept
+in a log file of its own, and calls that hang are killed after a timeout.'''
+
+import os
+import time
+import logging
+import subprocess
+
+# config file each program reads by default
+default_configs = {'swarp':'default.swarp','sex':'default.sex','psfex':'default.psfex'}
+# seconds after which each program is assumed to have hung
+tool_timeouts = {'swarp':4*3600,'sex':3600,'psfex':3600}
+
+def tool_cmd(cmd,cwd=None,config=None):
+    '''Adds -c with the config file to a command, if it has one.
+    Without an explicit config, the default config of the program in cwd is used'''
+    cmd = [str(c) for c in cmd]
+    tool = os.path.split(cmd[0])[-1]
+    if '-c' in cmd:
+        return cmd
+    if not config and cwd and tool in default_configs:
+        config = os.path.join(cwd,default_configs[tool])
+    if config and os.path.isfile(config):
+        cmd = [cmd[0],'-c',os.path.abspath(config)]+cmd[1:]
+    return cmd
+
+def run_tool(cmd,cwd=None,config=None,log_fn=None,timeout=None,logger=None,what=None,stdin=None):
+    '''Runs an external program, logging how long it took.
+    arguments:
+    cmd (list): the command, starting with the program
+    cwd (str): directory to run it in (default = the current directory)
+    config (str): config file to pass with -c (default = the default config in cwd)
+    log_fn (str): file to write its stdout and stderr to
+    timeout (float): seconds to wait before killing it (default = from tool_timeouts)
+    what (str): description of the call for the log
+    returns:
+    returncode (int): or None if it could not be run or timed out
+    '''
+    if not logger:
+        logger = logging.getLogger(__name__)
+    cmd = tool_cmd(cmd,cwd,config)
+    tool = os.path.split(cmd[0])[-1]
+    what = what or 'Running %s'%tool
+    if timeout is None:
+        timeout = tool_timeouts.get(tool)
+    logger.info('%s with command: %s'%(what,cmd))
+    starttime=float(time.time())
+    try:
+        p = subprocess.Popen(cmd,stdin=stdin,stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=cwd)
+    except (OSError, IOError):
+        logger.warning('%s failed for some reason'%what)
+        return None
+    try:
+        outs,errs = p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        outs,errs = p.communicate()
+        logger.error('%s took longer than %s seconds, so it was stopped'%(what,timeout))
+        p.returncode = None
+    if log_fn:
+        log_dir = os.path.split(log_fn)[0]
+        if log_dir and not os.path.isdir(log_dir):
+            os.makedirs(log_dir,exist_ok=True)
+        with open(log_fn,'wb') as f:
+            f.write(('%s\n'%' '.join(cmd)).encode())
+            f.write(outs or b'')
+            f.write(errs or b'')
+    endtime=float(time.time())
+    if p.returncode:
+        logger.warning('%s exited with code %s'%(what,p.returncode))
+    logger.info('Finished %s. Took %.3f seconds' %(what,endtime-starttime))
+    return p.returncode
+
+def tool_log(s,name):
+    '''Returns the file to keep the output of one call in, in the log dir of a Stack'''
+    return os.path.join(s.log_dir,'tools','%s.log'%name)
+
+def tool_xml(s,name):
+    '''Returns the file for SWarp to write the XML of one call to, next to its log.
+    SWarp writes swarp.xml in its directory by default, which calls running side by side would share'''
+    xml_fn = tool_log(s,name)[:-4]+'.xml'
+    os.makedirs(os.path.split(xml_fn)[0],exist_ok=True)
+    return xml_fn